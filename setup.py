@@ -27,7 +27,7 @@ setup(
 
       # C extension
       ext_modules=[Extension('ssw/libssw',
-                             ['src/ssw/ssw.c'],
+                             ['src/ssw/ssw.c', 'src/ssw/ssw_batch.c'],
                              include_dirs=["src/ssw"])],
 
       # Command line script
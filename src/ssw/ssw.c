@@ -51,6 +51,15 @@
 #define UNLIKELY(x) (x)
 #endif
 
+/* AVX2 kernels are compiled (with function target attributes, so that no special compiler flags are
+   needed) wherever the compiler supports them, and used only if the cpu running the code does */
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__)) && \
+	(defined(__clang__) || __GNUC__ > 4 || (__GNUC__ == 4 && __GNUC_MINOR__ >= 9))
+#define SSW_AVX2 1
+#include <immintrin.h>
+#define AVX2_TARGET __attribute__((target("avx2")))
+#endif
+
 /* Convert the coordinate in the scoring matrix into the coordinate in one line of the band. */
 #define set_u(u, w, i, j) { int x=(i)-(w); x=x>0?x:0; (u)=(j)-x+1; }
 
@@ -76,13 +85,14 @@ typedef struct {
 } cigar;
 
 struct _profile{
-	__m128i* profile_byte;	// 0: none
-	__m128i* profile_word;	// 0: none
+	void* profile_byte;	// 0: none
+	void* profile_word;	// 0: none
 	const int8_t* read;
 	const int8_t* mat;
 	int32_t readLen;
 	int32_t n;
 	uint8_t bias;
+	uint8_t avx2;	// the profiles are laid out for (and aligned with) the AVX2 kernels
 };
 
 /* Generate query profile rearrange query sequence & calculate the weight of match/mismatch. */
@@ -545,6 +555,468 @@ end:
 	return bests;
 }
 
+#ifdef SSW_AVX2
+
+/* AVX2 versions of qP_byte, sw_sse2_byte, qP_word and sw_sse2_word: the same striped algorithm with
+   32 byte (or 16 word) lanes, giving exactly the same results */
+
+/* Shift the whole 256-bit register left by n bytes; _mm256_slli_si256 only shifts within each 128-bit lane. */
+#define avx2_slli(v, n) _mm256_alignr_epi8((v), _mm256_permute2x128_si256((v), (v), 0x08), 16 - (n))
+
+static void* avx2_calloc (size_t size) {
+	void* p = 0;
+	if (posix_memalign(&p, 32, size) != 0) return 0;
+	memset(p, 0, size);
+	return p;
+}
+
+/* The rows past the end of the read (scored 0) carry the scores of the last row along the diagonal, which ends up in
+   the column maxima and thus in the sub-optimal score; the AVX2 kernels have more of these rows than the SSE2 ones, so the
+   rows that the SSE2 kernels don't have are masked out of the column maxima. Returns the mask of each segment. */
+static __m256i* avx2_row_mask (int32_t segLen, int32_t lanes, int32_t laneBytes, int32_t rows) {
+	__m256i* pvMask = (__m256i*) avx2_calloc(segLen * sizeof(__m256i));
+	uint8_t* t = (uint8_t*)pvMask;
+	int32_t i, lane;
+	for (i = 0; i < segLen; ++i) {
+		for (lane = 0; lane < lanes; ++lane) {
+			memset(t, i + lane * segLen < rows ? 0xff : 0, laneBytes);
+			t += laneBytes;
+		}
+	}
+	return pvMask;
+}
+
+AVX2_TARGET
+static __m256i* qP_byte_avx2 (const int8_t* read_num,
+				  const int8_t* mat,
+				  const int32_t readLen,
+				  const int32_t n,
+				  uint8_t bias) {
+
+	int32_t segLen = (readLen + 31) / 32;
+	__m256i* vProfile = (__m256i*)avx2_calloc(n * segLen * sizeof(__m256i));
+	int8_t* t = (int8_t*)vProfile;
+	int32_t nt, i, j, segNum;
+
+	for (nt = 0; LIKELY(nt < n); nt ++) {
+		for (i = 0; i < segLen; i ++) {
+			j = i;
+			for (segNum = 0; LIKELY(segNum < 32) ; segNum ++) {
+				*t++ = j>= readLen ? bias : mat[nt * n + read_num[j]] + bias;
+				j += segLen;
+			}
+		}
+	}
+	return vProfile;
+}
+
+AVX2_TARGET
+static alignment_end* sw_avx2_byte (const int8_t* ref,
+							 int8_t ref_dir,
+							 int32_t refLen,
+							 int32_t readLen,
+							 const uint8_t weight_gapO,
+							 const uint8_t weight_gapE,
+							 const __m256i* vProfile,
+							 uint8_t terminate,
+	 						 uint8_t bias,
+							 int32_t maskLen) {
+
+#define max32(m, vm) { __m128i vm128 = _mm_max_epu8(_mm256_castsi256_si128(vm), _mm256_extracti128_si256((vm), 1)); \
+					  vm128 = _mm_max_epu8(vm128, _mm_srli_si128(vm128, 8)); \
+					  vm128 = _mm_max_epu8(vm128, _mm_srli_si128(vm128, 4)); \
+					  vm128 = _mm_max_epu8(vm128, _mm_srli_si128(vm128, 2)); \
+					  vm128 = _mm_max_epu8(vm128, _mm_srli_si128(vm128, 1)); \
+					  (m) = _mm_extract_epi16(vm128, 0); }
+
+	uint8_t max = 0;
+	int32_t end_read = readLen - 1;
+	int32_t end_ref = -1;
+	int32_t segLen = (readLen + 31) / 32;
+
+	uint8_t* maxColumn = (uint8_t*) calloc(refLen, 1);
+
+	__m256i vZero = _mm256_setzero_si256();
+
+	__m256i* pvHStore = (__m256i*) avx2_calloc(segLen * sizeof(__m256i));
+	__m256i* pvHLoad = (__m256i*) avx2_calloc(segLen * sizeof(__m256i));
+	__m256i* pvE = (__m256i*) avx2_calloc(segLen * sizeof(__m256i));
+	__m256i* pvHmax = (__m256i*) avx2_calloc(segLen * sizeof(__m256i));
+	__m256i* pvMask = avx2_row_mask(segLen, 32, 1, (readLen + 15) / 16 * 16);
+
+	int32_t i, j;
+	__m256i vGapO = _mm256_set1_epi8(weight_gapO);
+	__m256i vGapE = _mm256_set1_epi8(weight_gapE);
+	__m256i vBias = _mm256_set1_epi8(bias);
+
+	__m256i vMaxScore = vZero;
+	__m256i vMaxMark = vZero;
+	__m256i vTemp;
+	int32_t edge, begin = 0, end = refLen, step = 1;
+
+	if (ref_dir == 1) {
+		begin = refLen - 1;
+		end = -1;
+		step = -1;
+	}
+	for (i = begin; LIKELY(i != end); i += step) {
+		int32_t cmp;
+		__m256i e, vF = vZero, vMaxColumn = vZero;
+
+		__m256i vH = pvHStore[segLen - 1];
+		vH = avx2_slli(vH, 1);
+		const __m256i* vP = vProfile + ref[i] * segLen;
+
+		__m256i* pv = pvHLoad;
+		pvHLoad = pvHStore;
+		pvHStore = pv;
+
+		for (j = 0; LIKELY(j < segLen); ++j) {
+			vH = _mm256_adds_epu8(vH, _mm256_load_si256(vP + j));
+			vH = _mm256_subs_epu8(vH, vBias);
+
+			e = _mm256_load_si256(pvE + j);
+			vH = _mm256_max_epu8(vH, e);
+			vH = _mm256_max_epu8(vH, vF);
+			vMaxColumn = _mm256_max_epu8(vMaxColumn, _mm256_and_si256(vH, _mm256_load_si256(pvMask + j)));
+
+			_mm256_store_si256(pvHStore + j, vH);
+
+			vH = _mm256_subs_epu8(vH, vGapO);
+			e = _mm256_subs_epu8(e, vGapE);
+			e = _mm256_max_epu8(e, vH);
+			_mm256_store_si256(pvE + j, e);
+
+			vF = _mm256_subs_epu8(vF, vGapE);
+			vF = _mm256_max_epu8(vF, vH);
+
+			vH = _mm256_load_si256(pvHLoad + j);
+		}
+
+		/* Lazy_F loop, as in sw_sse2_byte */
+		j = 0;
+		vH = _mm256_load_si256 (pvHStore + j);
+		vF = avx2_slli (vF, 1);
+		vTemp = _mm256_subs_epu8 (vH, vGapO);
+		vTemp = _mm256_subs_epu8 (vF, vTemp);
+		vTemp = _mm256_cmpeq_epi8 (vTemp, vZero);
+		cmp  = _mm256_movemask_epi8 (vTemp);
+
+		while (cmp != -1)
+		{
+			vH = _mm256_max_epu8 (vH, vF);
+			vMaxColumn = _mm256_max_epu8(vMaxColumn, _mm256_and_si256(vH, _mm256_load_si256(pvMask + j)));
+			_mm256_store_si256 (pvHStore + j, vH);
+			vF = _mm256_subs_epu8 (vF, vGapE);
+			j++;
+			if (j >= segLen)
+			{
+				j = 0;
+				vF = avx2_slli (vF, 1);
+			}
+			vH = _mm256_load_si256 (pvHStore + j);
+
+			vTemp = _mm256_subs_epu8 (vH, vGapO);
+			vTemp = _mm256_subs_epu8 (vF, vTemp);
+			vTemp = _mm256_cmpeq_epi8 (vTemp, vZero);
+			cmp  = _mm256_movemask_epi8 (vTemp);
+		}
+
+		vMaxScore = _mm256_max_epu8(vMaxScore, vMaxColumn);
+		vTemp = _mm256_cmpeq_epi8(vMaxMark, vMaxScore);
+		cmp = _mm256_movemask_epi8(vTemp);
+		if (cmp != -1) {
+			uint8_t temp;
+			vMaxMark = vMaxScore;
+			max32(temp, vMaxScore);
+
+			if (LIKELY(temp > max)) {
+				max = temp;
+				if (max + bias >= 255) break;	//overflow
+				end_ref = i;
+
+				for (j = 0; LIKELY(j < segLen); ++j) pvHmax[j] = pvHStore[j];
+			}
+		}
+
+		max32(maxColumn[i], vMaxColumn);
+		if (maxColumn[i] == terminate) break;
+	}
+
+	uint8_t *t = (uint8_t*)pvHmax;
+	int32_t column_len = segLen * 32;
+	for (i = 0; LIKELY(i < column_len); ++i, ++t) {
+		int32_t temp;
+		if (*t == max) {
+			temp = i / 32 + i % 32 * segLen;
+			if (temp < end_read) end_read = temp;
+		}
+	}
+
+	free(pvMask);
+	free(pvHmax);
+	free(pvE);
+	free(pvHLoad);
+	free(pvHStore);
+
+	alignment_end* bests = (alignment_end*) calloc(2, sizeof(alignment_end));
+	bests[0].score = max + bias >= 255 ? 255 : max;
+	bests[0].ref = end_ref;
+	bests[0].read = end_read;
+
+	bests[1].score = 0;
+	bests[1].ref = 0;
+	bests[1].read = 0;
+
+	edge = (end_ref - maskLen) > 0 ? (end_ref - maskLen) : 0;
+	for (i = 0; i < edge; i ++) {
+		if (maxColumn[i] > bests[1].score) {
+			bests[1].score = maxColumn[i];
+			bests[1].ref = i;
+		}
+	}
+	edge = (end_ref + maskLen) > refLen ? refLen : (end_ref + maskLen);
+	for (i = edge + 1; i < refLen; i ++) {
+		if (maxColumn[i] > bests[1].score) {
+			bests[1].score = maxColumn[i];
+			bests[1].ref = i;
+		}
+	}
+
+	free(maxColumn);
+	return bests;
+}
+
+AVX2_TARGET
+static __m256i* qP_word_avx2 (const int8_t* read_num,
+				  const int8_t* mat,
+				  const int32_t readLen,
+				  const int32_t n) {
+
+	int32_t segLen = (readLen + 15) / 16;
+	__m256i* vProfile = (__m256i*)avx2_calloc(n * segLen * sizeof(__m256i));
+	int16_t* t = (int16_t*)vProfile;
+	int32_t nt, i, j;
+	int32_t segNum;
+
+	for (nt = 0; LIKELY(nt < n); nt ++) {
+		for (i = 0; i < segLen; i ++) {
+			j = i;
+			for (segNum = 0; LIKELY(segNum < 16) ; segNum ++) {
+				*t++ = j>= readLen ? 0 : mat[nt * n + read_num[j]];
+				j += segLen;
+			}
+		}
+	}
+	return vProfile;
+}
+
+AVX2_TARGET
+static alignment_end* sw_avx2_word (const int8_t* ref,
+							 int8_t ref_dir,
+							 int32_t refLen,
+							 int32_t readLen,
+							 const uint8_t weight_gapO,
+							 const uint8_t weight_gapE,
+							 const __m256i* vProfile,
+							 uint16_t terminate,
+							 int32_t maskLen) {
+
+#define max16w(m, vm) { __m128i vm128 = _mm_max_epi16(_mm256_castsi256_si128(vm), _mm256_extracti128_si256((vm), 1)); \
+					vm128 = _mm_max_epi16(vm128, _mm_srli_si128(vm128, 8)); \
+					vm128 = _mm_max_epi16(vm128, _mm_srli_si128(vm128, 4)); \
+					vm128 = _mm_max_epi16(vm128, _mm_srli_si128(vm128, 2)); \
+					(m) = _mm_extract_epi16(vm128, 0); }
+
+	uint16_t max = 0;
+	int32_t end_read = readLen - 1;
+	int32_t end_ref = 0;
+	int32_t segLen = (readLen + 15) / 16;
+
+	uint16_t* maxColumn = (uint16_t*) calloc(refLen, 2);
+
+	__m256i vZero = _mm256_setzero_si256();
+
+	__m256i* pvHStore = (__m256i*) avx2_calloc(segLen * sizeof(__m256i));
+	__m256i* pvHLoad = (__m256i*) avx2_calloc(segLen * sizeof(__m256i));
+	__m256i* pvE = (__m256i*) avx2_calloc(segLen * sizeof(__m256i));
+	__m256i* pvHmax = (__m256i*) avx2_calloc(segLen * sizeof(__m256i));
+	__m256i* pvMask = avx2_row_mask(segLen, 16, 2, (readLen + 7) / 8 * 8);
+
+	int32_t i, j, k;
+	__m256i vGapO = _mm256_set1_epi16(weight_gapO);
+	__m256i vGapE = _mm256_set1_epi16(weight_gapE);
+
+	__m256i vMaxScore = vZero;
+	__m256i vMaxMark = vZero;
+	__m256i vTemp;
+	int32_t edge, begin = 0, end = refLen, step = 1;
+
+	if (ref_dir == 1) {
+		begin = refLen - 1;
+		end = -1;
+		step = -1;
+	}
+	for (i = begin; LIKELY(i != end); i += step) {
+		int32_t cmp;
+		__m256i e, vF = vZero;
+		__m256i vH = pvHStore[segLen - 1];
+		vH = avx2_slli (vH, 2);
+
+		__m256i* pv = pvHLoad;
+
+		__m256i vMaxColumn = vZero;
+
+		const __m256i* vP = vProfile + ref[i] * segLen;
+		pvHLoad = pvHStore;
+		pvHStore = pv;
+
+		for (j = 0; LIKELY(j < segLen); j ++) {
+			vH = _mm256_adds_epi16(vH, _mm256_load_si256(vP + j));
+
+			e = _mm256_load_si256(pvE + j);
+			vH = _mm256_max_epi16(vH, e);
+			vH = _mm256_max_epi16(vH, vF);
+			vMaxColumn = _mm256_max_epi16(vMaxColumn, _mm256_and_si256(vH, _mm256_load_si256(pvMask + j)));
+
+			_mm256_store_si256(pvHStore + j, vH);
+
+			vH = _mm256_subs_epu16(vH, vGapO);
+			e = _mm256_subs_epu16(e, vGapE);
+			e = _mm256_max_epi16(e, vH);
+			_mm256_store_si256(pvE + j, e);
+
+			vF = _mm256_subs_epu16(vF, vGapE);
+			vF = _mm256_max_epi16(vF, vH);
+
+			vH = _mm256_load_si256(pvHLoad + j);
+		}
+
+		/* Lazy_F loop, as in sw_sse2_word */
+		for (k = 0; LIKELY(k < 16); ++k) {
+			vF = avx2_slli (vF, 2);
+			for (j = 0; LIKELY(j < segLen); ++j) {
+				vH = _mm256_load_si256(pvHStore + j);
+				vH = _mm256_max_epi16(vH, vF);
+				_mm256_store_si256(pvHStore + j, vH);
+				vH = _mm256_subs_epu16(vH, vGapO);
+				vF = _mm256_subs_epu16(vF, vGapE);
+				if (UNLIKELY(! _mm256_movemask_epi8(_mm256_cmpgt_epi16(vF, vH)))) goto end;
+			}
+		}
+
+end:
+		vMaxScore = _mm256_max_epi16(vMaxScore, vMaxColumn);
+		vTemp = _mm256_cmpeq_epi16(vMaxMark, vMaxScore);
+		cmp = _mm256_movemask_epi8(vTemp);
+		if (cmp != -1) {
+			uint16_t temp;
+			vMaxMark = vMaxScore;
+			max16w(temp, vMaxScore);
+
+			if (LIKELY(temp > max)) {
+				max = temp;
+				end_ref = i;
+				for (j = 0; LIKELY(j < segLen); ++j) pvHmax[j] = pvHStore[j];
+			}
+		}
+
+		max16w(maxColumn[i], vMaxColumn);
+		if (maxColumn[i] == terminate) break;
+	}
+
+	uint16_t *t = (uint16_t*)pvHmax;
+	int32_t column_len = segLen * 16;
+	for (i = 0; LIKELY(i < column_len); ++i, ++t) {
+		int32_t temp;
+		if (*t == max) {
+			temp = i / 16 + i % 16 * segLen;
+			if (temp < end_read) end_read = temp;
+		}
+	}
+
+	free(pvMask);
+	free(pvHmax);
+	free(pvE);
+	free(pvHLoad);
+	free(pvHStore);
+
+	alignment_end* bests = (alignment_end*) calloc(2, sizeof(alignment_end));
+	bests[0].score = max;
+	bests[0].ref = end_ref;
+	bests[0].read = end_read;
+
+	bests[1].score = 0;
+	bests[1].ref = 0;
+	bests[1].read = 0;
+
+	edge = (end_ref - maskLen) > 0 ? (end_ref - maskLen) : 0;
+	for (i = 0; i < edge; i ++) {
+		if (maxColumn[i] > bests[1].score) {
+			bests[1].score = maxColumn[i];
+			bests[1].ref = i;
+		}
+	}
+	edge = (end_ref + maskLen) > refLen ? refLen : (end_ref + maskLen);
+	for (i = edge; i < refLen; i ++) {
+		if (maxColumn[i] > bests[1].score) {
+			bests[1].score = maxColumn[i];
+			bests[1].ref = i;
+		}
+	}
+
+	free(maxColumn);
+	return bests;
+}
+
+#endif	// SSW_AVX2
+
+/* -1: not decided yet (see ssw_set_avx2) */
+static int32_t use_avx2 = -1;
+
+int32_t ssw_set_avx2 (int32_t level) {
+#ifdef SSW_AVX2
+	__builtin_cpu_init();
+	use_avx2 = level != 0 && __builtin_cpu_supports("avx2") ? 1 : 0;
+#else
+	use_avx2 = 0;
+#endif
+	return use_avx2;
+}
+
+/* Dispatch to the SSE2 or AVX2 version of the kernels, according to the layout of the profile. */
+static void* qP_byte_any (int8_t avx2, const int8_t* read_num, const int8_t* mat, const int32_t readLen, const int32_t n, uint8_t bias) {
+#ifdef SSW_AVX2
+	if (avx2) return qP_byte_avx2(read_num, mat, readLen, n, bias);
+#endif
+	return qP_byte(read_num, mat, readLen, n, bias);
+}
+
+static void* qP_word_any (int8_t avx2, const int8_t* read_num, const int8_t* mat, const int32_t readLen, const int32_t n) {
+#ifdef SSW_AVX2
+	if (avx2) return qP_word_avx2(read_num, mat, readLen, n);
+#endif
+	return qP_word(read_num, mat, readLen, n);
+}
+
+static alignment_end* sw_byte_any (int8_t avx2, const int8_t* ref, int8_t ref_dir, int32_t refLen, int32_t readLen,
+							 const uint8_t weight_gapO, const uint8_t weight_gapE, const void* vProfile,
+							 uint8_t terminate, uint8_t bias, int32_t maskLen) {
+#ifdef SSW_AVX2
+	if (avx2) return sw_avx2_byte(ref, ref_dir, refLen, readLen, weight_gapO, weight_gapE, (const __m256i*)vProfile, terminate, bias, maskLen);
+#endif
+	return sw_sse2_byte(ref, ref_dir, refLen, readLen, weight_gapO, weight_gapE, (const __m128i*)vProfile, terminate, bias, maskLen);
+}
+
+static alignment_end* sw_word_any (int8_t avx2, const int8_t* ref, int8_t ref_dir, int32_t refLen, int32_t readLen,
+							 const uint8_t weight_gapO, const uint8_t weight_gapE, const void* vProfile,
+							 uint16_t terminate, int32_t maskLen) {
+#ifdef SSW_AVX2
+	if (avx2) return sw_avx2_word(ref, ref_dir, refLen, readLen, weight_gapO, weight_gapE, (const __m256i*)vProfile, terminate, maskLen);
+#endif
+	return sw_sse2_word(ref, ref_dir, refLen, readLen, weight_gapO, weight_gapE, (const __m128i*)vProfile, terminate, maskLen);
+}
+
 static cigar* banded_sw (const int8_t* ref,
 				 const int8_t* read,
 				 int32_t refLen,
@@ -751,6 +1223,8 @@ s_profile* ssw_init (const int8_t* read, const int32_t readLen, const int8_t* ma
 	p->profile_byte = 0;
 	p->profile_word = 0;
 	p->bias = 0;
+	if (use_avx2 < 0) ssw_set_avx2(-1);
+	p->avx2 = use_avx2;
 
 	if (score_size == 0 || score_size == 2) {
 		/* Find the bias to use in the substitution matrix */
@@ -759,9 +1233,9 @@ s_profile* ssw_init (const int8_t* read, const int32_t readLen, const int8_t* ma
 		bias = abs(bias);
 
 		p->bias = bias;
-		p->profile_byte = qP_byte (read, mat, readLen, n, bias);
+		p->profile_byte = qP_byte_any (p->avx2, read, mat, readLen, n, bias);
 	}
-	if (score_size == 1 || score_size == 2) p->profile_word = qP_word (read, mat, readLen, n);
+	if (score_size == 1 || score_size == 2) p->profile_word = qP_word_any (p->avx2, read, mat, readLen, n);
 	p->read = read;
 	p->mat = mat;
 	p->readLen = readLen;
@@ -786,7 +1260,7 @@ s_align* ssw_align (const s_profile* prof,
 					const int32_t maskLen) {
 
 	alignment_end* bests = 0, *bests_reverse = 0;
-	__m128i* vP = 0;
+	void* vP = 0;
 	int32_t word = 0, band_width = 0, readLen = prof->readLen;
 	int8_t* read_reverse = 0;
 	cigar* path;
@@ -801,10 +1275,10 @@ s_align* ssw_align (const s_profile* prof,
 
 	// Find the alignment scores and ending positions
 	if (prof->profile_byte) {
-		bests = sw_sse2_byte(ref, 0, refLen, readLen, weight_gapO, weight_gapE, prof->profile_byte, -1, prof->bias, maskLen);
+		bests = sw_byte_any(prof->avx2, ref, 0, refLen, readLen, weight_gapO, weight_gapE, prof->profile_byte, -1, prof->bias, maskLen);
 		if (prof->profile_word && bests[0].score == 255) {
 			free(bests);
-			bests = sw_sse2_word(ref, 0, refLen, readLen, weight_gapO, weight_gapE, prof->profile_word, -1, maskLen);
+			bests = sw_word_any(prof->avx2, ref, 0, refLen, readLen, weight_gapO, weight_gapE, prof->profile_word, -1, maskLen);
 			word = 1;
 		} else if (bests[0].score == 255) {
 			fprintf(stderr, "Please set 2 to the score_size parameter of the function ssw_init, otherwise the alignment results will be incorrect.\n");
@@ -812,7 +1286,7 @@ s_align* ssw_align (const s_profile* prof,
 			return NULL;
 		}
 	}else if (prof->profile_word) {
-		bests = sw_sse2_word(ref, 0, refLen, readLen, weight_gapO, weight_gapE, prof->profile_word, -1, maskLen);
+		bests = sw_word_any(prof->avx2, ref, 0, refLen, readLen, weight_gapO, weight_gapE, prof->profile_word, -1, maskLen);
 		word = 1;
 	}else {
 		fprintf(stderr, "Please call the function ssw_init before ssw_align.\n");
@@ -835,11 +1309,11 @@ s_align* ssw_align (const s_profile* prof,
 	// Find the beginning position of the best alignment.
 	read_reverse = seq_reverse(prof->read, r->read_end1);
 	if (word == 0) {
-		vP = qP_byte(read_reverse, prof->mat, r->read_end1 + 1, prof->n, prof->bias);
-		bests_reverse = sw_sse2_byte(ref, 1, r->ref_end1 + 1, r->read_end1 + 1, weight_gapO, weight_gapE, vP, r->score1, prof->bias, maskLen);
+		vP = qP_byte_any(prof->avx2, read_reverse, prof->mat, r->read_end1 + 1, prof->n, prof->bias);
+		bests_reverse = sw_byte_any(prof->avx2, ref, 1, r->ref_end1 + 1, r->read_end1 + 1, weight_gapO, weight_gapE, vP, r->score1, prof->bias, maskLen);
 	} else {
-		vP = qP_word(read_reverse, prof->mat, r->read_end1 + 1, prof->n);
-		bests_reverse = sw_sse2_word(ref, 1, r->ref_end1 + 1, r->read_end1 + 1, weight_gapO, weight_gapE, vP, r->score1, maskLen);
+		vP = qP_word_any(prof->avx2, read_reverse, prof->mat, r->read_end1 + 1, prof->n);
+		bests_reverse = sw_word_any(prof->avx2, ref, 1, r->ref_end1 + 1, r->read_end1 + 1, weight_gapO, weight_gapE, vP, r->score1, maskLen);
 	}
 	free(vP);
 	free(read_reverse);
@@ -867,6 +1341,50 @@ end:
 	return r;
 }
 
+int32_t ssw_traceback (const s_profile* prof,
+					const int8_t* ref,
+					const uint8_t weight_gapO,
+					const uint8_t weight_gapE,
+					const int32_t maskLen,
+					s_align* r) {
+
+	alignment_end* bests_reverse = 0;
+	void* vP = 0;
+	int32_t word, refLen, readLen, band_width;
+	int8_t* read_reverse = 0;
+	cigar* path;
+
+	/* ssw_align falls back to the word profile exactly when the byte kernel saturates */
+	word = prof->profile_byte == 0 || (prof->profile_word && r->score1 + prof->bias >= 255);
+
+	// Find the beginning position of the best alignment.
+	read_reverse = seq_reverse(prof->read, r->read_end1);
+	if (word == 0) {
+		vP = qP_byte_any(prof->avx2, read_reverse, prof->mat, r->read_end1 + 1, prof->n, prof->bias);
+		bests_reverse = sw_byte_any(prof->avx2, ref, 1, r->ref_end1 + 1, r->read_end1 + 1, weight_gapO, weight_gapE, vP, r->score1, prof->bias, maskLen);
+	} else {
+		vP = qP_word_any(prof->avx2, read_reverse, prof->mat, r->read_end1 + 1, prof->n);
+		bests_reverse = sw_word_any(prof->avx2, ref, 1, r->ref_end1 + 1, r->read_end1 + 1, weight_gapO, weight_gapE, vP, r->score1, maskLen);
+	}
+	free(vP);
+	free(read_reverse);
+	r->ref_begin1 = bests_reverse[0].ref;
+	r->read_begin1 = r->read_end1 - bests_reverse[0].read;
+	free(bests_reverse);
+
+	// Generate cigar.
+	refLen = r->ref_end1 - r->ref_begin1 + 1;
+	readLen = r->read_end1 - r->read_begin1 + 1;
+	band_width = abs(refLen - readLen) + 1;
+	path = banded_sw(ref + r->ref_begin1, prof->read + r->read_begin1, refLen, readLen, r->score1, weight_gapO, weight_gapE, band_width, prof->mat, prof->n);
+	if (path == 0) return -1;
+
+	r->cigar = path->seq;
+	r->cigarLen = path->length;
+	free(path);
+	return 0;
+}
+
 void align_destroy (s_align* a) {
 	free(a->cigar);
 	free(a);
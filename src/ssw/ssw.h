@@ -71,6 +71,13 @@ typedef struct {
 */
 s_profile* ssw_init (const int8_t* read, const int32_t readLen, const int8_t* mat, const int32_t n, const int8_t score_size);
 
+/*!	@function	Choose the SIMD kernels used with the query profiles created from now on by ssw_init; by default, AVX2 kernels are
+				used if the cpu supports them, and SSE2 kernels otherwise. Both give exactly the same results.
+	@param	level	0: use the SSE2 kernels; any other value: use the AVX2 kernels if the cpu supports them
+	@return	1 if the AVX2 kernels will be used, 0 otherwise
+*/
+int32_t ssw_set_avx2 (int32_t level);
+
 /*!	@function	Release the memory allocated by function ssw_init.
 	@param	p	pointer to the query profile structure
 */
@@ -119,6 +126,23 @@ s_align* ssw_align (const s_profile* prof,
 					const int32_t filterd,
 					const int32_t maskLen);
 
+/*!	@function	Complete a score-only alignment: find the best alignment beginning positions and the cigar.
+	@param	prof	pointer to the query profile structure that was used for the score-only alignment
+	@param	ref	pointer to the target sequence that was used for the score-only alignment
+	@param	weight_gapO	the absolute value of gap open penalty
+	@param	weight_gapE	the absolute value of gap extension penalty
+	@param	maskLen	see ssw_align
+	@param	r	alignment result returned by ssw_align with flag == 0; updated in place
+	@return	0 on success, -1 if the cigar could not be generated
+	@note	The result is the same as calling ssw_align with bit 8 of flag set, without repeating the forward pass.
+*/
+int32_t ssw_traceback (const s_profile* prof,
+					const int8_t* ref,
+					const uint8_t weight_gapO,
+					const uint8_t weight_gapE,
+					const int32_t maskLen,
+					s_align* r);
+
 /*!	@function	Release the memory allocated by function ssw_align.
 	@param	a	pointer to the alignment result structure
 */
@@ -0,0 +1,167 @@
+/*
+ *  ssw_batch.c
+ *
+ *  Batch wrappers around ssw_init/ssw_align so that python callers can align many
+ *  queries with one foreign call instead of one call (plus allocations) per query.
+ *
+ */
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include "ssw.h"
+#include "ssw_batch.h"
+
+static int32_t mask_length (int32_t readLen) {
+	return readLen > 30 ? readLen / 2 : 15;
+}
+
+static void mark_failed (s_align* r) {
+	memset(r, 0, sizeof(s_align));
+	r->ref_begin1 = -1;
+	r->ref_end1 = -1;
+	r->read_begin1 = -1;
+	r->ref_end2 = -1;
+	r->cigarLen = -1;
+}
+
+int32_t ssw_align_batch (const int8_t* const* refs,
+					const int32_t* refLens,
+					int32_t nRefs,
+					const int8_t* reads,
+					const int32_t* readLens,
+					int32_t nReads,
+					const int8_t* mat,
+					int32_t n,
+					uint8_t weight_gapO,
+					uint8_t weight_gapE,
+					uint8_t flag,
+					s_align* results) {
+
+	int32_t i, j, failed = 0;
+	const int8_t* read = reads;
+	s_profile* profile;
+	s_align* r;
+	s_align* result;
+
+	for (i = 0; i < nReads; ++i) {
+		/* the striped profile only depends on the query and the scoring matrix */
+		profile = readLens[i] > 0 ? ssw_init(read, readLens[i], mat, n, 2) : 0;
+
+		for (j = 0; j < nRefs; ++j) {
+			result = &results[i * nRefs + j];
+			r = (profile && refLens[j] > 0) ?
+				ssw_align(profile, refs[j], refLens[j], weight_gapO, weight_gapE, flag, 0, 0, mask_length(readLens[i])) : 0;
+
+			if (r) {
+				/* hand over ownership of the cigar array to the results array */
+				*result = *r;
+				free(r);
+			} else {
+				mark_failed(result);
+				++failed;
+			}
+		}
+
+		if (profile) init_destroy(profile);
+		read += readLens[i];
+	}
+
+	return failed;
+}
+
+int32_t ssw_align_batch_best (const int8_t* const* refs,
+					const int32_t* refLens,
+					const int32_t* refGroups,
+					int32_t nRefs,
+					const int8_t* reads,
+					const int32_t* readLens,
+					int32_t nReads,
+					int32_t nStrands,
+					const int8_t* mat,
+					int32_t n,
+					uint8_t weight_gapO,
+					uint8_t weight_gapE,
+					s_align* results) {
+
+	int32_t i, j, k, s, g, nGroups = 0, failed = 0;
+	int32_t bestStrand, bestRef;
+	const int8_t* read = reads;
+	s_profile** profiles = (s_profile**)calloc(nStrands, sizeof(s_profile*));
+	s_align* r;
+	s_align* result;
+
+	for (j = 0; j < nRefs; ++j) {
+		if (refGroups[j] + 1 > nGroups) nGroups = refGroups[j] + 1;
+	}
+
+	for (i = 0; i < nReads; ++i) {
+		/* first pass: scores and end positions only, for every strand and reference */
+		for (s = 0; s < nStrands; ++s) {
+			k = i * nStrands + s;
+			profiles[s] = readLens[k] > 0 ? ssw_init(read, readLens[k], mat, n, 2) : 0;
+
+			for (j = 0; j < nRefs; ++j) {
+				result = &results[k * nRefs + j];
+				r = (profiles[s] && refLens[j] > 0) ?
+					ssw_align(profiles[s], refs[j], refLens[j], weight_gapO, weight_gapE, 0, 0, 0, mask_length(readLens[k])) : 0;
+
+				if (r) {
+					*result = *r;
+					free(r);
+				} else {
+					mark_failed(result);
+					++failed;
+				}
+			}
+			read += readLens[k];
+		}
+
+		/* second pass: traceback only the best reference (and its best strand) in each group; on ties, the
+		   first reference and the first strand win */
+		for (g = 0; g < nGroups; ++g) {
+			bestStrand = -1;
+			bestRef = -1;
+			for (j = 0; j < nRefs; ++j) {
+				if (refGroups[j] != g) continue;
+				k = -1;
+				for (s = 0; s < nStrands; ++s) {
+					result = &results[(i * nStrands + s) * nRefs + j];
+					if (result->cigarLen < 0) continue;
+					if (k < 0 || result->score1 > results[(i * nStrands + k) * nRefs + j].score1) k = s;
+				}
+				if (k < 0) continue;
+				if (bestRef < 0 || results[(i * nStrands + k) * nRefs + j].score1 >
+								   results[(i * nStrands + bestStrand) * nRefs + bestRef].score1) {
+					bestStrand = k;
+					bestRef = j;
+				}
+			}
+
+			if (bestRef >= 0) {
+				k = i * nStrands + bestStrand;
+				result = &results[k * nRefs + bestRef];
+				if (ssw_traceback(profiles[bestStrand], refs[bestRef], weight_gapO, weight_gapE, mask_length(readLens[k]), result) != 0) {
+					mark_failed(result);
+					++failed;
+				}
+			}
+		}
+
+		for (s = 0; s < nStrands; ++s) {
+			if (profiles[s]) init_destroy(profiles[s]);
+		}
+	}
+
+	free(profiles);
+	return failed;
+}
+
+void ssw_batch_destroy (s_align* results, int32_t nResults) {
+	int32_t i;
+	for (i = 0; i < nResults; ++i) {
+		free(results[i].cigar);
+		results[i].cigar = 0;
+		results[i].cigarLen = 0;
+	}
+}
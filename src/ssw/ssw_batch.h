@@ -0,0 +1,102 @@
+/*
+ *  ssw_batch.h
+ *
+ *  Batch entry points for aligning many queries with a single foreign call; used by
+ *  ssw_wrap.Aligner.align_many() to avoid one ctypes round trip (and one query profile)
+ *  per query and reference.
+ *
+ */
+
+#ifndef SSW_BATCH_H
+#define SSW_BATCH_H
+
+#include <stdint.h>
+#include "ssw.h"
+
+#ifdef __cplusplus
+extern "C" {
+#endif	// __cplusplus
+
+/*!	@function	Align many queries against one or more reference sequences; the query profile of each query is
+				built once and reused for every reference.
+	@param	refs	array of pointers to the target sequences; the target sequences need to be numbers and
+					corresponding to the mat parameter of function ssw_init
+	@param	refLens	length of each target sequence
+	@param	nRefs	number of target sequences
+	@param	reads	pointer to the query sequences, encoded as numbers and packed one after another
+	@param	readLens	length of each query sequence; query i starts right after query i-1 in reads
+	@param	nReads	number of query sequences
+	@param	mat	pointer to the substitution matrix (see ssw_init)
+	@param	n	the square root of the number of elements in mat
+	@param	weight_gapO	the absolute value of gap open penalty
+	@param	weight_gapE	the absolute value of gap extension penalty
+	@param	flag	bitwise FLAG passed on to ssw_align for every alignment
+	@param	results	caller-allocated array of nReads * nRefs s_align structures, filled in place; the alignment of query i
+					against target j is stored in results[i * nRefs + j]; an alignment that could not be computed is
+					marked with cigarLen = -1
+	@return	number of alignments that could not be computed
+	@note	the mask length for the sub-optimal alignment is read length / 2 for reads longer than 30 and 15 otherwise;
+			the cigar arrays in results must be released with ssw_batch_destroy
+*/
+int32_t ssw_align_batch (const int8_t* const* refs,
+					const int32_t* refLens,
+					int32_t nRefs,
+					const int8_t* reads,
+					const int32_t* readLens,
+					int32_t nReads,
+					const int8_t* mat,
+					int32_t n,
+					uint8_t weight_gapO,
+					uint8_t weight_gapE,
+					uint8_t flag,
+					s_align* results);
+
+/*!	@function	Align many queries against several groups of reference sequences in two passes: first a
+				score-only pass over every query strand and reference, then a traceback (beginning positions and
+				cigar) only for the best-scoring reference and strand of each group.
+	@param	refs	array of pointers to the target sequences (see ssw_align_batch)
+	@param	refLens	length of each target sequence
+	@param	refGroups	group number (0, 1, ...) of each target sequence, eg one group per allele
+	@param	nRefs	number of target sequences
+	@param	reads	pointer to the query sequences, packed one after another as for ssw_align_batch; the nStrands queries of each read (eg
+					the read and its reverse complement) are stored one after another
+	@param	readLens	length of each query sequence
+	@param	nReads	number of reads; there are nReads * nStrands queries
+	@param	nStrands	number of queries per read
+	@param	mat	pointer to the substitution matrix (see ssw_init)
+	@param	n	the square root of the number of elements in mat
+	@param	weight_gapO	the absolute value of gap open penalty
+	@param	weight_gapE	the absolute value of gap extension penalty
+	@param	results	caller-allocated array of nReads * nStrands * nRefs s_align structures, laid out as for
+					ssw_align_batch; entries that lost in their group only hold the scores and the end positions
+					(ref_begin1 = read_begin1 = -1 and no cigar)
+	@return	number of alignments that could not be computed
+	@note	the best reference of a group is the first one with the highest score, where the score of a reference is
+			that of its first best-scoring strand
+*/
+int32_t ssw_align_batch_best (const int8_t* const* refs,
+					const int32_t* refLens,
+					const int32_t* refGroups,
+					int32_t nRefs,
+					const int8_t* reads,
+					const int32_t* readLens,
+					int32_t nReads,
+					int32_t nStrands,
+					const int8_t* mat,
+					int32_t n,
+					uint8_t weight_gapO,
+					uint8_t weight_gapE,
+					s_align* results);
+
+/*!	@function	Release the cigar arrays allocated by ssw_align_batch or ssw_align_batch_best.
+	@param	results	the results array filled by ssw_align_batch or ssw_align_batch_best; the array itself belongs to
+					the caller
+	@param	nResults	number of entries in results
+*/
+void ssw_batch_destroy (s_align* results, int32_t nResults);
+
+#ifdef __cplusplus
+}
+#endif	// __cplusplus
+
+#endif	// SSW_BATCH_H
@@ -21,6 +21,13 @@ def _get_libssw_path():
         raise Exception("Couldn't find libssw.so in this directory: '{}'".format(base))
     return os.path.join(base, matches[0])
 libssw = cdll.LoadLibrary(_get_libssw_path())#os.path.join(os.path.dirname(__file__), 'libssw.so'))
+
+def _translation_table(mapping, default):
+    """
+    Build a 256 entries table for bytes.translate(), mapping each byte to mapping.get(byte, default)
+    """
+    return bytes(bytearray(mapping.get(i, default) for i in range(256)))
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 class CAlignRes(Structure):
     """
@@ -55,6 +62,12 @@ class Aligner(object):
     base_to_int = { 'A':0, 'C':1, 'G':2, 'T':3, 'N':4, 'a':0, 'c':1, 'g':2, 't':3, 'n':4}
     int_to_base = { 0:'A', 1:'C', 2:'G', 3:'T', 4:'N'}
 
+    # Translation tables (for bytes.translate) from ascii bases to the integers above, and from
+    # these integers to the integers of the complementary bases; anything that is not a canonic
+    # DNA base is assigned 4 as for N
+    _encode_table = _translation_table(dict((ord(base), value) for base, value in base_to_int.items()), 4)
+    _complement_table = _translation_table({0:3, 1:2, 2:1, 3:0}, 4)
+
     # Load the ssw library using ctypes
     # libssw = cdll.LoadLibrary('libssw.so')
     #libssw = cdll.LoadLibrary(_get_libssw_path())#os.path.join(os.path.dirname(__file__), 'libssw.so'))
@@ -76,6 +89,18 @@ class Aligner(object):
     align_destroy = libssw.align_destroy
     align_destroy.restype = None
     align_destroy.argtypes = [POINTER(CAlignRes)]
+    # ssw_align_batch function
+    ssw_align_batch = libssw.ssw_align_batch
+    ssw_align_batch.restype = c_int32
+    ssw_align_batch.argtypes = [POINTER(POINTER(c_int8)), POINTER(c_int32), c_int32, POINTER(c_int8), POINTER(c_int32), c_int32, POINTER(c_int8), c_int32, c_uint8, c_uint8, c_uint8, POINTER(CAlignRes)]
+    # ssw_align_batch_best function
+    ssw_align_batch_best = libssw.ssw_align_batch_best
+    ssw_align_batch_best.restype = c_int32
+    ssw_align_batch_best.argtypes = [POINTER(POINTER(c_int8)), POINTER(c_int32), POINTER(c_int32), c_int32, POINTER(c_int8), POINTER(c_int32), c_int32, c_int32, POINTER(c_int8), c_int32, c_uint8, c_uint8, POINTER(CAlignRes)]
+    # ssw_batch_destroy function
+    ssw_batch_destroy = libssw.ssw_batch_destroy
+    ssw_batch_destroy.restype = None
+    ssw_batch_destroy.argtypes = [POINTER(CAlignRes), c_int32]
 
     #~~~~~~~FONDAMENTAL METHODS~~~~~~~#
 
@@ -219,7 +244,7 @@ class Aligner(object):
         match_len  = c_result.contents.query_end - c_result.contents.query_begin + 1
 
         if score >= min_score and match_len >= min_len:
-            py_result = PyAlignRes(c_result, query_len, self.report_secondary, self.report_cigar)
+            py_result = PyAlignRes(c_result.contents, query_len, self.report_secondary, self.report_cigar)
         else:
             py_result = None
 
@@ -230,27 +255,135 @@ class Aligner(object):
         # Return the object
         return py_result
 
+    def align_many(self, queries, both_strands=True, min_score=0, min_len=0):
+        """
+        Perform the alignment of many queries against the object reference sequence with a
+        single call to the ssw library (see ssw_batch.c)
+        @param queries List of query sequences as python strings (case insensitive)
+        @param both_strands Also align the reverse complement of each query if true
+        @param min_score Minimal score of match. None will be return in case of filtering out
+        @param min_len Minimal length of match. None will be return in case of filtering out
+        @return A list with one SSWAlignRes Object (or None) per query; if both_strands is true,
+        each item is a (forward, reverse complement) tuple of SSWAlignRes Objects
+        """
+        if self.ref_len == 0:
+            return [(None, None) if both_strands else None for query_seq in queries]
+
+        results = self._align_batch(queries, [self.ref_seq], None, both_strands, min_score, min_len)
+        return [query_results[0] for query_results in results]
+
     #~~~~~~~PRIVATE METHODS~~~~~~~#
 
-    def _DNA_to_int_mat (self, seq, len_seq):
+    def _align_batch(self, queries, ref_seqs, ref_groups, both_strands, min_score, min_len):
         """
-        Cast a python DNA string into a Ctype int8 matrix
+        Align every query (and its reverse complement if both_strands) against every reference
+        sequence; ref_seqs holds one c type integer matrix per reference. If ref_groups is set,
+        only the best alignment of each group is complete (see MultiAligner.align_many)
+        @return A list per query of results per reference (see align_many)
+        """
+        strands = 2 if both_strands else 1
+        n_refs = len(ref_seqs)
+        n_queries = len(queries) * strands
+        n_results = n_queries * n_refs
+
+        if n_results == 0:
+            return [[] for query_seq in queries]
+
+        # Pack all the queries (and their reverse complements) into a single buffer, which is
+        # then handed over to the ssw library without copying
+        query_lens = []
+        packed = []
+        for query_seq in queries:
+            query_num = self._encode_bytes(query_seq)
+            query_lens.append(len(query_num))
+            packed.append(query_num)
+            if both_strands:
+                query_lens.append(len(query_num))
+                packed.append(query_num[::-1].translate(self._complement_table))
+
+        packed = bytearray(b"".join(packed))
+        packed = (c_int8 * len(packed)).from_buffer(packed)
+        c_query_lens = (c_int32 * n_queries)(*query_lens)
+        c_ref_seqs = (POINTER(c_int8) * n_refs)(*[cast(ref_seq, POINTER(c_int8)) for ref_seq in ref_seqs])
+        c_ref_lens = (c_int32 * n_refs)(*[len(ref_seq) for ref_seq in ref_seqs])
+        c_results = (CAlignRes * n_results)()
+
+        if ref_groups is None:
+            self.ssw_align_batch(c_ref_seqs, # Pointers to the ref seqs in c type integers
+                                 c_ref_lens, # Length of each Refseq
+                                 n_refs, # Number of ref seqs
+                                 packed, # Packed query seqs in c type integers
+                                 c_query_lens, # Length of each query
+                                 n_queries, # Number of queries
+                                 self.mat, # Score matrix
+                                 5, # Square root of the number of elements in mat
+                                 self.gap_open, # Absolute value of gap open penalty
+                                 self.gap_extend, # absolute value of gap extend penalty
+                                 1, # Bitwise FLAG for output values = return all
+                                 c_results) # Filled in place, query-major
+        else:
+            self.ssw_align_batch_best(c_ref_seqs, # Pointers to the ref seqs in c type integers
+                                      c_ref_lens, # Length of each Refseq
+                                      (c_int32 * n_refs)(*ref_groups), # Group of each Refseq
+                                      n_refs, # Number of ref seqs
+                                      packed, # Packed query seqs in c type integers
+                                      c_query_lens, # Length of each query
+                                      len(queries), # Number of reads
+                                      strands, # Number of queries per read
+                                      self.mat, # Score matrix
+                                      5, # Square root of the number of elements in mat
+                                      self.gap_open, # Absolute value of gap open penalty
+                                      self.gap_extend, # absolute value of gap extend penalty
+                                      c_results) # Filled in place, query-major
+
+        py_results = []
+        for i in range(n_results):
+            c_result = c_results[i]
+            # score-only results don't have a beginning position to filter on
+            match_len = c_result.query_end - c_result.query_begin + 1 if c_result.query_begin >= 0 else min_len
+
+            if c_result.cigarLen >= 0 and c_result.score >= min_score and match_len >= min_len:
+                py_results.append(PyAlignRes(c_result, query_lens[i//n_refs], self.report_secondary, self.report_cigar))
+            else:
+                py_results.append(None)
+
+        # Free the cigars allocated by ssw_align_batch
+        self.ssw_batch_destroy(c_results, n_results)
+
+        results = []
+        for i in range(len(queries)):
+            first = i * strands * n_refs
+            forward = py_results[first:first+n_refs]
+            if both_strands:
+                reverse = py_results[first+n_refs:first+2*n_refs]
+                results.append(list(zip(forward, reverse)))
+            else:
+                results.append(forward)
+        return results
+
+    def encode(self, seq):
         """
-        # Declare the matrix
-        query_num_decl = c_int8 * len_seq
-        query_num = query_num_decl()
+        Cast a python DNA string into the integers expected by the ssw library, stored one per
+        byte in a bytearray; the result can be wrapped without copying into the c type integer
+        matrices given to set_encoded_refs()
+        """
+        return bytearray(self._encode_bytes(seq))
 
-        # for each letters in ATCGN transform in integers thanks to self.base_to_int
-        for i in range(len_seq):
-            try:
-                value = self.base_to_int[seq[i]]
-            # if the base is not in the canonic DNA bases assign 4 as for N
-            except KeyError:
-                value = 4
-            finally:
-                query_num[i] = value
+    def _encode_bytes(self, seq):
+        """
+        Cast a python DNA string into a bytes object holding one integer per base, using a
+        translation table rather than a lookup per base
+        """
+        if not isinstance(seq, bytes):
+            # non-ascii characters are replaced by '?', which is encoded as 4 as for N
+            seq = seq.encode("ascii", "replace")
+        return seq.translate(self._encode_table)
 
-        return query_num
+    def _DNA_to_int_mat (self, seq, len_seq):
+        """
+        Cast a python DNA string into a Ctype int8 matrix
+        """
+        return (c_int8 * len_seq).from_buffer(self.encode(seq))
 
     def _init_destroy(self, profile):
         """
@@ -266,6 +399,76 @@ class Aligner(object):
 
 
 
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class MultiAligner(Aligner):
+    """
+    @class  MultiAligner
+    @brief Query-centric wrapper for SSW align library: several reference sequences are stored,
+    and the query profile of each query is built once and aligned against all of them
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def __init__(self,
+                ref_seqs=(),
+                match=2,
+                mismatch=2,
+                gap_open=3,
+                gap_extend=1,
+                report_secondary=False,
+                report_cigar=False):
+        """
+        Initialize object by creating an interface with ssw library fonctions
+        @param ref_seqs List of reference sequences as python strings (case insensitive)
+        @param match Weight for a match
+        @param mismatch Absolute value of mismatch penalty
+        @param gap_open Absolute value of gap open penalty
+        @param gap_extend Absolute value of gap extend penalty
+        @param report_secondary Report the 2nd best alignement if true
+        @param report_cigar Report cigar string if true
+        """
+        Aligner.__init__(self, "", match, mismatch, gap_open, gap_extend, report_secondary, report_cigar)
+        self.set_refs(ref_seqs)
+
+    def set_refs(self, ref_seqs):
+        """
+        Cast each reference sequence into a c type integer matrix
+        """
+        self.set_encoded_refs([self._DNA_to_int_mat(ref_seq, len(ref_seq)) for ref_seq in ref_seqs])
+
+    def set_encoded_refs(self, ref_seqs):
+        """
+        Use reference sequences that have already been cast into c type integer matrices (eg
+        views on shared memory wrapped with c_int8.from_buffer() around the output of encode());
+        the matrices are referenced, not copied
+        """
+        self.ref_lens = [len(ref_seq) for ref_seq in ref_seqs]
+        self.ref_seqs = list(ref_seqs)
+
+    def align_many(self, queries, both_strands=True, min_score=0, min_len=0, ref_groups=None, which_refs=None):
+        """
+        Perform the alignment of many queries against every reference sequence with a single
+        call to the ssw library
+        @param queries List of query sequences as python strings (case insensitive)
+        @param both_strands Also align the reverse complement of each query if true
+        @param min_score Minimal score of match. None will be return in case of filtering out
+        @param min_len Minimal length of match. None will be return in case of filtering out
+        (not checked for score-only results)
+        @param ref_groups Optional list with a group number (0, 1, ...) for each reference sequence;
+        if set, every alignment is first computed score-only, then the beginning positions and
+        cigar are only computed for the best reference and strand of each group. The other
+        results only report the scores and end positions (ref_begin is -1 and cigar_string None)
+        @param which_refs Optional list of indices of the reference sequences to align against
+        (default: all of them); ref_groups then gives the group of each of these
+        @return A list per query, holding one SSWAlignRes Object (or None) per reference sequence
+        in the order given to set_refs() (or to which_refs); if both_strands is true, each item is
+        a (forward, reverse complement) tuple of SSWAlignRes Objects
+        """
+        ref_seqs = self.ref_seqs
+        if which_refs is not None:
+            ref_seqs = [self.ref_seqs[i] for i in which_refs]
+        return self._align_batch(queries, ref_seqs, ref_groups, both_strands, min_score, min_len)
+
+
 # Load the ssw library using ctypes
 #glibssw = cdll.LoadLibrary(os.path.join(os.path.dirname(__file__), 'libssw.so'))
 # libssw = cdll.LoadLibrary('libssw.so')
@@ -279,6 +482,23 @@ cigar_int_to_len.argtypes = [c_int32]
 cigar_int_to_op = libssw.cigar_int_to_op
 cigar_int_to_op.restype = c_char
 cigar_int_to_op.argtypes = [c_int32]
+# ssw_set_avx2 function
+_ssw_set_avx2 = libssw.ssw_set_avx2
+_ssw_set_avx2.restype = c_int32
+_ssw_set_avx2.argtypes = [c_int32]
+
+def set_simd(use_avx2=True):
+    """
+    Choose between the SSE2 and AVX2 alignment kernels of the ssw library for the alignments
+    started from now on in this process; AVX2 is used by default when the cpu supports it, and
+    both give exactly the same alignments
+    @param  use_avx2    False to force the SSE2 kernels
+    @return True if the AVX2 kernels will be used
+    """
+    return bool(_ssw_set_avx2(1 if use_avx2 else 0))
+
+# CIGAR operations in the order of their 4 bit codes
+_CIGAR_OPS = dict(enumerate("MIDNSHP=X"))
 
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
@@ -320,27 +540,27 @@ class PyAlignRes(object):
         @param report_secondary Report the 2nd best alignement if true
         @param report_cigar Report cigar string if true
         """
-        # Parse value in the C type structure pointer
+        # Parse value in the C type structure
         # Minimal mandatory parameters
-        self.score = Res.contents.score
-        self.ref_begin = Res.contents.ref_begin
-        self.ref_end = Res.contents.ref_end
-        self.query_begin = Res.contents.query_begin
-        self.query_end = Res.contents.query_end
+        self.score = Res.score
+        self.ref_begin = Res.ref_begin
+        self.ref_end = Res.ref_end
+        self.query_begin = Res.query_begin
+        self.query_end = Res.query_end
 
         # Information for sub-optimal match if require and available
-        score2 = Res.contents.score2
+        score2 = Res.score2
         if report_secondary and score2 != 0:
             self.score2 = score2
-            self.ref_end2 = Res.contents.ref_end2
+            self.ref_end2 = Res.ref_end2
         else:
             self.score2 = None
             self.ref_end2 = None
 
         # Cigar Information if CIGAR string if require and available
-        cigar_len = Res.contents.cigarLen
+        cigar_len = Res.cigarLen
         if report_cigar and cigar_len > 0:
-            self.cigar_string = self._cigar_string (Res.contents.cigar, cigar_len, query_len)
+            self.cigar_string = self._cigar_string (Res.cigar, cigar_len, query_len)
         else:
             self.cigar_string = None
 
@@ -359,10 +579,11 @@ class PyAlignRes(object):
             op_char = "S"
             cigar_string.append('{}{}'.format(op_len, op_char))
 
-        # Iterate over the cigar (pointer to a vector of int)
+        # Iterate over the cigar (pointer to a vector of int); this decodes the ints the same
+        # way as cigar_int_to_len and cigar_int_to_op, without a foreign call per operation
         for i in range(cigar_len):
-            op_len = cigar_int_to_len(cigar[i])
-            op_char = cigar_int_to_op(cigar[i]).decode("utf-8")
+            op_len = cigar[i] >> 4
+            op_char = _CIGAR_OPS.get(cigar[i] & 0xf, "M")
             cigar_string.append('{}{}'.format(op_len, op_char))
 
         # If the length of bases aligned is shorter than the overall query length
@@ -0,0 +1,151 @@
+""" On-disk cache of read realignments (see --alignment-cache).
+
+The cache is an sqlite database mapping a content hash (of the chromosome part sequences, the
+alignment settings and the read sequence) to the pickled realignment of the read. It is safe to
+share between concurrent svviz processes on one machine: sqlite takes care of the locking, and
+every process (and thread) uses its own connection. When the cache grows beyond its size cap,
+the least recently used entries are evicted.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+# bump this whenever the pickled alignments or the way they're computed changes
+CACHE_VERSION = 2
+
+# how long to wait for another process to release the database
+_TIMEOUT = 60
+
+# sqlite limits the number of parameters per statement
+_MAX_PARAMETERS = 500
+
+# each connection keeps a running estimate of the size of the cache, and only adds up the sizes of
+# the entries (which reads through the whole table) when the estimate goes over the cap, or after
+# this many puts, to catch up with what other processes have added
+_RESYNC_PUTS = 50
+
+
+def hashKey(*parts):
+    """ returns a hex digest identifying the given strings """
+    sha = hashlib.sha1(str(CACHE_VERSION).encode("ascii"))
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = part.encode("utf-8")
+        sha.update(hashlib.sha1(part).digest())
+    return sha.hexdigest()
+
+
+class AlignmentCache(object):
+    def __init__(self, path, maxSize):
+        """ path is the sqlite database file, and maxSize the cap on the total size of the cached
+        alignments, in bytes """
+        self.path = path
+        self.maxSize = maxSize
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # the cache is handed to the worker processes, which open their own connections
+        return {"path": self.path, "maxSize": self.maxSize}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["maxSize"])
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, nor survive a fork
+        if getattr(self._local, "pid", None) != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # another process may have created it in the meantime
+                    pass
+
+            connection = sqlite3.connect(self.path, timeout=_TIMEOUT)
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS alignments "
+                    "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, atime REAL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS alignments_atime ON alignments (atime)")
+
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+            self._resync(connection)
+
+        return self._local.connection
+
+    def get(self, keys):
+        """ returns a dict of key -> value for those of keys that are in the cache, marking them as
+        recently used """
+        connection = self._connection()
+        found = {}
+
+        for i in range(0, len(keys), _MAX_PARAMETERS):
+            batch = keys[i:i+_MAX_PARAMETERS]
+            placeholders = ",".join("?" * len(batch))
+
+            rows = connection.execute("SELECT key, value FROM alignments WHERE key IN ({})".format(placeholders),
+                batch).fetchall()
+            for key, value in rows:
+                try:
+                    found[key] = pickle.loads(bytes(value))
+                except Exception:
+                    logging.debug("Skipping unreadable alignment cache entry {}".format(key))
+
+            if len(rows) > 0:
+                with connection:
+                    connection.execute("UPDATE alignments SET atime=? WHERE key IN ({})".format(placeholders),
+                        [time.time()] + batch)
+
+        return found
+
+    def put(self, items):
+        """ stores the key -> value pairs of the dict items, then evicts the least recently used
+        entries if the cache is over its size cap """
+        if len(items) == 0:
+            return
+
+        connection = self._connection()
+        now = time.time()
+
+        rows = []
+        for key, value in items.items():
+            value = pickle.dumps(value, protocol=2)
+            rows.append((key, sqlite3.Binary(value), len(value), now))
+
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO alignments (key, value, size, atime) VALUES (?,?,?,?)", rows)
+
+        # replaced entries are counted twice, which only makes the estimate err on the high side
+        self._local.size += sum(row[2] for row in rows)
+        self._local.puts += 1
+
+        if self._local.size > self.maxSize or self._local.puts >= _RESYNC_PUTS:
+            self._evict(connection)
+
+    def _resync(self, connection):
+        total, count = connection.execute("SELECT TOTAL(size), COUNT(*) FROM alignments").fetchone()
+        self._local.size = total
+        self._local.puts = 0
+        return total, count
+
+    def _evict(self, connection):
+        with connection:
+            total, count = self._resync(connection)
+            if total <= self.maxSize or count == 0:
+                return
+
+            # drop the oldest entries, taking the cache down to about 90% of its cap
+            averageSize = total / float(count)
+            toRemove = int((total - self.maxSize * 0.9) / averageSize) + 1
+            removed, = connection.execute("SELECT TOTAL(size) FROM "
+                "(SELECT size FROM alignments ORDER BY atime LIMIT ?)", (toRemove,)).fetchone()
+            connection.execute("DELETE FROM alignments WHERE key IN "
+                "(SELECT key FROM alignments ORDER BY atime LIMIT ?)", (toRemove,))
+            self._local.size = total - removed
@@ -1,77 +1,142 @@
 """
-this module wraps the ssw_wrap Smith-Waterman alignment code in a subprocess
+this module runs the ssw_wrap Smith-Waterman alignment code in long-lived worker processes
 because ssw can occasionally segfault when aligning long reads against a reasonably
-large reference sequence; when the subprocess segfaults, this is detected below
-and the result is skipped
-
-not yet implemented: try aligning the reverse complement when the original sequence
-causes a segfault, then reverse the strand
+large reference sequence; the workers get one read at a time over a pipe, and when a worker
+dies this is detected below, the worker is replaced and the read is retried once by aligning
+its reverse complement (the strand is then reversed); if that crashes too, the read is
+reported as failed
 """
 from __future__ import print_function
 
+import atexit
 import collections
 import multiprocessing
-import os
-import six
-import subprocess
+
+try:
+    from multiprocessing.connection import wait as _waitConnections
+except ImportError:
+    # python 2
+    import select
+    def _waitConnections(connections, timeout=None):
+        return select.select(connections, [], [], timeout)[0]
 
 from svviz import misc
-from ssw import ssw_wrap
 from svviz import remap
-
-
-Aln = collections.namedtuple("Aln", ["ref_begin", "ref_end", "cigar_string", "score", "score2"])
+from svviz.sharedrefs import shareReference
+from svviz.utilities import reverseComp
 
 
 
-def alignProcWrapper(ref, seq):
-    cmd = "python {} {} {}".format(
-        os.path.realpath(__file__),
-        ref,
-        seq)
-    
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = proc.communicate()
+def alignRead(mapper, seq, reverseOnly=False):
+    """ aligns seq against all the chromosome parts of the Multimap mapper; if reverseOnly, only
+    the reverse complement of seq is aligned (see module docstring) """
+    if not reverseOnly:
+        return mapper.remap(seq)[1]
 
-    if proc.returncode != 0:
-        return None
+    alignments = mapper.aligner.align_many([reverseComp(seq)], both_strands=False, ref_groups=mapper.refGroups)[0]
 
-    fields = out.split()
-    strand = fields[0].decode()
-    
-    aln = Aln(int(fields[1]), int(fields[2]), fields[3].decode(), int(fields[4]), int(fields[5]))
-
-    return strand, aln
-
-def remaps(args):
-    namesToReferences, seq = args
     seqresult = {}
-    for name, ref in namesToReferences.items():
-        seqresult[name] = alignProcWrapper(ref, seq)
-    return seq, seqresult
-
-def multimap(namesToReferences, seqs):
-    if not hasattr(multimap, "pool"):
-        multimap.pool = multiprocessing.Pool(processes=misc.cpu_count_physical())
-
-    pool = multimap.pool
-
+    for name, aln in zip(mapper.names, alignments):
+        seqresult[name] = ("-", aln) if aln is not None else None
+    return seqresult
+
+def _workerLoop(conn):
+    mapper = None
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+
+        if message[0] == "refs":
+            mapper = remap.Multimap(message[1], **message[2])
+        elif message[0] == "align":
+            conn.send(alignRead(mapper, message[1], message[2]))
+        else:
+            break
+
+
+class _Worker(object):
+    def __init__(self):
+        self.conn, childConn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_workerLoop, args=(childConn,))
+        self.process.daemon = True
+        self.process.start()
+        childConn.close()
+
+        self.refs = None
+        self.task = None
+
+    def setRefs(self, refs, multimapArgs):
+        if self.refs is not refs:
+            self.conn.send(("refs", refs, multimapArgs))
+            self.refs = refs
+
+    def submit(self, task):
+        seq, reverseOnly = task
+        self.conn.send(("align", seq, reverseOnly))
+        self.task = task
+
+    def close(self):
+        try:
+            self.conn.send(("quit",))
+        except (IOError, OSError):
+            pass
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+# the workers are kept alive across calls to multimap(); see closeWorkers()
+_workers = []
+
+def closeWorkers():
+    while len(_workers) > 0:
+        _workers.pop().close()
+
+atexit.register(closeWorkers)
+
+def multimap(namesToReferences, seqs, namesToAlleles=None, seedChain=False, tryExact=False,
+             maxSecondScoreRatio=None, cache=None, namesToStrands=None):
+    """ realigns each of seqs against every reference, returning a dict of
+    seq -> {name: (strand, aln)}; reads that can't be aligned are given None for every name; see
+    remap.Multimap for the other arguments (the workers look up and store their realignments in
+    the cache themselves; the retries of crashed reads aren't cached) """
+    names = list(namesToReferences.keys())
+    refs = collections.OrderedDict((name, shareReference(namesToReferences[name])) for name in names)
+    multimapArgs = dict(namesToAlleles=namesToAlleles, seedChain=seedChain, tryExact=tryExact,
+        maxSecondScoreRatio=maxSecondScoreRatio, cache=cache, namesToStrands=namesToStrands)
+
+    while len(_workers) < misc.cpu_count_physical():
+        _workers.append(_Worker())
+
+    pending = collections.deque((seq, False) for seq in collections.OrderedDict.fromkeys(seqs))
     results = {}
-    results = dict(pool.map_async(remaps, [(namesToReferences, seq) for seq in seqs]).get(999999))
-    # results = dict(map(remaps, [(namesToReferences, seq) for seq in seqs]))
-
-    return results
-
-def align(ref, seq):
-    aligner = ssw_wrap.Aligner(ref, report_cigar=True, report_secondary=True)
-    strand, aln = remap.alignBothStrands(seq, aligner)
-    
-    print(strand, aln.ref_begin, aln.ref_end, aln.cigar_string, aln.score, aln.score2)
-    
 
-if __name__ == '__main__':
-    import sys
-    ref = sys.argv[1]
-    seq = sys.argv[2]
+    while len(pending) > 0 or any(worker.task is not None for worker in _workers):
+        for worker in _workers:
+            if worker.task is None and len(pending) > 0:
+                worker.setRefs(refs, multimapArgs)
+                worker.submit(pending.popleft())
+
+        busy = dict((worker.conn, worker) for worker in _workers if worker.task is not None)
+        for conn in _waitConnections(list(busy.keys())):
+            worker = busy[conn]
+            seq, reverseOnly = worker.task
+
+            try:
+                results[seq] = conn.recv()
+                worker.task = None
+            except (EOFError, IOError, OSError):
+                # the worker crashed (most likely a segfault in ssw) while aligning this read
+                worker.process.join()
+                _workers[_workers.index(worker)] = _Worker()
+
+                if not reverseOnly:
+                    pending.append((seq, True))
+                else:
+                    results[seq] = dict((name, None) for name in names)
 
-    align(ref, seq)
+    return results
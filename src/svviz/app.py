@@ -11,8 +11,11 @@ from svviz import dotplots
 from svviz import export
 from svviz import flanking
 from svviz import insertsizes
+from svviz import mateindex
+from svviz import multiprocessor
 from svviz import pairfinder
 from svviz import remap
+from svviz import sharedrefs
 from svviz import summarystats
 from svviz import track
 from svviz import utilities
@@ -84,8 +87,12 @@ def loadReads(dataHub):
     sampleReads = dataHub.args.sample_reads
     for sample in dataHub:
         logging.info(" - {}".format(sample.name))
+        if dataHub.args.mate_index is not None and sample.mateIndex is None and not sample.singleEnded:
+            sample.mateIndex = mateindex.load(sample.bamPath, dataHub.args.mate_index or None)
+
         sample.reads = remap.getReads(dataHub.variant, sample.bam, dataHub.args.min_mapq, dataHub.args.pair_min_mapq,
-            sample.searchDistance, sample.singleEnded, dataHub.args.include_supplementary, maxReads, sampleReads)
+            sample.searchDistance, sample.singleEnded, dataHub.args.include_supplementary, maxReads, sampleReads,
+            dataHub.args.sample_seed, sample.mateIndex)
 
         readCount += len(sample.reads)
         readLength += sum(len(read.seq) for read in sample.reads)
@@ -114,8 +121,10 @@ def setSampleParams(dataHub):
             sample.orientations = "any"
 
 def runRemap(dataHub):
+    # the reads of all the samples are realigned together
+    samplesToAlnCollections = remap.do_realign(dataHub)
     for sample in dataHub:
-        sample.alnCollections = remap.do_realign(dataHub, sample)
+        sample.alnCollections = samplesToAlnCollections[sample.name]
 
 def runDisambiguation(dataHub):
     flankingRegionCollection = flanking.FlankingRegionCollection(dataHub.variant)
@@ -352,6 +361,11 @@ def run(args):
 
         summaryStats.addVariantResults(dataHub)
 
+    # the realignment worker pool and shared reference sequences are kept across variants; we're
+    # done with them now
+    multiprocessor.closePool()
+    sharedrefs.closeSharedReferences()
+
     summaryStats.display()
     if dataHub.args.summary is not None:
         summaryStats.saveToPath(dataHub.args.summary)
@@ -171,9 +171,38 @@ def parseArgs(args):
         "will substantially increase speed on Illumina data but may result in some inexact\n"
         "results; default: false")
 
+    inputParams.add_argument("--mate-window", metavar="SD", type=float, help=
+        "realign only one read of each pair against the full alleles, and align its mate just \n"
+        "within the mean insert size plus SD standard deviations around it (falling back to the \n"
+        "full alleles if the mate doesn't align well there); keeps the mate next to its pair \n"
+        "rather than at a repeat elsewhere, but alignments of the mate elsewhere are not \n"
+        "considered; only saves time when the alleles are much longer than the window \n"
+        "(default: off)")
+
+    inputParams.add_argument("--predict-strand", action="store_true", help=
+        "align reads first only on the strand expected from their original alignment, aligning\n"
+        "the other strand only if it could matter for the best alignment or for whether the \n"
+        "read is multimapping (default: align both strands)")
+
+    inputParams.add_argument("--seed-chain", action="store_true", help=
+        "align long reads (eg PacBio) only against the stretches of each allele found by chaining\n"
+        "their minimizer matches, rather than against the whole allele (default: false)")
+
+    inputParams.add_argument("--flanking-shortcut", action="store_true", help=
+        "realign the read pairs lying well inside a segment shared by both alleles only against\n"
+        "the ref allele, and copy their alignments over to the alt allele (where they get no \n"
+        "second-best score); pairs that are multimapping against the ref allele are still \n"
+        "realigned against both alleles (default: false)")
+
     inputParams.add_argument("--sample-reads", type=int, help=
         "use at most this many reads (pairs), sampling randomly if need be, useful \n"
         "when running in batch mode (default: use all reads)")
+    inputParams.add_argument("--sample-seed", type=int, default=0, help=
+        "the seed for --sample-reads; the same seed picks the same reads every time (default: 0)")
+    inputParams.add_argument("--mate-index", metavar="DIR", nargs="?", const="", help=
+        "find mates through an index of the discordant read pairs of each bam, built the first \n"
+        "time it's needed and kept next to the bam (or in DIR); speeds up batch mode \n"
+        "(default: no index)")
 
     inputParams.add_argument("--max-reads", type=int, help=
         "maximum number of reads allowed, totaled across all samples, useful when running in batch \n"
@@ -195,7 +224,20 @@ def parseArgs(args):
     interfaceParams.add_argument("-p", "--port", type=portNumber, help=
         "define a port to use for the web browser (default: random port)")
     interfaceParams.add_argument("--processes", type=int, help=
-        "how many processes to use for read realignment (default: use all available cores)")
+        "the maximum number of processes (or threads) to use for read realignment (default: \n"
+        "depending on the amount of work, from a single process up to all available cores)")
+    interfaceParams.add_argument("--alignment-backend", choices=["auto", "processes", "threads"],
+        default="auto", help=
+        "whether read realignment should run in worker processes or in threads (which avoids \n"
+        "forking and copying data between processes); by default, the one expected to be \n"
+        "fastest is chosen for each job, or a single process for small jobs")
+    interfaceParams.add_argument("--alignment-cache", metavar="CACHE_PATH", help=
+        "cache read realignments in this file, so that re-running the same variants and samples \n"
+        "(eg with different display or disambiguation options) doesn't realign the reads again; \n"
+        "the cache can be shared by several svviz runs at once (default: no cache)")
+    interfaceParams.add_argument("--alignment-cache-size", metavar="MB", type=float, default=1000, help=
+        "maximum size of the alignment cache in megabytes; the least recently used alignments \n"
+        "are dropped beyond this (default: 1000)")
     interfaceParams.add_argument("--no-web", action="store_true", help=
         "don't show the web interface")
     interfaceParams.add_argument("--save-reads", metavar="OUT_BAM_PATH", help=
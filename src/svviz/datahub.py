@@ -127,6 +127,7 @@ class Sample(object):
 
         self.bamPath = bamPath
         self.bam = pysam.Samfile(self.bamPath, "rb") if self.bamPath else None
+        self.mateIndex = None
 
         self.readStatistics = None
         self.insertSizePlot = None
@@ -139,6 +140,7 @@ class Sample(object):
         state = self.__dict__.copy()
         del state["bam"]
         del state["reads"]
+        state["mateIndex"] = None
         return state
 
     def reset(self):
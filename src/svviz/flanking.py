@@ -1,3 +1,6 @@
+from svviz.alignment import Alignment
+
+
 class FlankingRegionCollection(object):
     """
     Used to store information about genomic regions that are 'flanking', meaning they are not really 
@@ -17,9 +20,82 @@ class FlankingRegionCollection(object):
         for allele in ["ref", "alt"]:
             self.alleleFlanks[allele] = AlleleFlankingRegion(variant, allele, commonSegmentIDs)
 
+        # segment ID -> allele -> (part ID, start, end) of the common segment within the part
+        self.segmentPlacements = _placeSegments(variant, commonSegmentIDs)
+
+        # a read from a flanking region can align better to sequence that's only in the alt allele
+        # (eg an inserted repeat, or a second copy of a segment), so ref alignments can only be
+        # projected onto the alt allele when it's made up of sequence already in the ref allele
+        self.projectable = _altAddsNoSequence(variant)
+
     def isFlanking(self, alignmentSet, allele):
         return self.alleleFlanks[allele].isFlanking(alignmentSet)
 
+    def confiningSegment(self, chrom, start, end, margin=0):
+        """ returns the ID of the common segment containing the genomic interval chrom:start-end
+        with at least margin nt to spare on either side, or None """
+        for segmentID, (segment, placements) in self.segmentPlacements.items():
+            if _sameChrom(segment.chrom, chrom) and segment.start + margin <= start and end <= segment.end - margin:
+                return segmentID
+        return None
+
+    def projectAlignment(self, aln, segmentID, fromAllele, toAllele, margin=0):
+        """ moves aln, an alignment against fromAllele, to the coordinates of the same common segment
+        in toAllele; returns None if aln doesn't lie within the segment with margin nt to spare """
+        segment, placements = self.segmentPlacements[segmentID]
+        fromPart, fromStart, fromEnd = placements[fromAllele]
+
+        if aln.regionID != fromPart or aln.start < fromStart + margin or aln.end > fromEnd - margin:
+            return None
+
+        toPart, toStart, toEnd = placements[toAllele]
+        offset = toStart - fromStart
+        return Alignment(aln.name, toPart, aln.start+offset, aln.end+offset, aln.strand, aln.seq, aln.cigar,
+            aln.score, aln.genome_seq, aln.score2, aln.mapq)
+
+
+def _sameChrom(chrom1, chrom2):
+    # the bam and the genome may disagree on the "chr" prefix
+    return chrom1.replace("chr", "", 1) == chrom2.replace("chr", "", 1)
+
+def _altAddsNoSequence(variant):
+    """ returns True if each segment of the alt allele is a genomic segment of the ref allele (on
+    either strand), used only once; eg deletions, inversions and translocations, but not insertions
+    or duplications """
+    def segmentKeys(allele):
+        return [(segment.chrom, segment.start, segment.end, segment.source)
+                for part in variant.chromParts(allele) for segment in part.segments]
+
+    refKeys = set(segmentKeys("ref"))
+    altKeys = segmentKeys("alt")
+
+    return len(set(altKeys)) == len(altKeys) and \
+        all(key[3] == "genome" and key in refKeys for key in altKeys)
+
+def _placeSegments(variant, commonSegmentIDs):
+    """ finds the position of each common segment within the chromosome parts of both alleles,
+    leaving out segments whose position can't be trusted (eg clipped at the end of a chromosome) """
+    placements = {}
+    for allele in ["ref", "alt"]:
+        for part in variant.chromParts(allele):
+            curpos = 0
+            partPlacements = {}
+            for segment in part.segments:
+                # segment coordinates are inclusive
+                end = curpos + segment.end - segment.start
+                if segment.id in commonSegmentIDs and segment.source == "genome":
+                    partPlacements[segment.id] = (segment, (part.id, curpos, end))
+                curpos = end + 1
+
+            if curpos != len(part.getSeq()):
+                continue
+
+            for segmentID, (segment, placement) in partPlacements.items():
+                placements.setdefault(segmentID, (segment, {}))[1][allele] = placement
+
+    return dict((segmentID, placement) for segmentID, placement in placements.items()
+                if len(placement[1]) == 2)
+
 
 
 class AlleleFlankingRegion(object):
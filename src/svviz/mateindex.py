@@ -0,0 +1,128 @@
+""" Sidecar index of the location of mates in a bam file (see --mate-index).
+
+Finding the mates of the reads near a breakpoint means random access to the bam at each mate's
+position, paid again for every variant in batch mode. The mate index is built by reading the bam
+once; it holds the records of discordant pairs (paired reads not flagged as properly paired, with
+both reads mapped), whose mates are the ones found far from the breakpoint regions, as a sorted
+array of (read name hash, chromosome, position, virtual file offset). PairFinder looks the mates up
+in it, then jumps straight to their records.
+
+The index is kept next to the bam (or in a cache directory) and is rebuilt whenever the size or
+modification time of the bam changes.
+"""
+
+import hashlib
+import logging
+import os
+import struct
+import time
+
+import numpy
+import pysam
+
+
+# bump this whenever the layout of the index changes
+INDEX_VERSION = 1
+
+INDEX_SUFFIX = ".svviz-mates.npz"
+
+_DTYPE = numpy.dtype([("hash", "<u8"), ("tid", "<i4"), ("pos", "<i4"), ("offset", "<u8")])
+
+
+def nameHash(qname):
+    return struct.unpack("<Q", hashlib.md5(qname.encode("utf-8")).digest()[:8])[0]
+
+def isDiscordant(read):
+    # paired, not properly paired, and both reads mapped
+    return (read.flag & 0xF) == 0x1
+
+
+class MateIndex(object):
+    def __init__(self, entries):
+        """ entries is a numpy array of _DTYPE, sorted by hash """
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, qname, tid, pos):
+        """ returns the virtual file offsets of the records of read qname at the given position """
+        key = nameHash(qname)
+        first = numpy.searchsorted(self.entries["hash"], key, side="left")
+        last = numpy.searchsorted(self.entries["hash"], key, side="right")
+
+        matches = self.entries[first:last]
+        return [int(entry["offset"]) for entry in matches if entry["tid"] == tid and entry["pos"] == pos]
+
+    @classmethod
+    def build(cls, bamPath):
+        """ reads through the bam to build the index; the bam is opened afresh, since reading
+        through an already open file would start wherever the last fetch() left off """
+        t0 = time.time()
+
+        hashes, tids, positions, offsets = [], [], [], []
+        with pysam.AlignmentFile(bamPath) as bam:
+            reads = bam.fetch(until_eof=True)
+            while True:
+                offset = bam.tell()
+                try:
+                    read = next(reads)
+                except StopIteration:
+                    break
+
+                if isDiscordant(read):
+                    hashes.append(nameHash(read.qname))
+                    tids.append(read.tid)
+                    positions.append(read.pos)
+                    offsets.append(offset)
+
+        entries = numpy.empty(len(hashes), dtype=_DTYPE)
+        entries["hash"] = hashes
+        entries["tid"] = tids
+        entries["pos"] = positions
+        entries["offset"] = offsets
+        entries.sort(order="hash", kind="mergesort")
+
+        logging.info("  Built mate index of {:,} discordant reads in {:.1f}s".format(len(entries), time.time()-t0))
+        return cls(entries)
+
+
+def indexPath(bamPath, directory=None):
+    """ the index goes next to the bam, or in directory if given (named after the bam's full path) """
+    if directory is None:
+        return bamPath + INDEX_SUFFIX
+    key = hashlib.sha1(os.path.abspath(bamPath).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(directory, os.path.basename(bamPath) + "." + key + INDEX_SUFFIX)
+
+def _bamSignature(bamPath):
+    stat = os.stat(bamPath)
+    return numpy.array([INDEX_VERSION, stat.st_size, int(stat.st_mtime * 1e6)], dtype="<i8")
+
+def load(bamPath, directory=None):
+    """ returns the MateIndex of the bam, reading it from disk if it's up to date, or else building
+    it and saving it for next time """
+    path = indexPath(bamPath, directory)
+    signature = _bamSignature(bamPath)
+
+    if os.path.exists(path):
+        try:
+            with numpy.load(path) as saved:
+                if numpy.array_equal(saved["signature"], signature):
+                    return MateIndex(saved["entries"])
+            logging.info("  Mate index {} is out of date; rebuilding".format(path))
+        except Exception as e:
+            logging.warn("  Couldn't read mate index {} ({}); rebuilding".format(path, e))
+
+    index = MateIndex.build(bamPath)
+
+    try:
+        if directory is not None and not os.path.exists(directory):
+            os.makedirs(directory)
+        # written under a temporary name first, so that other processes never see a partial file
+        tmpPath = "{}.{}.tmp.npz".format(path, os.getpid())
+        numpy.savez(tmpPath, entries=index.entries, signature=signature)
+        os.rename(tmpPath, path)
+    except (IOError, OSError) as e:
+        logging.warn("  Couldn't save mate index to {} ({}); it will be rebuilt next time".format(path, e))
+
+    return index
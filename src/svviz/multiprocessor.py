@@ -1,4 +1,7 @@
+import atexit
+import hashlib
 import multiprocessing
+import pickle
 import sys
 import time
 import traceback
@@ -13,25 +16,93 @@ except ImportError:
 
 
 
-def chunkIt(seq, num):
-    avg = len(seq) / float(num)
+# aim for this many chunks per process, so that processes that finish early can pick up
+# remaining work instead of waiting on the slowest chunk
+CHUNKS_PER_PROCESS = 8
+
+# how often (in seconds) the progress bar is refreshed while waiting on results
+PROGRESS_INTERVAL = 0.2
+
+# with batched=True, the method is called on this many args at a time, so that the progress of
+# each chunk can be reported as it goes
+PROGRESS_BATCH_SIZE = 50
+
+def chunkByCost(seq, costs, num):
+    """ splits seq into about num chunks of roughly equal total cost (costs gives the cost
+    of each item); the most expensive items go into the first chunks so that the tail of
+    the schedule is made of small chunks """
+    if len(seq) == 0:
+        return []
+
+    if costs is None:
+        costs = [1] * len(seq)
+    order = sorted(range(len(seq)), key=lambda i: -costs[i])
+
+    target = sum(costs) / float(max(num, 1))
     out = []
-    last = 0.0
-    
-    while last < len(seq):
-        out.append(seq[int(last):int(last + avg)])
-        last += avg
-        
+    cur = []
+    curCost = 0
+    for i in order:
+        cur.append(seq[i])
+        curCost += costs[i]
+        if curCost >= target:
+            out.append(cur)
+            cur = []
+            curCost = 0
+    if len(cur) > 0:
+        out.append(cur)
+
     return out
 
 # reuse process pools for multiple Multiprocessor.map() calls
 # to prevent having too many interprocess communication files open
 _queue = multiprocessing.Queue()
+
+# the worker pool is kept alive across Multiprocessor.map() calls (eg across samples and
+# variants in batch mode); see getPool() and closePool()
+_pool = None
+_poolProcesses = None
+
+def getPool(processes):
+    """ returns the long-lived worker pool, starting it if needed; the pool only ever grows, so that
+    a job wanting fewer processes runs on the larger pool rather than restarting it (the number of
+    chunks then bounds how many of its workers are busy) """
+    global _pool, _poolProcesses
+
+    if _pool is not None and _poolProcesses < processes:
+        closePool()
+
+    if _pool is None:
+        _pool = multiprocessing.Pool(processes=processes, initializer=_map_init, initargs=[_queue])
+        _poolProcesses = processes
+
+    return _pool
+
+def poolSize():
+    """ returns the number of processes of the worker pool, or None if it isn't running """
+    return _poolProcesses
+
+def closePool(terminate=False):
+    """ shuts down the long-lived worker pool; the next Multiprocessor.map() call will start 
+    a new one """
+    global _pool, _poolProcesses
+
+    if _pool is not None:
+        if terminate:
+            _pool.terminate()
+        else:
+            _pool.close()
+        _pool.join()
+
+    _pool = None
+    _poolProcesses = None
+
+atexit.register(closePool, terminate=True)
   
         
 class Multiprocessor(object):
     @classmethod
-    def map(cls, method, args, initArgs=None, processes=2, verbose=1, name=""):
+    def map(cls, method, args, initArgs=None, processes=2, verbose=1, name="", costs=None, batched=False, chunks=None):
         """
         This is the meat of things, basically a replacement for multiprocessing.pool. Subclass this class to enable
         an object-oriented approach to multiprocessing, where an object is instantiated for each pool, allowing
@@ -42,6 +113,12 @@ class Multiprocessor(object):
         - improved handling of ctrl-k termination of the multiple processes (so you usually don't have to individually
         kill -9 each sub-process)
         - some nice progress information (optionally) about the various processes as they are ongoing
+
+        The args are split into many small chunks of similar total cost (see chunkByCost(); costs optionally gives
+        the expected cost of each arg), which are handed out to the processes as they become free; chunks sets the
+        number of chunks (default: CHUNKS_PER_PROCESS per process). If batched is
+        True, method is called with lists of (up to PROGRESS_BATCH_SIZE) args from each chunk, and must return a list
+        of results.
         
         verbose == 1 - include information about starting and finishing each process
         verbose == 2 - print periodic updates about the status of each process
@@ -49,52 +126,57 @@ class Multiprocessor(object):
         """
     
         queue = _queue
-        pool = multiprocessing.Pool(processes=processes, initializer=_map_init, initargs=[_queue])      
-        # queue = multiprocessing.Queue()
-        # if verbose <= 2:
-        #     pool = multiprocessing.Pool(processes=processes)
-        # else:
-        #     pool = 
+        pool = getPool(processes)
+
+        # the subclass instance is built at most once per worker for each distinct set of initArgs,
+        # so the initArgs are sent pickled along with a key identifying them
+        initArgsPickle = pickle.dumps(initArgs, protocol=pickle.HIGHEST_PROTOCOL)
+        initKey = hashlib.sha1(initArgsPickle).hexdigest()
 
         methodname = method.__name__
-        asyncResults = []
-        
-        for i, chunk in enumerate(chunkIt(args, processes)):
-            result = pool.apply_async(_map, [cls, methodname, initArgs, chunk, i, verbose])
-            result.chunkCount = i
-            asyncResults.append(result)
-        pool.close()
 
-        numChunks = len(asyncResults)
-        
-        
+        if chunks is None:
+            chunks = processes*CHUNKS_PER_PROCESS
+        chunks = chunkByCost(args, costs, chunks)
+        tasks = [(cls, methodname, initKey, initArgsPickle, chunk, i, verbose, batched) for i, chunk in enumerate(chunks)]
+        numChunks = len(tasks)
+
         mappedValues = []
 
         if verbose > 2:
             progressBar = _multiProgressBar(name=name)
+            for i, chunk in enumerate(chunks):
+                progressBar.update(i, 0, len(chunk))
             # t0 = time.time()
+
+        # results are collected as each chunk finishes, in whatever order that happens
+        results = pool.imap_unordered(_mapStar, tasks)
+        remaining = numChunks
             
-        while len(asyncResults) > 0:
-            for i, asyncResult in enumerate(asyncResults):
-                if asyncResult.ready():
-                    mappedValues.extend(asyncResult.get())
-                    asyncResults.remove(asyncResult)
+        try:
+            while remaining > 0:
+                try:
+                    chunkNum, chunkValues = results.next(timeout=PROGRESS_INTERVAL)
+                except multiprocessing.TimeoutError:
+                    pass
+                else:
+                    mappedValues.extend(chunkValues)
+                    remaining -= 1
                     if verbose > 2:
-                        progressBar.finishProcess(asyncResult.chunkCount)
+                        progressBar.finishProcess(chunkNum)
                     elif verbose >= 1:
-                        print("-- %i of %i done"%(numChunks-len(asyncResults), numChunks))
-            
-            time.sleep(0.5)
-
-            while not queue.empty():
-                status = queue.get_nowait()
-                progressBar.update(status[2], status[0], status[1])
+                        print("-- %i of %i done"%(numChunks-remaining, numChunks))
 
-            if verbose > 2:
-                progressBar.redraw()
-        
+                while not queue.empty():
+                    status = queue.get_nowait()
+                    if verbose > 2:
+                        progressBar.update(status[2], status[0], status[1])
 
-        pool.join()        
+                if verbose > 2:
+                    progressBar.redraw()
+        except KeyboardInterrupt:
+            closePool(terminate=True)
+            raise
 
         if verbose > 2:
             progressBar.finish()
@@ -107,32 +189,62 @@ class Multiprocessor(object):
 def _map_init(q):
     # allow setting a multiprocessing.Queue for the _map function
     _map.q = q
+    _map.instances = {}
+
+# how many Multiprocessor instances each worker keeps around for reuse
+_INSTANCE_CACHE_SIZE = 2
+
+def _getInstance(cls, initKey, initArgsPickle):
+    """ returns the worker's cached instance of cls for these initArgs, building it if 
+    needed; only the most recently used instances are kept """
+    if not hasattr(_map, "instances"):
+        _map.instances = {}
+
+    key = (cls.__module__, cls.__name__, initKey)
+    if key not in _map.instances:
+        initArgs = pickle.loads(initArgsPickle)
+        if initArgs != None:
+            instance_ = cls(*initArgs)
+        else:
+            instance_ = cls()
+
+        while len(_map.instances) >= _INSTANCE_CACHE_SIZE:
+            oldest = min(_map.instances, key=lambda k: _map.instances[k][0])
+            del _map.instances[oldest]
+        _map.instances[key] = [None, instance_]
+
+    _map.instances[key][0] = time.time()
+    return _map.instances[key][1]
     
-def _map(cls, methodName, initArgs, args, chunkNum, verbose):
+def _mapStar(task):
+    chunkNum = task[5]
+    return chunkNum, _map(*task)
+
+def _map(cls, methodName, initKey, initArgsPickle, args, chunkNum, verbose, batched=False):
     """ this takes care of most of the goodies, such as instantiating the Multiprocessor
     subclass, and performing the actual 'map' activity (as well as taking care of passing
     progress information back to the main process) """
     
     t0 = time.time()
-    if initArgs != None:
-        instance_ = cls(*initArgs)
-    else:
-        instance_ = cls()
+    instance_ = _getInstance(cls, initKey, initArgsPickle)
     boundMethod = getattr(instance_, methodName)
     results = []
 
     try:
+        if batched:
+            for i in range(0, len(args), PROGRESS_BATCH_SIZE):
+                if verbose > 1:
+                    _reportProgress(i, len(args), chunkNum)
+                results.extend(boundMethod(args[i:i+PROGRESS_BATCH_SIZE]))
+            return results
+
         tlast = time.time()
         
         for i, arg in enumerate(args):
             tnow = time.time()
             
             if verbose > 1 and (i%100==0 or i%(len(args)/20+1)==0 or (tnow-tlast)>1):
-                if hasattr(_map, "q"):
-                    _map.q.put((i, len(args), chunkNum))
-                else:
-                    print(i, "of", len(args), chunkNum)
-
+                _reportProgress(i, len(args), chunkNum)
                 tlast = tnow
             results.append(boundMethod(arg))
         
@@ -144,6 +256,12 @@ def _map(cls, methodName, initArgs, args, chunkNum, verbose):
         traceback.print_exc(file=sys.stdout)
         raise
 
+def _reportProgress(completed, total, chunkNum):
+    if hasattr(_map, "q"):
+        _map.q.put((completed, total, chunkNum))
+    else:
+        print(completed, "of", total, chunkNum)
+
 def formatTime(t):
     if t > 3600:
         t = "%.1fh"%(t / 3600.0)
@@ -243,7 +361,7 @@ class _multiProgressBar(object):
                 for barid in sorted(self.barsToProgress):
                     text.append(self._getBar(barid, self.barsToProgress[barid][0], self.barsToProgress[barid][1], barWidth))
             else:
-                text.append("[processes=%d]"%len(self.barsToProgress))
+                text.append("[chunks=%d]"%len(self.barsToProgress))
                 
             endmarker = "\n"
             if self.isatty:
@@ -1,22 +1,72 @@
 import collections
+import hashlib
+import heapq
 import logging
-import random
+import struct
 import time
 
+from svviz import mateindex
+
 class TooManyReadsException(Exception): pass
 
+# regions with more records than this are reported as they are being read
+LOTS_OF_READS = int(1e5)
+
+# mate positions less than this far apart are fetched from the bam together, since reading through
+# the records in between costs less than seeking (and decompressing a block) again
+MATE_FETCH_MERGE_DISTANCE = 5000
+
+# ...as long as the gap holds fewer than about this many records (a few bgzf blocks' worth); in
+# deeper data, the merge distance shrinks accordingly (see PairFinder.mateMergeDistance())
+MATE_FETCH_MERGE_RECORDS = 1000
+
+def coalesce(positions, distance=MATE_FETCH_MERGE_DISTANCE):
+    """ returns the (start, end) intervals covering the given positions, merging positions less than
+    distance apart """
+    intervals = []
+    for position in sorted(positions):
+        if len(intervals) > 0 and position - intervals[-1][1] < distance:
+            intervals[-1][1] = position + 1
+        else:
+            intervals.append([position, position + 1])
+    return [tuple(interval) for interval in intervals]
+
+def readKey(read):
+    """ returns a cheap identity for an alignment record, the same for the copies of a record fetched
+    more than once (eg from overlapping regions, or again as a mate) """
+    supplementaryIndex = 0
+    if read.flag & 0x800:
+        # the supplementary alignments of a read are told apart by the part of the read they align,
+        # ie by the length of their leading (soft or hard) clip
+        for op, length in read.cigartuples or []:
+            if op not in (4, 5):
+                break
+            supplementaryIndex += length
+    return (read.qname, read.flag, read.tid, read.pos, read.is_read1, supplementaryIndex)
+
+def sampleHash(qname, seed=0):
+    """ returns a number in [0, 1) from a hash of the read name, the same for both reads of a pair, in
+    every run and every process; which reads are sampled depends on it (see PairFinder.getToMatch()) """
+    digest = hashlib.md5("{}:{}".format(seed, qname).encode("utf-8")).digest()
+    return struct.unpack(">Q", digest[:8])[0] / float(2**64)
+
 class ReadSet(object):
+    """ the alignment records of a read (pair), without duplicates """
     def __init__(self):
         self.reads = []
-        self.strings = []
+        self.keys = set()
     def add(self, newread):
-        if str(newread) not in self.strings:
-            self.strings.append(str(newread))
-            self.reads.append(newread)
+        """ adds newread unless it's already in the set; returns True if it was added """
+        key = readKey(newread)
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        self.reads.append(newread)
+        return True
 
 class PairFinder(object):
     def __init__(self, regions, sam, minmapq=-1, pair_minmapq=-1, is_paired=True, include_supplementary=False,
-                 max_reads=None, sample_reads=None):
+                 max_reads=None, sample_reads=None, sample_seed=0, mate_index=None):
         self.include_supplementary = include_supplementary
         self.regions = regions
         self.sam = sam
@@ -27,113 +77,193 @@ class PairFinder(object):
         self.supplementaryAlignmentsFound = False
         self.maxReads = max_reads
         self.sampleReads = sample_reads
+        self.sampleSeed = sample_seed
+        self.mateIndex = mate_index
+
+        # reads from the search regions left out only because of pair_minmapq, by read name; these
+        # can still be mates (see findmatches())
+        self.belowPairMapq = collections.defaultdict(list)
+
+        # the number of mapped records on each chromosome, from the bam index (see estimateCount())
+        self.mappedByChrom = None
 
         self.tomatch, self.readsByID = self.getToMatch()
-        if self.tomatch is None:
-            self.tomatch, self.readsByID = self.getToMatchWithSampling()
-        
+
         if is_paired:
             logging.debug("  To-match: {:,}".format(len(self.tomatch)))
             self.domatching()
 
 
-        matchIDs = set(read.qname for read in self.tomatch)
+        matchIDs = collections.OrderedDict.fromkeys(read.qname for read in self.tomatch)
         self.matched = [self.readsByID[id_].reads for id_ in matchIDs]
 
         logging.info("  reads with missing pairs: {}".format(sum(1 for x in self.matched if (len(x)<2 and x[0].is_paired))))
 
     def getToMatch(self):
-        tomatch = set()
+        """ returns the reads from the search regions (as a list), and a dict of read name -> ReadSet;
+        with sample_reads, these are the reads of the sample_reads read names with the lowest
+        sampleHash(), which is found in a single pass by dropping the read names above the highest
+        hash kept so far whenever there are too many """
+        tomatch = []
         readsByID = collections.defaultdict(ReadSet)
 
-        for region in self.regions:
-            for read in self.loadRegion(region.chr(), region.start(), region.end()):
-                tomatch.add(read)
-                readsByID[read.qname].add(read)
-
-                if self.sampleReads is not None and len(readsByID) > self.sampleReads:
-                    return None, None
-                if self.maxReads and len(tomatch) > self.maxReads:
-                    raise TooManyReadsException
-
-        return tomatch, readsByID
+        # the reads in tomatch that haven't been dropped by the sampling, which are the ones that
+        # count towards max_reads
+        kept = 0
 
-    def getToMatchWithSampling(self):
-        readIDs = set()
+        # a max-heap (of -hash, read name) of the read names kept when sampling
+        sampled = []
+        sampling = False
 
-        logging.info("  exceeded number of reads required to begin sampling; performing sampling")
         for region in self.regions:
             for read in self.loadRegion(region.chr(), region.start(), region.end()):
-                readIDs.add(read.qname)
-
-        readIDs = random.sample(readIDs, self.sampleReads)
-
-        tomatch = set()
-        readsByID = collections.defaultdict(ReadSet)
+                if self.sampleReads is not None and read.qname not in readsByID:
+                    readHash = sampleHash(read.qname, self.sampleSeed)
+                    if len(sampled) >= self.sampleReads:
+                        if len(sampled) == 0 or readHash >= -sampled[0][0]:
+                            continue
+                        if not sampling:
+                            logging.info("  exceeded number of reads required to begin sampling; performing sampling")
+                            sampling = True
+                        dropped = heapq.heappushpop(sampled, (-readHash, read.qname))[1]
+                        kept -= len(readsByID.pop(dropped).reads)
+
+                        # every now and then, let go of the reads of the dropped read names
+                        if len(tomatch) > 8 * self.sampleReads:
+                            tomatch = [read_ for read_ in tomatch if read_.qname in readsByID]
+                    else:
+                        heapq.heappush(sampled, (-readHash, read.qname))
+
+                if readsByID[read.qname].add(read):
+                    tomatch.append(read)
+                    kept += 1
+
+                if self.maxReads and kept > self.maxReads:
+                    raise TooManyReadsException
 
-        for region in self.regions:
-            for read in self.loadRegion(region.chr(), region.start(), region.end()):
-                if read.qname in readIDs:
-                    tomatch.add(read)
-                    readsByID[read.qname].add(read)
+        if sampling:
+            tomatch = [read for read in tomatch if read.qname in readsByID]
 
         return tomatch, readsByID
 
     def domatching(self):
-        t0 = None
+        unmatched = [read for read in self.tomatch if len(self.readsByID[read.qname].reads) < 2]
+        self.findmatches(unmatched)
 
-        for i, read in enumerate(self.tomatch):#[:150]):
-            if i % 10000 == 0:
-                if t0 is None:
-                    t0 = time.time()
-                    elapsed = "Finding mate pairs..."
-                else:
-                    t1 = time.time()
-                    elapsed = "t={:.1f}s".format(t1-t0)
-                    t0 = t1
-                logging.info("   {:,} of {:,} {}".format(i, len(self.tomatch), elapsed))
-            if len(self.readsByID[read.qname].reads) < 2:
-                self.findmatch(read)
+    def findmatches(self, reads):
+        """ looks for the mates of reads: the mate positions are gathered, sorted and merged into
+        intervals (see coalesce()), each of which is fetched once; mates within the search regions
+        have already been loaded """
+        t0 = time.time()
 
-
-    def findmatch(self, read):
-        if read.is_paired and read.rnext >= 0:
+        searched = collections.defaultdict(list)
+        for region in self.regions:
+            searched[region.chr()].append((region.start(), region.end()))
+
+        wanted = set()
+        positions = collections.defaultdict(list)
+        indexed = 0
+        for read in reads:
+            if not read.is_paired or read.rnext < 0:
+                continue
             chrom = self.sam.getrname(read.rnext)
-            for read in self.loadRegion(chrom, read.pnext, read.pnext+1, mates=True):
-                if read.qname in self.readsByID:
-                    self.readsByID[read.qname].add(read)
 
+            if any(start <= read.pnext < end for start, end in searched[chrom]):
+                for mate in self.belowPairMapq.get(read.qname, []):
+                    self.readsByID[read.qname].add(mate)
+            elif self.findIndexedMates(read):
+                indexed += 1
+            else:
+                wanted.add(read.qname)
+                positions[chrom].append(read.pnext)
+
+        if self.mateIndex is not None:
+            logging.info("   Found the mates of {:,} reads through the mate index".format(indexed))
+
+        # in the order of the bam, to read it sequentially
+        intervals = [(chrom, start, end) for chrom in sorted(positions, key=self.sam.gettid)
+                     for start, end in coalesce(positions[chrom], self.mateMergeDistance(chrom))]
+        logging.info("   Finding mate pairs for {:,} reads in {:,} regions...".format(len(wanted), len(intervals)))
+
+        for chrom, start, end in intervals:
+            for mate in self.loadRegion(chrom, start, end, mates=True):
+                if mate.qname in wanted:
+                    self.readsByID[mate.qname].add(mate)
+
+        logging.debug("   Found mates in {:.1f}s".format(time.time()-t0))
+
+
+    def findIndexedMates(self, read):
+        """ reads the mate records of read from their offsets in the mate index (see mateindex.py);
+        returns False if the index doesn't have them """
+        if self.mateIndex is None or not mateindex.isDiscordant(read):
+            return False
+
+        offsets = self.mateIndex.lookup(read.qname, read.rnext, read.pnext)
+        for offset in offsets:
+            self.sam.seek(offset)
+            mate = next(self.sam)
+            if mate.qname == read.qname and self.passesFilters(mate, mates=True):
+                self.readsByID[read.qname].add(mate)
+
+        return len(offsets) > 0
+
+    def mateMergeDistance(self, chrom):
+        """ returns how far apart mate positions on chrom can be and still be fetched together: the
+        gap in between is read through, so it's kept to about MATE_FETCH_MERGE_RECORDS records """
+        estimate = self.estimateCount(chrom, 0, MATE_FETCH_MERGE_DISTANCE)
+        if estimate is None or estimate <= MATE_FETCH_MERGE_RECORDS:
+            return MATE_FETCH_MERGE_DISTANCE
+        return max(1, MATE_FETCH_MERGE_DISTANCE * MATE_FETCH_MERGE_RECORDS // estimate)
+
+    def estimateCount(self, chrom, start, end):
+        """ estimates the number of records in a region without reading it, from the number of mapped
+        records on the chromosome kept in the bam index; returns None if the index doesn't tell """
+        if self.mappedByChrom is None:
+            try:
+                self.mappedByChrom = dict((stats.contig, stats.mapped) for stats in self.sam.get_index_statistics())
+            except (AttributeError, ValueError):
+                self.mappedByChrom = {}
+
+        mapped = self.mappedByChrom.get(chrom)
+        length = self.sam.get_reference_length(chrom) if chrom in self.sam.references else None
+        if not mapped or not length:
+            return None
+        return int(mapped * min(end - start, length) / float(length))
 
     def loadRegion(self, chrom, start, end, mates=False):
-        count = self.sam.count(chrom, start, end)
-        reads = self.sam.fetch(chrom, start, end)
+        # the records are only read once: the region is reported as it turns out to be deep, and
+        # the caller can stop reading at any point (eg once there are more than --max-reads reads)
+        estimate = self.estimateCount(chrom, start, end)
+        if estimate is not None and estimate > 5e6:
+            logging.debug("   about {:,} reads in {}:{}-{}".format(estimate, chrom, start, end))
 
-        if count > 1e5:
-            if mates:
-                logging.warn("  LOTS OF READS IN MATE-PAIR REGION: {}:{}-{} count={:,}".format(chrom, start, end, count))
-            else:
-                logging.warn("  LOTS OF READS IN BREAKPOINT REGION: {}:{}-{} count={:,}".format(chrom, start, end, count))
+        reads = self.sam.fetch(chrom, start, end)
 
-        # goodReads = []
         for i, read in enumerate(reads):
-            if i%1000000 == 0 and count > 5e6:
-                logging.debug("   > {} of {}".format(i, count))
-
-            if read.mapq >= self.minmapq and not read.is_secondary and not read.is_duplicate:
-                if (read.flag & 0x800) != 0 and not self.include_supplementary:
-                    self.supplementaryAlignmentsFound = True
-                    continue
-
-                if not mates and read.mapq < self.pair_minmapq:
-                    continue
+            if i == LOTS_OF_READS:
+                if mates:
+                    logging.warn("  LOTS OF READS IN MATE-PAIR REGION: {}:{}-{} count>{:,}".format(chrom, start, end, i))
+                else:
+                    logging.warn("  LOTS OF READS IN BREAKPOINT REGION: {}:{}-{} count>{:,}".format(chrom, start, end, i))
+            if i%1000000 == 0 and i > 0 and estimate is not None and estimate > 5e6:
+                logging.debug("   > {:,} of about {:,}".format(i, estimate))
 
+            if self.passesFilters(read, mates):
                 yield read
 
-                # self.readsByID[read.qname].add(read)
-                # goodReads.append(read)
+    def passesFilters(self, read, mates=False):
+        """ whether read should be used (as a mate if mates); keeps track of the supplementary
+        alignments left out and of the reads left out because of pair_minmapq """
+        if read.mapq >= self.minmapq and not read.is_secondary and not read.is_duplicate:
+            if (read.flag & 0x800) != 0 and not self.include_supplementary:
+                self.supplementaryAlignmentsFound = True
+                return False
 
-                # if not mates and self.maxReads and len(goodReads) > self.maxReads:
-                #     return goodReads
+            if not mates and read.mapq < self.pair_minmapq:
+                self.belowPairMapq[read.qname].append(read)
+                return False
 
+            return True
 
-        # return goodReads
+        return False
@@ -0,0 +1,143 @@
+""" Chooses how to run a read realignment job: serially, with threads or with worker processes,
+and in chunks of how many reads.
+
+The choice is based on a simple model of the time each option takes: smith-waterman work (read
+length x reference length) plus a fixed cost per read, spread over the workers, plus the cost of
+starting the workers and of handing work over to them. The predicted and measured times are both
+logged, and the measured time is used to correct the predictions of later jobs in the same run
+(eg the other variants of a batch).
+"""
+
+import logging
+import math
+import multiprocessing
+
+from svviz import misc
+from svviz import multiprocessor
+
+
+SECONDS_PER_CELL = 1.4e-9
+SECONDS_PER_READ = 5e-5
+
+# the part of the work done while holding the GIL (in python rather than in the ssw library),
+# which threads can't do in parallel
+GIL_FRACTION = 0.15
+
+THREAD_START_SECONDS = 0.005
+
+# starting (or growing) the process pool, per process
+PROCESS_START_SECONDS = 0.05
+
+# sending a chunk to a worker process and getting its results back
+CHUNK_SECONDS = 0.005
+TRANSFER_SECONDS_PER_READ = 2e-5
+
+# chunks should take at least this long, so that the overhead of handing them out stays small;
+# there are otherwise up to multiprocessor.CHUNKS_PER_PROCESS chunks per worker
+MIN_CHUNK_SECONDS = 0.1
+
+# with the default number of processes, jobs expected to take longer than this on the physical
+# cores also use the virtual cores, which only add about this much of a core each
+VIRTUAL_CORES_MIN_SECONDS = 60
+VIRTUAL_CORE_EFFICIENCY = 0.25
+
+# the number of reads sent to the ssw library together when realigning serially or with threads
+BATCH_SIZE = 100
+
+
+class ExecutionPlan(object):
+    def __init__(self, mode, workers, chunks, batchSize, predicted, poolSize=None):
+        """ mode is "serial", "threads" or "processes"; the reads are split into the given number of
+        chunks for the workers, and sent to the ssw library batchSize at a time; poolSize is the
+        number of processes to start the pool with, which can be more than the workers this job
+        keeps busy (see multiprocessor.getPool()) """
+        self.mode = mode
+        self.workers = workers
+        self.chunks = chunks
+        self.batchSize = batchSize
+        self.predicted = predicted
+        self.poolSize = poolSize if poolSize is not None else workers
+
+    def __str__(self):
+        if self.mode == "serial":
+            return "serial"
+        return "{} {} in {} chunks".format(self.workers, self.mode, self.chunks)
+
+
+# measured / predicted time, per mode, for the jobs run so far
+_calibration = {}
+
+def _predict(mode, work, reads, workers, cores, chunks, poolProcesses=None):
+    # cores is the number of cores the workers amount to (see VIRTUAL_CORE_EFFICIENCY); the process
+    # pool is only started (or restarted) if it's smaller than poolProcesses
+    if mode == "serial":
+        predicted = work
+    elif mode == "threads":
+        predicted = work * (GIL_FRACTION + (1 - GIL_FRACTION) / cores) + THREAD_START_SECONDS * workers
+    else:
+        predicted = work / cores + chunks * CHUNK_SECONDS + reads * TRANSFER_SECONDS_PER_READ
+        if (multiprocessor.poolSize() or 0) < poolProcesses:
+            predicted += PROCESS_START_SECONDS * poolProcesses
+
+    return predicted * _calibration.get(mode, 1.0)
+
+def _chunkCount(work, reads, workers):
+    chunks = min(workers * multiprocessor.CHUNKS_PER_PROCESS, int(work / MIN_CHUNK_SECONDS))
+    return max(1, min(reads, max(workers, chunks)))
+
+def plan(seqs, totalRefLength, processes=None, backend="auto"):
+    """ returns the ExecutionPlan for aligning seqs against references of totalRefLength bases;
+    processes is the maximum number of workers (None for the default, which depends on the size of
+    the job), and backend is "processes" or "threads" to use only that kind of workers """
+    reads = len(seqs)
+    work = sum(len(seq) for seq in seqs) * totalRefLength * SECONDS_PER_CELL + reads * SECONDS_PER_READ
+
+    # more workers than cores only share the cores
+    cores = min(processes, multiprocessing.cpu_count()) if processes is not None else None
+    if processes is None:
+        processes = cores = misc.cpu_count_physical()
+        virtual = multiprocessing.cpu_count()
+        if virtual > processes and work / processes > VIRTUAL_CORES_MIN_SECONDS:
+            cores = processes + (virtual - processes) * VIRTUAL_CORE_EFFICIENCY
+            processes = virtual
+
+    candidates = [ExecutionPlan("serial", 1, 1, BATCH_SIZE, _predict("serial", work, reads, 1, 1, 1))]
+
+    workers = max(1, min(processes, reads))
+    if workers > 1:
+        cores = min(cores, workers)
+        chunks = _chunkCount(work, reads, workers)
+        if backend in ["auto", "threads"]:
+            batchSize = max(1, min(BATCH_SIZE, int(math.ceil(reads / float(chunks)))))
+            candidates.append(ExecutionPlan("threads", workers, chunks, batchSize,
+                _predict("threads", work, reads, workers, cores, chunks)))
+        if backend in ["auto", "processes"]:
+            # the pool is kept at the maximum number of processes rather than sized to each job, so
+            # that small jobs don't restart it (or a later big job after them); a job with fewer reads
+            # than processes is split into one chunk per read, which keeps only that many busy
+            poolProcesses = max(processes, multiprocessor.poolSize() or 0)
+            candidates.append(ExecutionPlan("processes", workers, chunks, BATCH_SIZE,
+                _predict("processes", work, reads, workers, cores, chunks, poolProcesses), poolProcesses))
+        if backend != "auto":
+            candidates = candidates[1:]
+
+    best = min(candidates, key=lambda candidate: candidate.predicted)
+
+    message = "  Realigning {} reads: {} (predicted {:.2f}s".format(reads, best, best.predicted)
+    others = ["{} {:.2f}s".format(candidate.mode, candidate.predicted) for candidate in candidates if candidate is not best]
+    if len(others) > 0:
+        message += "; " + ", ".join(others)
+    logging.info(message + ")")
+
+    return best
+
+def record(plan, elapsed):
+    """ logs the time taken by the job run according to plan, and uses it to correct the predictions
+    for that mode """
+    logging.debug("  Realignment took {:.2f}s ({} predicted {:.2f}s)".format(elapsed, plan.mode, plan.predicted))
+
+    if plan.predicted > 0 and elapsed > 0.05:
+        ratio = elapsed / plan.predicted
+        # only go halfway (geometrically) to the measured ratio, so that a single unusual job doesn't
+        # throw the model off
+        _calibration[plan.mode] = _calibration.get(plan.mode, 1.0) * math.sqrt(min(max(ratio, 0.1), 10))
@@ -1,16 +1,20 @@
 import collections
+import hashlib
 import logging
 import math
-import re
 import sys
 import time
 
+from svviz.aligncache import AlignmentCache, hashKey
 from svviz.multiprocessor import Multiprocessor
+from svviz.sharedrefs import SharedReference, shareReference
 
 from svviz.utilities import reverseComp, Locus
 from svviz.alignment import Alignment, AlignmentSet, AlignmentSetCollection
+from svviz.flanking import FlankingRegionCollection
+from svviz.seedchain import MinimizerIndex, chainAnchors, chainWindow, minimizers
 from svviz.pairfinder import PairFinder
-from svviz import misc
+from svviz import planner
 
 def log2(x):
     try:
@@ -31,18 +35,67 @@ def check_swalign():
 
 
 class RemapAlignment(object):
-    def __init__(self, re_result, query, match):
+    def __init__(self, start, query, match):
         self.score = match * len(query)
         self.score2 = None
-        self.ref_begin = re_result.start()
-        self.ref_end = re_result.end()-1 ### I think this is right
+        self.ref_begin = start
+        self.ref_end = start + len(query) - 1
         self.query_begin = 0
         self.query_end = len(query)-1
         self.cigar_string = str(len(query)) + "M"
 
-def tryAlignExact(query, revquery, target, aligner):
-    f_results = [m for m in re.finditer(query, target)]
-    r_results = [m for m in re.finditer(revquery, target)]
+
+# reads at least this long are aligned by seed-chain-extend with Multimap(seedChain=True), and
+# against the windows around at most this many of their best chains in each part
+SEED_CHAIN_MIN_LENGTH = 500
+SEED_CHAIN_MAX_WINDOWS = 2
+
+
+# length of the k-mers used to look up reads in an ExactMatchIndex
+EXACT_INDEX_K = 16
+
+class ExactMatchIndex(object):
+    """ k-mer index of a chromosome part sequence, used to find the exact (full-length) 
+    occurrences of reads; it's built once per part, after which a lookup takes about read length 
+    time (plus one comparison per occurrence of the k-mer used) instead of a scan of the part """
+    def __init__(self, target, k=EXACT_INDEX_K):
+        self.target = target
+        self.k = k
+
+        self.kmers = {}
+        for i in range(len(target)-k+1):
+            self.kmers.setdefault(target[i:i+k], []).append(i)
+
+    def find(self, query):
+        """ returns the (sorted) start positions of all the occurrences of query, including
+        overlapping ones """
+        k = self.k
+
+        if len(query) < k:
+            positions = []
+            i = self.target.find(query)
+            while i >= 0:
+                positions.append(i)
+                i = self.target.find(query, i+1)
+            return positions
+
+        # the rarest of a few of the query's k-mers gives the fewest candidates to check
+        offset, candidates = None, None
+        for curOffset in (0, (len(query)-k)//2, len(query)-k):
+            hits = self.kmers.get(query[curOffset:curOffset+k], [])
+            if candidates is None or len(hits) < len(candidates):
+                offset, candidates = curOffset, hits
+                if len(hits) == 0:
+                    break
+
+        return [pos-offset for pos in candidates
+                if pos >= offset and self.target.startswith(query, pos-offset)]
+
+def tryAlignExact(query, revquery, index, aligner):
+    """ looks for exact matches of the read (either strand) in a chromosome part using its
+    ExactMatchIndex; if the read occurs more than once, score2 is set to the score """
+    f_results = index.find(query)
+    r_results = index.find(revquery)
 
     if len(f_results) > 0:
         aln = RemapAlignment(f_results[0], query, aligner.match)
@@ -58,12 +111,41 @@ def tryAlignExact(query, revquery, target, aligner):
 
     return strand, aln
 
-def alignBothStrands(seq, aligner): #, target):
-    revseq = reverseComp(seq)
 
-    forward_al = aligner.align(seq)
-    reverse_al = aligner.align(revseq)
+# length of the k-mers a read needs to share with a chromosome part to be aligned against it, when
+# prefiltering (see Multimap)
+PREFILTER_K = 12
 
+class SkippedAlignment(object):
+    """ stands in for the alignment of a read against a chromosome part with which it shares no
+    k-mers; score is an upper bound of the real score (see seedlessScoreBound()) """
+    def __init__(self, score):
+        self.score = score
+        self.score2 = None
+        self.ref_begin = -1
+        self.ref_end = -1
+        self.query_begin = -1
+        self.query_end = -1
+        self.cigar_string = None
+
+def seedlessScoreBound(readLength, k, match, mismatch, gapOpen):
+    """ upper bound of the smith-waterman score of a read against a sequence with which it shares
+    no k-mer (on either strand): the matches come in runs of at most k-1, each separated from the 
+    next by at least a mismatch or a gap; this requires that neither sequence contains bases that 
+    score 0 (eg 'N') """
+    runs = -(-readLength // (k-1))
+    return match * readLength - min(mismatch, gapOpen) * (runs - 1)
+
+def kmers(seq, k):
+    return set(seq[i:i+k] for i in range(len(seq)-k+1))
+
+def isACGT(seq):
+    return set(seq).issubset("ACGT")
+
+
+def chooseStrand(forward_al, reverse_al):
+    """ picks the better of the forward and reverse-complement alignments of a read, keeping
+    the score of the other strand as the second-best score if it's higher """
     strand = None
 
     if not forward_al:
@@ -92,31 +174,362 @@ def alignBothStrands(seq, aligner): #, target):
 
 
 class Multimap(Multiprocessor):
-    def __init__(self, namesToReferences, tryExact=False):
+    def __init__(self, namesToReferences, tryExact=False, namesToAlleles=None, maxSecondScoreRatio=None,
+                 cache=None, namesToStrands=None, seedChain=False):
+        """ namesToReferences maps each chromosome part to its sequence, either as a string or as a
+        SharedReference (see svviz.sharedrefs)
+
+        if maxSecondScoreRatio and namesToAlleles are set, reads are not aligned against the parts
+        with which they share no k-mers, as long as the upper bound of the score against such a part
+        is both below the best score of the allele and at most maxSecondScoreRatio times that score;
+        this doesn't change which alignment is the best, nor whether the read counts as multimapping
+        (see disambiguate.scoreAlignmentSetCollection()), but the second-best score may be lower
+
+        namesToStrands optionally gives the strand ("+" or "-", or None if unknown) on which reads
+        are expected to align against each part; reads are then first aligned on that strand only,
+        and the other strand is skipped under the same conditions as a part (above)
+
+        if seedChain, reads of at least SEED_CHAIN_MIN_LENGTH nt are aligned only against the
+        stretches of each part found by chaining their minimizers (see svviz.seedchain); parts
+        without any chain are aligned against in full
+
+        cache is an optional aligncache.AlignmentCache; the realignments are looked up and stored
+        in it, keyed by all the part sequences (since the alignments against each part depend on
+        the other parts), the alignment settings and the read sequence """
         from ssw import ssw_wrap
 
         self.tryExact = tryExact
+        self.maxSecondScoreRatio = maxSecondScoreRatio if namesToAlleles is not None else None
+
+        self.names = list(namesToReferences.keys())
+        references = [namesToReferences[name] for name in self.names]
+
+        self.cache = cache
+        if cache is not None:
+            referenceKeys = [reference.key if isinstance(reference, SharedReference) 
+                             else hashlib.sha1(reference.encode("ascii")).hexdigest() for reference in references]
+
+        # one aligner for all the chromosome parts, so that the query profile of each read is
+        # only built once per strand no matter how many parts (and alleles) there are
+        self.aligner = ssw_wrap.MultiAligner(report_cigar=True, report_secondary=True)
+        if all(isinstance(reference, SharedReference) for reference in references):
+            # align directly against the already-encoded sequences in shared memory
+            self.aligner.set_encoded_refs([reference.encoded() for reference in references])
+            if tryExact or self.maxSecondScoreRatio is not None or seedChain:
+                references = [reference.seq() for reference in references]
+        else:
+            self.aligner.set_refs(references)
+
+        # exact matches are looked up in an index of each part rather than by scanning the parts
+        self.namesToIndexes = {}
+        if tryExact:
+            self.namesToIndexes = dict((name, ExactMatchIndex(reference)) for name, reference in zip(self.names, references))
+
+        # if we know which allele each part belongs to, only the best alignment per allele
+        # needs a traceback (the only one chooseBestAlignment() will keep)
+        self.alleles = None
+        self.refGroups = None
+        if namesToAlleles is not None:
+            self.alleles = []
+            for name in self.names:
+                if namesToAlleles[name] not in self.alleles:
+                    self.alleles.append(namesToAlleles[name])
+            self.refGroups = [self.alleles.index(namesToAlleles[name]) for name in self.names]
+
+        self.seedChain = seedChain
+        if seedChain:
+            self.partSeqs = references
+            self.minimizerIndexes = [MinimizerIndex(reference) for reference in references]
+
+        self.partStrands = None
+        if namesToStrands is not None and self.maxSecondScoreRatio is not None:
+            self.partStrands = [namesToStrands[name] for name in self.names]
+
+        # parts with bases other than ACGT always need to be aligned against (their kmers are None);
+        # there's nothing to skip if each allele has a single part, since each allele needs an alignment
+        self.prefilterParts = self.maxSecondScoreRatio is not None and len(set(self.refGroups)) < len(self.names)
+        self.partKmers = None
+        if self.prefilterParts or self.partStrands is not None:
+            self.partKmers = [kmers(reference, PREFILTER_K) if isACGT(reference) else None
+                              for reference in references]
+
+        if cache is not None:
+            settings = (self.aligner.match, self.aligner.mismatch, self.aligner.gap_open, self.aligner.gap_extend,
+                        tryExact, EXACT_INDEX_K, self.maxSecondScoreRatio, PREFILTER_K, self.refGroups,
+                        self.partStrands, seedChain, SEED_CHAIN_MIN_LENGTH, SEED_CHAIN_MAX_WINDOWS)
+            self.cacheKey = hashKey(repr(settings), *referenceKeys)
 
-        self.namesToAligners = {}
-        self.namesToRefs = {}
+    def remap(self, seq):
+        return self.remapMany([seq])[0]
+
+    def remapMany(self, seqs):
+        """ aligns a batch of read sequences against all the chromosome parts, using a single
+        call into the ssw library (see ssw_wrap.MultiAligner.align_many()) for the sequences that 
+        aren't in the cache; each of seqs can also be a (sequence, alleles) tuple, to align that
+        sequence only against the parts of those alleles (given namesToAlleles) """
+        jobs = []
+        for seq in seqs:
+            if isinstance(seq, tuple):
+                seq, alleles = seq
+                jobs.append((seq, tuple(allele for allele in self.alleles if allele in alleles)))
+            else:
+                jobs.append((seq, None))
 
-        for name, ref in namesToReferences.items():
-            self.namesToAligners[name] = ssw_wrap.Aligner(ref, report_cigar=True, report_secondary=True)
-            self.namesToRefs[name] = ref
+        if self.cache is None:
+            return self._remapMany(jobs)
 
-    def remap(self, seq):
-        results = {}
-        for name, aligner in self.namesToAligners.items():
-            results[name] = None
+        keys = [hashKey(self.cacheKey, seq, *(alleles or ())) for seq, alleles in jobs]
+        cached = self.cache.get(keys)
 
-            if self.tryExact:
-                revseq = reverseComp(seq)
-                results[name] = tryAlignExact(seq, revseq, self.namesToRefs[name], aligner)
+        remapped = dict(self._remapMany([job for job, key in zip(jobs, keys) if key not in cached]))
+        self.cache.put(dict((key, [remapped[seq][self.names[j]] for j in self._parts(alleles)])
+                            for (seq, alleles), key in zip(jobs, keys) if seq in remapped))
+
+        for (seq, alleles), key in zip(jobs, keys):
+            if key in cached:
+                remapped[seq] = dict(zip([self.names[j] for j in self._parts(alleles)], cached[key]))
+
+        return [(seq, remapped[seq]) for seq, alleles in jobs]
+
+    def _parts(self, alleles):
+        """ returns the indices of the parts of the given alleles, or of all the parts if alleles
+        is None """
+        if alleles is None:
+            return tuple(range(len(self.names)))
+        return tuple(j for j in range(len(self.names)) if self.alleles[self.refGroups[j]] in alleles)
+
+    def _remapMany(self, jobs):
+        seqs = [seq for seq, alleles in jobs]
+        parts = [self._parts(alleles) for seq, alleles in jobs]
+        results = [{} for seq in seqs]
+        toAlign = []
 
-            if results[name] is None:
-                results[name] = alignBothStrands(seq, aligner)#, self.namesToRefs[name])
+        for i, seq in enumerate(seqs):
+            if self.seedChain and len(seq) >= SEED_CHAIN_MIN_LENGTH:
+                results[i] = self._seedChain(seq, parts[i])
+            elif self.tryExact:
+                revseq = reverseComp(seq)
+                for j in parts[i]:
+                    name = self.names[j]
+                    results[i][name] = tryAlignExact(seq, revseq, self.namesToIndexes[name], self.aligner)
+
+            # an exact match has the highest possible score, so a smith-waterman alignment can
+            # only be picked over it by tying with it in an earlier part; that alignment is then
+            # the first best one of its allele, which gets a traceback
+            if any(results[i].get(self.names[j]) is None for j in parts[i]):
+                toAlign.append(i)
+
+        # reads are aligned in batches that need the same parts (and strands)
+        batches = collections.OrderedDict()
+        oneStrand = {}
+        for i in toAlign:
+            which = tuple(j for j in parts[i] if results[i].get(self.names[j]) is None)
+            if self.prefilterParts:
+                which = self._prefilter(seqs[i], results[i], which)
+            for strand, strandWhich in self._predictStrands(seqs[i], which):
+                batches.setdefault((strandWhich, strand), []).append(i)
+                if strand is not None:
+                    oneStrand[i] = oneStrand.get(i, ()) + strandWhich
+        self._alignBatches(seqs, results, batches)
+
+        if self.prefilterParts:
+            # the parts that were skipped but whose score bound isn't low enough still need to be
+            # aligned against
+            batches = collections.OrderedDict()
+            for i in toAlign:
+                which = self._checkSkipped(seqs[i], results[i], parts[i])
+                if len(which) > 0:
+                    batches.setdefault((which, None), []).append(i)
+            self._alignBatches(seqs, results, batches)
+
+        if len(oneStrand) > 0:
+            # the other strand still needs to be aligned where its score bound isn't low enough
+            batches = collections.OrderedDict()
+            for i, which in oneStrand.items():
+                for strand, strandWhich in self._checkOtherStrand(seqs[i], results[i], which):
+                    batches.setdefault((strandWhich, strand), []).append(i)
+            self._alignBatches(seqs, results, batches)
+
+        return list(zip(seqs, [dict((self.names[j], result[self.names[j]]) for j in resultParts)
+                               for result, resultParts in zip(results, parts)]))
+
+    def _seedChain(self, seq, parts):
+        """ aligns a long read against the windows of each of the parts (indices) found by chaining
+        its minimizers; returns a dict of part name -> (strand, aln) for the parts where either
+        strand of the read has a chain
+
+        every window (of every part, on either strand) is first scored in a single call into the
+        ssw library, and only the best alignment of each allele gets a traceback, as for the reads
+        aligned against the whole parts (see _alignBatches()) """
+        from ssw import ssw_wrap
 
-        return seq, results
+        revseq = reverseComp(seq)
+        forwardMinimizers = minimizers(seq.upper())
+        reverseMinimizers = minimizers(revseq.upper())
+
+        # (part index, start, end) of each window, and the strands with a chain
+        windows = []
+        strands = set()
+        for j in parts:
+            partSeq, index = self.partSeqs[j], self.minimizerIndexes[j]
+            partWindows = set()
+            for strand, query, queryMinimizers in [("+", seq, forwardMinimizers), ("-", revseq, reverseMinimizers)]:
+                strandWindows = _chainWindows(index.anchors(queryMinimizers), len(query), len(partSeq))
+                if len(strandWindows) > 0:
+                    strands.add(strand)
+                partWindows.update(strandWindows)
+            windows.extend((j, start, end) for start, end in _mergeWindows(partWindows))
+
+        if len(windows) == 0:
+            return {}
+
+        groups = [self.refGroups[j] if self.refGroups is not None else j for j, start, end in windows]
+        groupIDs = sorted(set(groups))
+
+        # a separate aligner for each read, since the mapper may be shared between threads
+        aligner = ssw_wrap.MultiAligner([self.partSeqs[j][start:end+1] for j, start, end in windows],
+            match=self.aligner.match, mismatch=self.aligner.mismatch, gap_open=self.aligner.gap_open,
+            gap_extend=self.aligner.gap_extend, report_secondary=True, report_cigar=True)
+
+        # both strands are only aligned if both have a chain
+        if len(strands) == 2:
+            alignments = aligner.align_many([seq], ref_groups=[groupIDs.index(g) for g in groups])[0]
+        else:
+            query = seq if "+" in strands else revseq
+            alignments = aligner.align_many([query], both_strands=False, ref_groups=[groupIDs.index(g) for g in groups])[0]
+            alignments = [(aln, None) if "+" in strands else (None, aln) for aln in alignments]
+
+        # part index -> list of (strand, aln) in all its windows
+        byPart = collections.OrderedDict()
+        for (j, start, end), (forward, reverse) in zip(windows, alignments):
+            for strand, aln in [("+", forward), ("-", reverse)]:
+                if aln is not None:
+                    _shiftAlignment(aln, start)
+                    byPart.setdefault(j, []).append((strand, aln))
+
+        result = {}
+        for j, partAlignments in byPart.items():
+            result[self.names[j]] = _bestInWindows(partAlignments, len(seq))
+
+        return result
+
+    def _alignBatches(self, seqs, results, batches):
+        """ batches: (tuple of part indices, strand) -> list of read indices, where strand is "+" or
+        "-" to align only the read or its reverse complement, or None for both; an alignment on
+        one strand is combined with any earlier alignment on the other strand """
+        for (which, strand), toAlign in batches.items():
+            refGroups = None
+            if self.refGroups is not None:
+                refGroups = [self.refGroups[j] for j in which]
+
+            queries = [seqs[i] for i in toAlign]
+            if strand == "-":
+                queries = [reverseComp(query) for query in queries]
+            alignments = self.aligner.align_many(queries, both_strands=(strand is None),
+                ref_groups=refGroups, which_refs=which)
+
+            for i, partAlignments in zip(toAlign, alignments):
+                for j, alignment in zip(which, partAlignments):
+                    name = self.names[j]
+                    if strand is None:
+                        results[i][name] = chooseStrand(*alignment)
+                    else:
+                        other = results[i][name][1] if results[i].get(name) is not None else None
+                        if strand == "+":
+                            results[i][name] = chooseStrand(alignment, other)
+                        else:
+                            results[i][name] = chooseStrand(other, alignment)
+
+    def _predictStrands(self, seq, which):
+        """ splits the parts (among which) by the strand seq is expected to align on, returning a
+        list of (strand, parts); strand is None for the parts that need both strands aligned """
+        if self.partStrands is None or len(seq) < 2 * PREFILTER_K or not isACGT(seq):
+            return [(None, which)]
+
+        byStrand = collections.OrderedDict()
+        for j in which:
+            strand = self.partStrands[j] if self.partKmers[j] is not None else None
+            byStrand.setdefault(strand, []).append(j)
+
+        return [(strand, tuple(strandWhich)) for strand, strandWhich in byStrand.items()]
+
+    def _checkOtherStrand(self, seq, result, which):
+        """ for the parts (among which) that seq was only aligned against on its predicted strand,
+        returns a list of (strand, parts) that still need the other strand aligned: those with
+        which the other strand shares k-mers, or for which the score bound isn't low enough (as for
+        _checkSkipped()) """
+        bound = seedlessScoreBound(len(seq), PREFILTER_K, self.aligner.match, self.aligner.mismatch,
+            self.aligner.gap_open)
+
+        # best score of each allele so far (None if an alignment failed); the real best scores
+        # can only be higher
+        bestScores = {}
+        for j, name in enumerate(self.names):
+            if result.get(name) is not None and not isinstance(result[name][1], SkippedAlignment):
+                group = self.refGroups[j]
+                aln = result[name][1]
+                if aln is None or bestScores.get(group, 0) is None:
+                    bestScores[group] = None
+                else:
+                    bestScores[group] = max(aln.score, bestScores.get(group, 0))
+
+        otherKmers = {"+": kmers(seq, PREFILTER_K), "-": kmers(reverseComp(seq), PREFILTER_K)}
+
+        byStrand = collections.OrderedDict()
+        for j in which:
+            other = "-" if self.partStrands[j] == "+" else "+"
+            best = bestScores.get(self.refGroups[j])
+            if best is None or not (bound < best and bound <= self.maxSecondScoreRatio * best) or \
+                    not otherKmers[other].isdisjoint(self.partKmers[j]):
+                byStrand.setdefault(other, []).append(j)
+
+        return [(strand, tuple(strandWhich)) for strand, strandWhich in byStrand.items()]
+
+    def _prefilter(self, seq, result, which):
+        """ returns the parts (among which) that seq shares k-mers with, along with all the parts
+        of any allele that would otherwise be left without an alignment """
+        if len(seq) < 2 * PREFILTER_K or not isACGT(seq):
+            return which
+
+        seqKmers = kmers(seq, PREFILTER_K)
+        seqKmers.update(kmers(reverseComp(seq), PREFILTER_K))
+
+        keep = [j for j in which if self.partKmers[j] is None or not seqKmers.isdisjoint(self.partKmers[j])]
+
+        covered = set(self.refGroups[j] for j in keep)
+        covered.update(self.refGroups[j] for j, name in enumerate(self.names) if result.get(name) is not None)
+        keep.extend(j for j in which if self.refGroups[j] not in covered)
+
+        return tuple(sorted(keep))
+
+    def _checkSkipped(self, seq, result, parts):
+        """ fills in a SkippedAlignment for the parts (among parts) that weren't aligned against, if
+        their score bound is low enough; returns the parts that still need to be aligned against """
+        bound = seedlessScoreBound(len(seq), PREFILTER_K, self.aligner.match, self.aligner.mismatch,
+            self.aligner.gap_open)
+
+        # best score of each allele (None if an alignment failed)
+        bestScores = {}
+        for j, name in enumerate(self.names):
+            if result.get(name) is not None:
+                group = self.refGroups[j]
+                aln = result[name][1]
+                if aln is None or bestScores.get(group, 0) is None:
+                    bestScores[group] = None
+                else:
+                    bestScores[group] = max(aln.score, bestScores.get(group, 0))
+
+        which = []
+        for j in parts:
+            name = self.names[j]
+            if result.get(name) is None:
+                best = bestScores.get(self.refGroups[j])
+                if best is not None and bound < best and bound <= self.maxSecondScoreRatio * best:
+                    result[name] = ("+", SkippedAlignment(bound))
+                else:
+                    which.append(j)
+
+        return tuple(which)
 
 
 def filterDegenerateOnly(reads):
@@ -127,7 +540,8 @@ def filterDegenerateOnly(reads):
     return filtered
 
 def chooseBestAlignment(read, mappings, chromPartsCollection):
-    # TODO: this should be read-pair aware
+    # TODO: this should be read-pair aware (it only is with --mate-window, where the mappings of
+    # one read of each pair are restricted to the neighborhood of its mate; see _alignInMateWindows())
     # TODO: this is kind of ridiculous; we need to make pickleable reads that can be sent to 
     # and from the Multimapper
     # mappings: name -> (strand, aln)
@@ -148,8 +562,12 @@ def chooseBestAlignment(read, mappings, chromPartsCollection):
     for name, mapping in mappings.items():
         strand, aln = mapping
         if name == bestName:
-            if secondScore is None or bestAln.score2 > secondScore:
+            if bestAln.score2 is not None and (secondScore is None or bestAln.score2 > secondScore):
                 secondScore = bestAln.score2
+        elif isinstance(aln, SkippedAlignment):
+            # the real score is lower than this bound, which Multimap made sure is too low to
+            # make the read multimapping
+            continue
         else:
             if secondScore is None or aln.score > secondScore:
                 secondScore = aln.score
@@ -166,72 +584,548 @@ def chooseBestAlignment(read, mappings, chromPartsCollection):
     return bestAln
 
 
-def do1remap(chromPartsCollection, reads, processes, jobName="", tryExact=False):
-    reads = filterDegenerateOnly(reads)
+def remapThreaded(mapper, seqs, threads, batchSize=planner.BATCH_SIZE):
+    """ realigns seqs with a pool of threads sharing the Multimap (or WindowAligner) mapper (and so a
+    single copy of the encoded references); the ssw library is called through ctypes, which releases
+    the GIL """
+    from multiprocessing.pool import ThreadPool
 
-    namesToReferences = {}
-    for name, chromPart in chromPartsCollection.parts.items():
-        namesToReferences[chromPart.id] = chromPart.getSeq()
+    batches = [seqs[i:i+batchSize] for i in range(0, len(seqs), batchSize)]
 
-    # map each read sequence against each chromosome part (the current allele only)
+    remapped = {}
+    pool = ThreadPool(threads)
+    try:
+        for batchResults in pool.imap_unordered(mapper.remapMany, batches):
+            remapped.update(batchResults)
+    finally:
+        pool.terminate()
+
+    return remapped
+
+def partStrand(chromPart):
+    """ returns the strand on which reads from the genome are expected to align against the
+    chromosome part, or None if it's made up of segments on both strands (or not from the genome);
+    read sequences from the bam are already given on the forward strand of the genome """
+    strands = set(segment.strand for segment in chromPart.segments)
+    if len(strands) == 1 and all(segment.source == "genome" for segment in chromPart.segments):
+        return strands.pop()
+    return None
+
+def remapSeqs(chromPartsCollections, seqs, processes, jobName="", tryExact=False, backend="auto",
+             maxSecondScoreRatio=None, cache=None, predictStrand=False, seedChain=False, seqsToAlleles=None):
+    """ realigns the read sequences against the chromosome parts of all the alleles in one pass,
+    returning a dict of seq -> {chromosome part ID: (strand, aln)}; processes is the maximum number of
+    workers (None to let the planner decide; -1 for crash-isolated subprocesses, see alignproc), and
+    backend restricts the workers to "processes" or "threads" (see planner.plan()); if predictStrand, the reads are first
+    aligned only on the strand of the segments making up each part (see partStrand()); see
+    Multimap for maxSecondScoreRatio, cache and seedChain
+
+    seqsToAlleles optionally maps some of the sequences to the alleles they need to be realigned
+    against (the others are realigned against all the alleles); their realignments then only
+    cover the parts of those alleles (except with the crash-isolated subprocesses) """
+    namesToReferences = collections.OrderedDict()
+    namesToAlleles = {}
+    namesToStrands = {} if predictStrand else None
+    for allele, chromPartsCollection in chromPartsCollections.items():
+        for name, chromPart in chromPartsCollection.parts.items():
+            assert chromPart.id not in namesToReferences, "chromosome part IDs must be unique across alleles"
+            namesToReferences[chromPart.id] = chromPart.getSeq()
+            namesToAlleles[chromPart.id] = allele
+            if predictStrand:
+                namesToStrands[chromPart.id] = partStrand(chromPart)
+
+    # map each read sequence against each chromosome part (of every allele)
+
+    # identical sequences (within a sample, or across samples) only need to be aligned once
+    readCount = len(seqs)
+    seqs = list(collections.OrderedDict.fromkeys(seqs))
+    if len(seqs) < readCount:
+        logging.info("  Realigning {} distinct sequences for {} reads ({} duplicate alignments saved)".format(
+            len(seqs), readCount, readCount-len(seqs)))
+
+    # smith-waterman cost scales with read length x reference length
+    totalRefLength = sum(len(ref) for ref in namesToReferences.values())
+    costs = [len(seq) * totalRefLength for seq in seqs]
+
+    jobs = seqs
+    refLength = totalRefLength
+    if seqsToAlleles:
+        alleleLengths = collections.Counter()
+        for name, ref in namesToReferences.items():
+            alleleLengths[namesToAlleles[name]] += len(ref)
+
+        jobs = [(seq, tuple(seqsToAlleles[seq])) if seq in seqsToAlleles else seq for seq in seqs]
+        costs = [len(seq) * sum(alleleLengths[allele] for allele in seqsToAlleles[seq]) if seq in seqsToAlleles else cost
+                 for seq, cost in zip(seqs, costs)]
+        # the reference length per read base, averaged over the sequences
+        refLength = sum(costs) / float(max(1, sum(len(seq) for seq in seqs)))
 
     if processes == -1:
         from svviz import alignproc
-        logging.info(" == aligning using slower subprocesses for error-prone "
+        logging.info(" == aligning using crash-isolated subprocesses for error-prone "
             "datasets (eg pacbio) ==")
-        remapped = alignproc.multimap(namesToReferences, [read.seq for read in reads])
-        # raise Exception("not yet implemented")
-    elif processes != 1:
+        return alignproc.multimap(namesToReferences, seqs, namesToAlleles, seedChain=seedChain, tryExact=tryExact,
+            maxSecondScoreRatio=maxSecondScoreRatio, cache=cache, namesToStrands=namesToStrands)
+
+    plan = planner.plan(seqs, refLength, processes, backend)
+    t0 = time.time()
+
+    if plan.mode == "threads":
+        mapper = Multimap(namesToReferences, tryExact=tryExact, namesToAlleles=namesToAlleles,
+            maxSecondScoreRatio=maxSecondScoreRatio, cache=cache, namesToStrands=namesToStrands,
+            seedChain=seedChain)
+        remapped = remapThreaded(mapper, jobs, plan.workers, plan.batchSize)
+    elif plan.mode == "processes":
         verbose = 3
 
-        remapped = dict(Multimap.map(Multimap.remap, [read.seq for read in reads], initArgs=[namesToReferences], 
-            verbose=verbose, processes=processes, name=jobName))
+        # the workers attach to the encoded sequences instead of getting them pickled with every chunk
+        namesToShared = collections.OrderedDict((name, shareReference(ref)) for name, ref in namesToReferences.items())
+
+        remapped = dict(Multimap.map(Multimap.remapMany, jobs, initArgs=[namesToShared, tryExact, namesToAlleles, maxSecondScoreRatio, cache, namesToStrands,
+            seedChain], 
+            verbose=verbose, processes=plan.poolSize, name=jobName, costs=costs, batched=True, chunks=plan.chunks))
     else:
-        mapper = Multimap(namesToReferences, tryExact=tryExact)
+        mapper = Multimap(namesToReferences, tryExact=tryExact, namesToAlleles=namesToAlleles,
+            maxSecondScoreRatio=maxSecondScoreRatio, cache=cache, namesToStrands=namesToStrands,
+            seedChain=seedChain)
 
         remapped = {}
-        for i, read in enumerate(reads):
+        for i in range(0, len(jobs), plan.batchSize):
             if i % 1000 == 0:
-                logging.debug("realigned {} of {} reads".format(i, len(reads)))
-            seq, result = mapper.remap(read.seq)
-            remapped[seq] = result
+                logging.debug("realigned {} of {} reads".format(i, len(jobs)))
+            remapped.update(mapper.remapMany(jobs[i:i+plan.batchSize]))
+
+    planner.record(plan, time.time() - t0)
+    return remapped
+
+def _chooseAlignments(chromPartsCollections, reads, remapped, windowed=None):
+    """ picks the best alignment of each read for each allele from the realignments against all
+    the chromosome parts (see remapSeqs()), or for the reads aligned near their mates, from the
+    alignments in windowed (see _alignInMateWindows()) """
+    results = {}
+    for allele, chromPartsCollection in chromPartsCollections.items():
+        alignmentSets = collections.defaultdict(AlignmentSet)
+        badReads = set()
+
+        for read in reads:
+            # TODO: for paired-end, if there are equally-scoring alignments in multiple parts, we should pick
+            # the pair which are in the correct orientation
+            if windowed is not None and id(read) in windowed:
+                mappings = windowed[id(read)][allele]
+            else:
+                mappings = collections.OrderedDict((name, remapped[read.seq][name]) for name in chromPartsCollection.parts)
+            aln = chooseBestAlignment(read, mappings, chromPartsCollection)
+            if aln is None:
+                badReads.add(read.qname)
+            else:
+                alignmentSets[read.qname].addAlignment(aln)
 
-    alignmentSets = collections.defaultdict(AlignmentSet)
-    badReads = set()
+        results[allele] = (alignmentSets, badReads)
 
-    for read in reads:
-        # TODO: for paired-end, if there are equally-scoring alignments in multiple parts, we should pick
-        # the pair which are in the correct orientation
-        aln = chooseBestAlignment(read, remapped[read.seq], chromPartsCollection)
-        if aln is None:
-            badReads.add(read.qname)
-        else:
-            alignmentSets[read.qname].addAlignment(aln)
+    return results
 
-    return alignmentSets, badReads
 
 
+# with --flanking-shortcut, reads from pairs aligned at least this many read lengths inside a
+# segment shared by both alleles are only realigned against the ref allele (see do_realign())
+FLANKING_SHORTCUT_MARGIN = 2
 
-def do_realign(dataHub, sample):
+def do_realign(dataHub):
+    """ realigns the reads of all the samples against both alleles as a single job, so that the
+    workers are kept busy until all the realignments are done, then splits the alignments back up 
+    by sample; returns a dict of sample name -> alnCollections """
     processes = dataHub.args.processes
-    if processes is None or processes == 0:
-        # we don't really gain from using virtual cores, so try to figure out how many physical
-        # cores we have
-        processes = misc.cpu_count_physical()
+    if processes == 0:
+        # let the planner choose the number of workers (see planner.plan())
+        processes = None
 
     variant = dataHub.variant
-    reads = sample.reads
-    name = "{}:{{}}".format(sample.name[:15])
+    samplesToReads = collections.OrderedDict((sample.name, filterDegenerateOnly(sample.reads)) for sample in dataHub)
+
+    if len(samplesToReads) == 1:
+        name = list(samplesToReads.keys())[0][:15]
+    else:
+        name = "{} samples".format(len(samplesToReads))
+
+    cache = None
+    if dataHub.args.alignment_cache is not None:
+        cache = AlignmentCache(dataHub.args.alignment_cache, dataHub.args.alignment_cache_size * 1e6)
+
+    chromPartsCollections = collections.OrderedDict((allele, variant.chromParts(allele)) for allele in ["ref", "alt"])
+    remapArgs = dict(processes=processes, jobName=name, tryExact=dataHub.args.fast,
+        backend=dataHub.args.alignment_backend, maxSecondScoreRatio=dataHub.args.max_multimapping_similarity,
+        cache=cache, predictStrand=dataHub.args.predict_strand, seedChain=dataHub.args.seed_chain)
 
     t0 = time.time()
-    refalignments, badReadsRef = do1remap(variant.chromParts("ref"), reads, processes, 
-        jobName=name.format("ref"), tryExact=dataHub.args.fast)
-    altalignments, badReadsAlt = do1remap(variant.chromParts("alt"), reads, processes, 
-        jobName=name.format("alt"), tryExact=dataHub.args.fast)
+
+    # with --flanking-shortcut, pairs lying well inside a segment common to both alleles are only
+    # realigned against the ref allele; their alignments are then projected onto the alt allele
+    # (unless the alt allele has sequence of its own, see FlankingRegionCollection.projectable)
+    flankingRegions = FlankingRegionCollection(variant)
+    samplesToFlanking = collections.OrderedDict()
+    for sample in dataHub:
+        samplesToFlanking[sample.name] = {}
+        if dataHub.args.flanking_shortcut and flankingRegions.projectable:
+            samplesToFlanking[sample.name] = _confinedPairs(samplesToReads[sample.name], sample.bam, flankingRegions)
+
+    fullReads = collections.OrderedDict()
+    flankingReads = collections.OrderedDict()
+    for sampleName, reads in samplesToReads.items():
+        confined = samplesToFlanking[sampleName]
+        fullReads[sampleName] = [read for read in reads if read.qname not in confined]
+        flankingReads[sampleName] = [read for read in reads if read.qname in confined]
+
+    # with --mate-window, the mate of each read pair that's realigned against the full alleles is
+    # then aligned only near it (see _alignInMateWindows())
+    samplesToFollowers = collections.OrderedDict()
+    for sample in dataHub:
+        samplesToFollowers[sample.name] = {}
+        if dataHub.args.mate_window is not None and not sample.singleEnded and \
+                sample.readStatistics.hasInsertSizeDistribution():
+            samplesToFollowers[sample.name] = _pairFollowers(fullReads[sample.name])
+
+    seqs = [read.seq for sampleName, reads in fullReads.items() for read in reads
+            if id(read) not in samplesToFollowers[sampleName]]
+
+    # the reads confined to a common segment are realigned against the ref allele in the same job
+    # (unless their sequence is also that of another read, including a mate aligned near its pair,
+    # which takes the realignment to be against all the alleles)
+    flankingSeqs = [read.seq for reads in flankingReads.values() for read in reads]
+    seqsToAlleles = dict((seq, ["ref"]) for seq in flankingSeqs)
+    for reads in fullReads.values():
+        for read in reads:
+            seqsToAlleles.pop(read.seq, None)
+
+    remapped = remapSeqs(chromPartsCollections, seqs + flankingSeqs, seqsToAlleles=seqsToAlleles, **remapArgs)
+
+    # seq -> the alleles it still needs to be realigned against, which is done in a single job at
+    # the end
+    toRealign = collections.OrderedDict()
+
+    projected = collections.OrderedDict()
+    if len(flankingSeqs) > 0:
+        refOnly = collections.OrderedDict([("ref", chromPartsCollections["ref"])])
+
+        fallbackSeqs = []
+        for sampleName, reads in flankingReads.items():
+            refSets, altSets, fallback = _projectFlanking(reads, remapped, refOnly,
+                samplesToFlanking[sampleName], flankingRegions, dataHub.args.max_multimapping_similarity)
+            projected[sampleName] = (refSets, altSets)
+
+            fallbackReads = [read for read in reads if read.qname in fallback]
+            fullReads[sampleName].extend(fallbackReads)
+            fallbackSeqs.extend(read.seq for read in fallbackReads)
+
+        logging.info(" Skipped alt realignment for {} reads inside flanking regions".format(
+            len(flankingSeqs)-len(fallbackSeqs)))
+
+        # the reads that couldn't be projected still need to be realigned against the alt allele
+        for seq in fallbackSeqs:
+            if seq in seqsToAlleles:
+                toRealign.setdefault(seq, set()).add("alt")
+
+    windowed = {}
+    windowFallback = {}
+    if any(len(followers) > 0 for followers in samplesToFollowers.values()):
+        followers = []
+        for sample in dataHub:
+            stats = sample.readStatistics
+            halfWidth = stats.meanInsertSize() + dataHub.args.mate_window * stats.stddevInsertSize()
+            followers.extend((follower, mate, halfWidth) for follower, mate in samplesToFollowers[sample.name].values())
+        windowed, windowFallback = _alignInMateWindows(chromPartsCollections, followers, remapped, processes=processes,
+            jobName=name, backend=dataHub.args.alignment_backend)
+
+        logging.info(" Aligned {} mates near their pair's other read ({} ref and {} alt alignments "
+            "against the full allele)".format(len(windowed), len(windowFallback["ref"]), len(windowFallback["alt"])))
+
+        # mates that don't align well near their pair's other read are realigned against the whole
+        # allele
+        for allele, followers in windowFallback.items():
+            for read in followers:
+                toRealign.setdefault(read.seq, set()).add(allele)
+
+    if len(toRealign) > 0:
+        realigned = remapSeqs(chromPartsCollections, list(toRealign), seqsToAlleles=toRealign, **remapArgs)
+        for seq, mappings in realigned.items():
+            remapped.setdefault(seq, {}).update(mappings)
+
+        for allele, followers in windowFallback.items():
+            for read in followers:
+                windowed[id(read)][allele] = collections.OrderedDict(
+                    (name, remapped[read.seq][name]) for name in chromPartsCollections[allele].parts)
+
     t1 = time.time()
 
     logging.debug(" Time to realign: {:.1f}s".format(t1-t0))
 
+    samplesToAlnCollections = collections.OrderedDict()
+    for sampleName, reads in fullReads.items():
+        alignments = _chooseAlignments(chromPartsCollections, reads, remapped, windowed)
+        if sampleName in projected:
+            for allele, alignmentSets in zip(["ref", "alt"], projected[sampleName]):
+                alignments[allele][0].update(alignmentSets)
+        samplesToAlnCollections[sampleName] = _collectAlignments(alignments)
+
+    return samplesToAlnCollections
+
+def _pairFollowers(reads):
+    """ for each read pair, picks the read with the lower mapping quality (the second one on ties) to
+    be aligned near its mate; returns a dict of id(follower) -> (follower, mate) """
+    pairs = collections.OrderedDict()
+    for read in reads:
+        pairs.setdefault(read.qname, []).append(read)
+
+    followers = {}
+    for pair in pairs.values():
+        if len(pair) != 2:
+            continue
+        leader, follower = pair
+        if follower.mapq > leader.mapq:
+            leader, follower = follower, leader
+        followers[id(follower)] = (follower, leader)
+
+    return followers
+
+def _alignInMateWindows(chromPartsCollections, followers, remapped, processes, jobName="", backend="auto"):
+    """ aligns each follower read, for each allele, only against the stretch of the chromosome part
+    within halfWidth of where its mate was realigned; followers is a list of (follower, mate,
+    halfWidth), and the alignments are run as a single job (see alignWindowJobs()); returns a dict
+    of id(follower) -> allele -> mappings (as used by chooseBestAlignment()), along with a dict of
+    allele -> the followers that don't align well near their mate, whose mappings for that allele
+    are left out and need to be realigned against the whole allele """
+    windowed = {}
+    fallback = collections.OrderedDict((allele, []) for allele in chromPartsCollections)
+
+    # id(follower) -> (follower, [(allele, part name, start, end)] of the windows, job key);
+    # followers with the same sequence and windows (eg the same read in several samples) share a job
+    placements = collections.OrderedDict()
+    jobs = collections.OrderedDict()
+
+    for follower, mate, halfWidth in followers:
+        if follower.seq in remapped:
+            # already realigned against the full alleles (eg as another read)
+            continue
+
+        windowed[id(follower)] = alleleMappings = {}
+        windows = []
+        windowPlacements = []
+        for allele, chromPartsCollection in chromPartsCollections.items():
+            mappings = collections.OrderedDict((name, remapped[mate.seq][name]) for name in chromPartsCollection.parts)
+            mateAln = chooseBestAlignment(mate, mappings, chromPartsCollection)
+            if mateAln is None:
+                # the pair can't be aligned against this allele anyway
+                alleleMappings[allele] = collections.OrderedDict((name, None) for name in chromPartsCollection.parts)
+                continue
+
+            partSeq = chromPartsCollection.getSeq(mateAln.regionID)
+            # padded by the read length, so that reads at the very edge aren't clipped
+            padding = int(halfWidth) + len(follower.seq)
+            start = max(0, mateAln.start - padding)
+            end = min(len(partSeq)-1, mateAln.end + padding)
+            windows.append((partSeq[start:end+1], start))
+            windowPlacements.append((allele, mateAln.regionID, start, end))
+
+        if len(windows) > 0:
+            key = (follower.seq, tuple(windowPlacements))
+            jobs[key] = (key, follower.seq, windows)
+            placements[id(follower)] = (follower, windowPlacements, key)
+
+    results = alignWindowJobs(list(jobs.values()), processes, jobName, backend)
+
+    for followerID, (follower, windowPlacements, key) in placements.items():
+        for (allele, name, start, end), mapping in zip(windowPlacements, results[key]):
+            if mapping is None or mapping[1].score / float(WindowAligner.MATCH) < len(follower.seq) * AlignmentSet.AlnThreshold:
+                fallback[allele].append(follower)
+            else:
+                windowed[followerID][allele] = collections.OrderedDict([(name, mapping)])
+
+    return windowed, fallback
+
+def alignWindowJobs(jobs, processes, jobName="", backend="auto"):
+    """ runs the window alignments of jobs, a list of (key, seq, windows) (see
+    WindowAligner.remapMany()), serially or in parallel as chosen by the planner; returns a dict of
+    key -> list of mappings per window """
+    if len(jobs) == 0:
+        return {}
+
+    # the planner models each read as aligned against all the references, so use the average
+    # total length of the windows of a read
+    windowLength = sum(len(window) for key, seq, windows in jobs for window, start in windows) / float(len(jobs))
+    plan = planner.plan([seq for key, seq, windows in jobs], windowLength, processes, backend)
+    t0 = time.time()
+
+    if plan.mode == "threads":
+        results = remapThreaded(WindowAligner(), jobs, plan.workers, plan.batchSize)
+    elif plan.mode == "processes":
+        costs = [len(seq) * sum(len(window) for window, start in windows) for key, seq, windows in jobs]
+        results = dict(WindowAligner.map(WindowAligner.remapMany, jobs, initArgs=[], verbose=3,
+            processes=plan.poolSize, name=jobName, costs=costs, batched=True, chunks=plan.chunks))
+    else:
+        results = {}
+        for i in range(0, len(jobs), plan.batchSize):
+            results.update(WindowAligner().remapMany(jobs[i:i+plan.batchSize]))
+
+    planner.record(plan, time.time() - t0)
+    return results
+
+class WindowAligner(Multiprocessor):
+    """ aligns reads against windows of the chromosome parts (see _alignInMateWindows()) """
+    MATCH = 2
+
+    def remapMany(self, jobs):
+        """ jobs is a list of (key, seq, windows), where windows is a list of (window sequence,
+        start of the window in its part); returns a list of (key, mappings), with one (strand, aln)
+        or None per window """
+        from ssw import ssw_wrap
+
+        # a separate aligner for each batch, since the instance may be shared between threads
+        aligner = ssw_wrap.MultiAligner(match=self.MATCH, report_cigar=True, report_secondary=True)
+        return [(key, alignInWindows(aligner, seq, windows)) for key, seq, windows in jobs]
+
+def alignInWindows(aligner, seq, windows):
+    """ aligns both strands of seq against each of windows, a list of (window sequence, start of the
+    window in its part), with a single call to the ssw_wrap.MultiAligner aligner; every strand and
+    window is first scored, then only the best strand in each window gets a traceback; returns a
+    list with one (strand, aln) per window, with the coordinates of aln relative to the part, or
+    None """
+    aligner.set_refs([window for window, start in windows])
+    alignments = aligner.align_many([seq], ref_groups=list(range(len(windows))))[0]
+
+    mappings = []
+    for (forward, reverse), (window, start) in zip(alignments, windows):
+        if forward is None and reverse is None:
+            mappings.append(None)
+            continue
+        strand, aln = chooseStrand(forward, reverse)
+        _shiftAlignment(aln, start)
+        mappings.append((strand, aln))
+
+    return mappings
+
+def _chainWindows(anchors, queryLength, partLength):
+    """ returns the windows (start, end; inclusive) of the part around the best chains of the
+    anchors; their ends are padded by the mask length of the ssw library, so that the second-best
+    score is the same as for an alignment against the whole part, which is usually the best
+    alignment carried on with a deletion to just past the mask """
+    mask = _maskLength(queryLength) + 1
+
+    windows = []
+    for score, chain in chainAnchors(anchors)[:SEED_CHAIN_MAX_WINDOWS]:
+        start, end = chainWindow(chain, queryLength, partLength)
+        windows.append((start, min(partLength - 1, end + mask)))
+    return windows
+
+def _mergeWindows(windows):
+    """ merges the overlapping windows (start, end; inclusive), eg for the pieces of a read spanning
+    a large deletion """
+    merged = []
+    for start, end in sorted(windows):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _maskLength(queryLength):
+    # the distance from the best alignment within which the ssw library ignores sub-optimal
+    # alignments (see ssw_batch.c)
+    return queryLength // 2 if queryLength > 30 else 15
+
+def _bestInWindows(alignments, queryLength):
+    """ picks the best of the alignments (a list of (strand, aln)) of a read against the windows
+    of a part; as for the ssw library aligning against the whole part, the second-best score is
+    raised to the score of the other alignments ending outside the mask around the best one, and
+    to the best score of the other strand (see chooseStrand()) """
+    bestStrand, best = alignments[0]
+    for strand, aln in alignments[1:]:
+        if aln.score > best.score:
+            bestStrand, best = strand, aln
+
+    mask = _maskLength(queryLength)
+    for strand, aln in alignments:
+        if aln is best:
+            continue
+        if strand == bestStrand and abs(aln.ref_end - best.ref_end) <= mask:
+            continue
+        if best.score2 is None or aln.score > best.score2:
+            best.score2 = aln.score
+            best.ref_end2 = -1
+
+    return bestStrand, best
+
+def _shiftAlignment(aln, offset):
+    """ moves an alignment against a window starting at offset to the coordinates of the whole
+    sequence """
+    if aln.ref_begin >= 0:
+        # not set for score-only alignments
+        aln.ref_begin += offset
+    aln.ref_end += offset
+    if aln.ref_end2 is not None and aln.ref_end2 >= 0:
+        aln.ref_end2 += offset
+
+def _confinedPairs(reads, bam, flankingRegions):
+    """ returns a dict of qname -> segment ID for the pairs whose reads were all originally aligned
+    well inside the same common segment (see FLANKING_SHORTCUT_MARGIN) """
+    pairs = collections.defaultdict(list)
+    for read in reads:
+        pairs[read.qname].append(read)
+
+    confined = {}
+    for qname, pair in pairs.items():
+        segmentIDs = set()
+        for read in pair:
+            if read.is_unmapped or read.tid < 0:
+                segmentIDs.add(None)
+                break
+            margin = FLANKING_SHORTCUT_MARGIN * len(read.seq)
+            segmentIDs.add(flankingRegions.confiningSegment(bam.getrname(read.tid), read.pos, read.aend-1, margin))
+
+        if len(segmentIDs) == 1 and None not in segmentIDs:
+            confined[qname] = segmentIDs.pop()
+
+    return confined
+
+def _projectFlanking(reads, refRemapped, refOnly, confined, flankingRegions, maxMultimappingSimilarity):
+    """ picks the ref alignments of the reads confined to a common segment and projects them onto
+    the alt allele; returns the ref and alt alignment sets, along with the qnames of the pairs whose
+    ref alignments strayed out of their segment or are multimapping, and so need to be realigned
+    against both alleles """
+    refSets, badReads = _chooseAlignments(refOnly, reads, refRemapped)["ref"]
+    altSets = collections.defaultdict(AlignmentSet)
+    fallback = set(badReads)
+
+    for qname, refSet in refSets.items():
+        if qname in fallback:
+            continue
+        for aln in refSet.getAlignments():
+            # the second-best ref alignment may lie in sequence the alt allele doesn't have (eg a
+            # repeat copy within a deleted segment), so only the second-best score of reads that
+            # aren't multimapping against the ref allele is known to be low enough against the alt
+            # allele (barring alignments across the alt breakpoints)
+            if aln.score2 is not None and aln.score2 / float(aln.score) > maxMultimappingSimilarity:
+                fallback.add(qname)
+                break
+
+            margin = FLANKING_SHORTCUT_MARGIN * len(aln.seq)
+            altAln = flankingRegions.projectAlignment(aln, confined[qname], "ref", "alt", margin)
+            if altAln is None:
+                fallback.add(qname)
+                break
+            altAln.score2 = None
+            altSets[qname].addAlignment(altAln)
+
+    for qname in fallback:
+        refSets.pop(qname, None)
+        altSets.pop(qname, None)
+
+    return refSets, altSets, fallback
+
+def _collectAlignments(alignments):
+    """ turns the per-allele alignments of a sample (see _chooseAlignments()) into AlignmentSetCollections,
+    dropping the reads that couldn't be aligned """
+    refalignments, badReadsRef = alignments["ref"]
+    altalignments, badReadsAlt = alignments["alt"]
+
     badReads = badReadsRef.union(badReadsAlt)
 
     if len(badReads) > 0:
@@ -254,13 +1148,16 @@ def do_realign(dataHub, sample):
 
 
 
-def _getreads(searchRegions, bam, minmapq, pair_minmapq, single_ended, include_supplementary, max_reads, sample_reads):
+def _getreads(searchRegions, bam, minmapq, pair_minmapq, single_ended, include_supplementary, max_reads, sample_reads,
+              sample_seed, mate_index):
     pairFinder = PairFinder(searchRegions, bam, minmapq=minmapq, pair_minmapq=pair_minmapq,
-        is_paired=(not single_ended), include_supplementary=include_supplementary, max_reads=max_reads, sample_reads=sample_reads)
+        is_paired=(not single_ended), include_supplementary=include_supplementary, max_reads=max_reads, sample_reads=sample_reads,
+        sample_seed=sample_seed, mate_index=mate_index)
     reads = [item for sublist in pairFinder.matched for item in sublist]
     return reads, pairFinder.supplementaryAlignmentsFound
 
-def getReads(variant, bam, minmapq, pair_minmapq, searchDistance, single_ended=False, include_supplementary=False, max_reads=None, sample_reads=None):
+def getReads(variant, bam, minmapq, pair_minmapq, searchDistance, single_ended=False, include_supplementary=False, max_reads=None, sample_reads=None,
+             sample_seed=0, mate_index=None):
     t0 = time.time()
     searchRegions = variant.searchRegions(searchDistance)
 
@@ -268,7 +1165,7 @@ def getReads(variant, bam, minmapq, pair_minmapq, searchDistance, single_ended=F
     # tries to switch to the other variation ('4' or 'chr4')
     try:
         reads, supplementaryAlignmentsFound = _getreads(searchRegions, bam, minmapq, pair_minmapq, single_ended, 
-            include_supplementary, max_reads, sample_reads)
+            include_supplementary, max_reads, sample_reads, sample_seed, mate_index)
     except ValueError as e:
         oldchrom = searchRegions[0].chr()
         try:
@@ -282,7 +1179,7 @@ def getReads(variant, bam, minmapq, pair_minmapq, searchDistance, single_ended=F
             logging.warn("  Couldn't find reads on chromosome '{}'; trying instead '{}'".format(oldchrom, newchrom))
 
             reads, supplementaryAlignmentsFound = _getreads(searchRegions, bam, minmapq, pair_minmapq, single_ended, 
-                include_supplementary, max_reads, sample_reads)
+                include_supplementary, max_reads, sample_reads, sample_seed, mate_index)
 
         except ValueError:
             raise e
@@ -0,0 +1,152 @@
+""" Seed-chain-extend alignment of long reads (see --seed-chain).
+
+Rather than aligning a long read against the whole of a chromosome part, the (w,k)-minimizers
+of the read are looked up in an index of the part; the hits (anchors) are chained, and the read is
+only aligned against the stretch of the part spanned by each of the best chains, padded to leave
+room for the unanchored ends of the read and for indels. This turns a smith-waterman alignment
+against a part of several kb (or more) into one against a window about the size of the read.
+"""
+
+import collections
+import math
+import zlib
+
+
+MINIMIZER_K = 15
+MINIMIZER_W = 10
+
+# minimizers occurring more often than this in a part are too repetitive to be useful anchors
+MAX_OCCURRENCES = 50
+
+# anchors are only chained if they're at most this far apart, on both the read and the part
+MAX_CHAIN_GAP = 1000
+
+# how many of the preceding anchors are tried as the predecessor of each anchor in a chain
+CHAIN_LOOKBACK = 50
+
+# chains scoring less than this (about 3 anchors) are ignored
+MIN_CHAIN_SCORE = 40
+
+# the unanchored ends of a read are given this much more room in the part (for insertions in the
+# part relative to the read), plus a fixed padding on either side of the window
+WINDOW_SLACK = 0.2
+WINDOW_PADDING = 100
+
+
+def _hash(kmer):
+    # a hash that's the same in every process (unlike hash() in python 3)
+    return zlib.crc32(kmer.encode("ascii"))
+
+def minimizers(seq, k=MINIMIZER_K, w=MINIMIZER_W):
+    """ returns the (w,k)-minimizers of seq as a list of (position, k-mer): for each window of w
+    consecutive k-mers, the one with the lowest hash (the leftmost on ties) """
+    if len(seq) < k:
+        return []
+
+    hashes = [_hash(seq[i:i+k]) for i in range(len(seq)-k+1)]
+    w = min(w, len(hashes))
+
+    # candidates holds the positions of the k-mers that may still be the minimizer of a later
+    # window, with increasing hashes
+    candidates = collections.deque()
+    result = []
+    for i, h in enumerate(hashes):
+        while len(candidates) > 0 and hashes[candidates[-1]] > h:
+            candidates.pop()
+        candidates.append(i)
+        if candidates[0] <= i - w:
+            candidates.popleft()
+
+        if i >= w-1 and (len(result) == 0 or result[-1][0] != candidates[0]):
+            result.append((candidates[0], seq[candidates[0]:candidates[0]+k]))
+
+    return result
+
+
+class MinimizerIndex(object):
+    """ the positions of the minimizers of a chromosome part sequence """
+    def __init__(self, target, k=MINIMIZER_K, w=MINIMIZER_W):
+        self.k = k
+        self.w = w
+
+        self.positions = {}
+        for position, kmer in minimizers(target.upper(), k, w):
+            self.positions.setdefault(kmer, []).append(position)
+
+        for kmer in [kmer for kmer, positions in self.positions.items() if len(positions) > MAX_OCCURRENCES]:
+            del self.positions[kmer]
+
+    def anchors(self, queryMinimizers):
+        """ returns the (target position, query position) of the minimizers shared by the query
+        (whose minimizers are given, as returned by minimizers()) and the target """
+        anchors = []
+        for queryPosition, kmer in queryMinimizers:
+            for targetPosition in self.positions.get(kmer, []):
+                anchors.append((targetPosition, queryPosition))
+        return anchors
+
+
+def chainAnchors(anchors, k=MINIMIZER_K):
+    """ chains co-linear anchors (as returned by MinimizerIndex.anchors()); returns a list of
+    (score, anchors) for the chains scoring at least MIN_CHAIN_SCORE, best first; each anchor
+    belongs to a single chain """
+    anchors = sorted(anchors)
+    scores = []
+    predecessors = []
+
+    for i, (targetPosition, queryPosition) in enumerate(anchors):
+        best, predecessor = k, -1
+
+        for j in range(i-1, max(-1, i-1-CHAIN_LOOKBACK), -1):
+            targetGap = targetPosition - anchors[j][0]
+            queryGap = queryPosition - anchors[j][1]
+            if targetGap > MAX_CHAIN_GAP:
+                break
+            if targetGap <= 0 or queryGap <= 0 or queryGap > MAX_CHAIN_GAP:
+                continue
+
+            # the gap cost grows with the difference in diagonal, ie the length of the indel
+            # between the two anchors
+            indel = abs(targetGap - queryGap)
+            cost = 0.01 * k * indel + 0.5 * math.log(indel, 2) if indel > 0 else 0
+            score = scores[j] + min(targetGap, queryGap, k) - cost
+            if score > best:
+                best, predecessor = score, j
+
+        scores.append(best)
+        predecessors.append(predecessor)
+
+    # chains are traced back from the highest-scoring anchors, stopping where they run into an
+    # anchor that already belongs to a better chain
+    used = set()
+    chains = []
+    for i in sorted(range(len(anchors)), key=lambda i: -scores[i]):
+        if i in used:
+            continue
+        chain = []
+        j = i
+        while j >= 0 and j not in used:
+            chain.append(j)
+            used.add(j)
+            j = predecessors[j]
+
+        score = scores[i] - (scores[j] if j >= 0 else 0)
+        if score >= MIN_CHAIN_SCORE:
+            chains.append((score, [anchors[c] for c in reversed(chain)]))
+
+    chains.sort(key=lambda chain: -chain[0])
+    return chains
+
+
+def chainWindow(chain, queryLength, targetLength, k=MINIMIZER_K):
+    """ returns the stretch (start, end; inclusive) of the target to align the query against for
+    the given chain """
+    firstTarget, firstQuery = chain[0]
+    lastTarget, lastQuery = chain[-1]
+
+    before = int(firstQuery * (1 + WINDOW_SLACK))
+    after = int((queryLength - lastQuery - k) * (1 + WINDOW_SLACK))
+
+    start = max(0, firstTarget - before - WINDOW_PADDING)
+    end = min(targetLength-1, lastTarget + k + after + WINDOW_PADDING)
+    return start, end
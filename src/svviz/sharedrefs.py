@@ -0,0 +1,124 @@
+""" Reference sequences shared with the alignment worker processes through memory-mapped files.
+
+Each sequence is encoded for the ssw library once, written to a file named after its hash, and
+handed to the workers as a small SharedReference handle; the workers map the file and align
+against it directly instead of unpickling and re-encoding the sequence for every task. Since the
+files are keyed by the sequence hash, a reference that is needed again (eg for the next sample)
+is not written twice.
+"""
+
+import atexit
+import collections
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+from ctypes import c_int8
+
+
+# how many reference files are kept around by the main process; older ones are deleted (workers
+# that have already mapped them keep a valid mapping)
+MAX_SHARED_REFERENCES = 256
+
+# how many mapped files each worker keeps open
+_ATTACHED_CACHE_SIZE = 64
+
+
+class SharedReference(object):
+    """ a picklable handle to a reference sequence stored in a memory-mapped file; the file holds
+    the encoded sequence followed by the sequence itself """
+    def __init__(self, path, length):
+        self.path = path
+        self.length = length
+
+        # the files are named after the sha1 of the sequence
+        self.key = os.path.basename(path)
+
+    def __len__(self):
+        return self.length
+
+    def encoded(self):
+        """ returns the encoded sequence as a c_int8 array backed by the mapped file (no copy) """
+        if self.length == 0:
+            return (c_int8 * 0)()
+        return (c_int8 * self.length).from_buffer(_attach(self.path))
+
+    def seq(self):
+        """ returns the (unencoded) sequence as a string """
+        if self.length == 0:
+            return ""
+        seq = _attach(self.path)[self.length:2*self.length]
+        if not isinstance(seq, str):
+            seq = seq.decode("ascii")
+        return seq
+
+    def __repr__(self):
+        return "SharedReference({}, {})".format(self.path, self.length)
+
+
+_attached = collections.OrderedDict()
+
+def _attach(path):
+    """ maps a reference file, reusing the mapping if the file has already been mapped by this
+    process """
+    if path in _attached:
+        mapped = _attached.pop(path)
+    else:
+        with open(path, "rb") as f:
+            # copy-on-write, so that ctypes can wrap the mapping; nothing ever writes to it
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    _attached[path] = mapped
+    while len(_attached) > _ATTACHED_CACHE_SIZE:
+        # arrays returned by encoded() keep their own reference to the mapping
+        _attached.popitem(last=False)
+
+    return mapped
+
+
+_directory = None
+_shared = collections.OrderedDict()
+
+def shareReference(seq):
+    """ returns a SharedReference for seq, writing the file if this sequence hasn't been shared
+    yet """
+    global _directory
+    from ssw import ssw_wrap
+
+    if not isinstance(seq, str):
+        seq = seq.decode("ascii")
+    key = hashlib.sha1(seq.encode("ascii")).hexdigest()
+
+    if key in _shared:
+        reference = _shared.pop(key)
+    else:
+        if _directory is None:
+            _directory = tempfile.mkdtemp(prefix="svviz-refs-")
+
+        path = os.path.join(_directory, key)
+        with open(path+".tmp", "wb") as f:
+            f.write(ssw_wrap.Aligner().encode(seq))
+            f.write(seq.encode("ascii"))
+        os.rename(path+".tmp", path)
+
+        reference = SharedReference(path, len(seq))
+
+    _shared[key] = reference
+    while len(_shared) > MAX_SHARED_REFERENCES:
+        key, oldest = _shared.popitem(last=False)
+        os.remove(oldest.path)
+
+    return reference
+
+def closeSharedReferences():
+    """ deletes all the reference files written by shareReference() """
+    global _directory
+
+    if _directory is not None:
+        shutil.rmtree(_directory, ignore_errors=True)
+
+    _directory = None
+    _shared.clear()
+
+atexit.register(closeSharedReferences)
@@ -0,0 +1,63 @@
+from svviz import multiprocessor
+from svviz import planner
+
+
+class _Squarer(multiprocessor.Multiprocessor):
+    def __init__(self, offset):
+        self.offset = offset
+
+    def square(self, x):
+        return x * x + self.offset
+
+    def squareMany(self, xs):
+        return [self.square(x) for x in xs]
+
+def checkPoolReuse():
+    # the pool is started for the largest number of processes asked for, then reused by the
+    # map() calls asking for fewer
+    multiprocessor.closePool()
+    pools = []
+    for processes, batched in [(2, False), (1, True), (2, True), (1, False)]:
+        method = _Squarer.squareMany if batched else _Squarer.square
+        results = _Squarer.map(method, list(range(50)), initArgs=[1], processes=processes, verbose=0,
+            batched=batched)
+        if sorted(results) != [x * x + 1 for x in range(50)]:
+            return False, "wrong results with processes={} batched={}".format(processes, batched)
+        pools.append(multiprocessor.getPool(1))
+
+    if any(pool is not pools[0] for pool in pools):
+        return False, "the pool was restarted between map() calls"
+    if multiprocessor.poolSize() != 2:
+        return False, "the pool has {} processes instead of 2".format(multiprocessor.poolSize())
+    return True, ""
+
+def checkPlannedPool():
+    # a job with fewer reads than processes still starts the pool with all of them, so that the
+    # bigger job after it runs on the same pool
+    multiprocessor.closePool()
+    pools = []
+    for reads in [2, 40]:
+        plan = planner.plan(["ACGT"*25]*reads, 1000, processes=3, backend="processes")
+        if plan.poolSize != 3 or plan.workers != min(reads, 3):
+            return False, "planned {} workers on a pool of {} for {} reads".format(plan.workers, plan.poolSize, reads)
+        _Squarer.map(_Squarer.square, list(range(reads)), initArgs=[1], processes=plan.poolSize, verbose=0,
+            chunks=plan.chunks)
+        pools.append(multiprocessor.getPool(1))
+
+    if pools[0] is not pools[1]:
+        return False, "the pool was restarted after a small job"
+    return True, ""
+
+def run():
+    """ checks the reuse of the worker pool across Multiprocessor.map() calls """
+    try:
+        for check in [checkPoolReuse, checkPlannedPool]:
+            result = check()
+            if not result[0]:
+                return result
+        return True, ""
+    finally:
+        multiprocessor.closePool()
+
+if __name__ == '__main__':
+    print(run())
@@ -0,0 +1,128 @@
+import os
+import random
+import shutil
+import tempfile
+
+import pysam
+
+from svviz import mateindex
+from svviz import pairfinder
+from svviz.pairfinder import PairFinder, TooManyReadsException
+from svviz.utilities import Locus
+
+
+CHROM_LENGTH = 200000
+
+def _read(header, name, chrom, pos, flag, mateChrom, matePos):
+    read = pysam.AlignedSegment(header)
+    read.query_name = name
+    read.query_sequence = "".join(random.choice("ACGT") for i in range(100))
+    read.flag = flag
+    read.reference_name = chrom
+    read.reference_start = pos
+    read.mapping_quality = 60
+    read.cigarstring = "100M"
+    read.next_reference_name = mateChrom
+    read.next_reference_start = matePos
+    read.query_qualities = pysam.qualitystring_to_array("I" * 100)
+    return read
+
+def writeBam(directory, properPairs=1000, discordantPairs=60):
+    """ writes a sorted, indexed bam of read pairs, properly paired on chr1 between 10kb and 70kb,
+    and discordant between chr1 and chr2; returns its path """
+    random.seed(1)
+    header = pysam.AlignmentHeader.from_dict({"HD": {"VN": "1.0"},
+        "SQ": [{"SN": "chr1", "LN": CHROM_LENGTH}, {"SN": "chr2", "LN": CHROM_LENGTH}]})
+
+    unsortedPath = os.path.join(directory, "unsorted.bam")
+    with pysam.AlignmentFile(unsortedPath, "wb", header=header) as bam:
+        for i in range(properPairs):
+            pos = random.randint(10000, 69000)
+            bam.write(_read(header, "proper{}".format(i), "chr1", pos, 99, "chr1", pos+300))
+            bam.write(_read(header, "proper{}".format(i), "chr1", pos+300, 147, "chr1", pos))
+        for i in range(discordantPairs):
+            pos1, pos2 = random.randint(10000, 190000), random.randint(10000, 190000)
+            bam.write(_read(header, "discordant{}".format(i), "chr1", pos1, 97, "chr2", pos2))
+            bam.write(_read(header, "discordant{}".format(i), "chr2", pos2, 145, "chr1", pos1))
+
+    path = os.path.join(directory, "reads.bam")
+    pysam.sort("-o", path, unsortedPath)
+    pysam.index(path)
+    return path
+
+def checkSampleWithMaxReads(bamPath):
+    # only the reads kept by the sampling count towards max_reads, so 100 sampled pairs fit well
+    # within 400 reads even though many more reads go by before the sampling drops them
+    bam = pysam.AlignmentFile(bamPath)
+    try:
+        pairFinder = PairFinder([Locus("chr1", 10000, 70000, "+")], bam, sample_reads=100, max_reads=400)
+    except TooManyReadsException:
+        return False, "sampling 100 pairs exceeded max_reads=400"
+
+    names = set(read.qname for pair in pairFinder.matched for read in pair)
+    if len(names) != 100:
+        return False, "sampled {} read names instead of 100".format(len(names))
+    return True, ""
+
+def checkMateIndex(bamPath):
+    # the index covers the whole bam even if the bam has already been read from (here, the
+    # second half of chr2), and is the same when read back from disk
+    bam = pysam.AlignmentFile(bamPath)
+    for read in bam.fetch("chr2", CHROM_LENGTH//2, CHROM_LENGTH):
+        pass
+
+    with pysam.AlignmentFile(bamPath) as fresh:
+        discordant = [read for read in fresh.fetch(until_eof=True) if mateindex.isDiscordant(read)]
+    directory = os.path.join(os.path.dirname(bamPath), "mateindex")
+
+    for attempt in ["built", "loaded"]:
+        index = mateindex.load(bamPath, directory)
+        if len(index) != len(discordant):
+            return False, "{} mate index has {} of the {} discordant reads".format(attempt, len(index), len(discordant))
+
+        for read in discordant:
+            found = []
+            for offset in index.lookup(read.qname, read.tid, read.pos):
+                bam.seek(offset)
+                found.append(next(bam))
+            if not any(mate.qname == read.qname and mate.flag == read.flag for mate in found):
+                return False, "{} mate index doesn't find {}".format(attempt, read.qname)
+
+    return True, ""
+
+def checkMateMergeDistance(bamPath):
+    # the mate positions are merged over shorter distances where there are more reads, and the
+    # mates are all found either way
+    bam = pysam.AlignmentFile(bamPath)
+    pairs = {}
+    for mergeRecords in [pairfinder.MATE_FETCH_MERGE_RECORDS, 10]:
+        originalRecords, pairfinder.MATE_FETCH_MERGE_RECORDS = pairfinder.MATE_FETCH_MERGE_RECORDS, mergeRecords
+        try:
+            pairFinder = PairFinder([Locus("chr2", 10000, 190000, "+")], bam)
+            distances = [pairFinder.mateMergeDistance(chrom) for chrom in ["chr1", "chr2"]]
+        finally:
+            pairfinder.MATE_FETCH_MERGE_RECORDS = originalRecords
+        pairs[mergeRecords] = sorted((pair[0].qname, len(pair)) for pair in pairFinder.matched)
+
+    if distances[0] >= pairfinder.MATE_FETCH_MERGE_DISTANCE or distances[1] != pairfinder.MATE_FETCH_MERGE_DISTANCE:
+        return False, "merge distances of {} for the deep chr1 and {} for the sparse chr2".format(*distances)
+    if pairs[10] != pairs[pairfinder.MATE_FETCH_MERGE_RECORDS] or any(count != 2 for name, count in pairs[10]):
+        return False, "mates missing with the shorter merge distance"
+    return True, ""
+
+def run():
+    """ checks PairFinder on a simulated bam """
+    directory = tempfile.mkdtemp()
+    try:
+        bamPath = writeBam(directory)
+        for check in [checkSampleWithMaxReads, checkMateIndex, checkMateMergeDistance]:
+            result = check(bamPath)
+            if not result[0]:
+                return result
+    finally:
+        shutil.rmtree(directory)
+
+    return True, ""
+
+if __name__ == '__main__':
+    print(run())
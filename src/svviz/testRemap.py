@@ -0,0 +1,285 @@
+import collections
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from svviz import alignproc
+from svviz import remap
+from svviz.aligncache import AlignmentCache
+from svviz.flanking import FlankingRegionCollection
+from svviz.genomesource import GenomeSource
+from svviz.utilities import Locus, reverseComp
+from svviz.variants import Deletion, Translocation
+
+
+MAX_SIMILARITY = 0.95
+
+class _Read(object):
+    # the attributes of a pysam read used by remap.chooseBestAlignment()
+    def __init__(self, seq):
+        self.qname = seq
+        self.seq = seq
+        self.is_reverse = False
+        self.mapq = 60
+
+def _mutate(seq, rate):
+    # substitutions and short indels
+    mutated = []
+    for base in seq:
+        r = random.random()
+        if r < rate:
+            mutated.append(random.choice("ACGT"))
+        elif r < rate*1.2:
+            continue
+        elif r < rate*1.4:
+            mutated.append(base + random.choice("ACGT"))
+        else:
+            mutated.append(base)
+    return "".join(mutated)
+
+def makeChromParts():
+    """ a translocation within a random sequence, so that each allele has two chromosome parts; a
+    stretch from near the second breakpoint is repeated near the first one, so that reads from it
+    are multimapping """
+    random.seed(1)
+    genome = "".join(random.choice("ACGT") for i in range(40000))
+    genome = genome[:10300] + genome[29400:29700] + genome[10600:]
+
+    variant = Translocation(Locus("chr1", 10000, 10000, "+"), Locus("chr1", 30000, 30000, "+"), 1000,
+        GenomeSource(genome))
+    return collections.OrderedDict((allele, variant.chromParts(allele)) for allele in ["ref", "alt"])
+
+def sampleReads(chromPartsCollections, count, length, rate):
+    """ reads from all the chromosome parts, a quarter of them reverse-complemented """
+    partSeqs = [part.getSeq() for chromPartsCollection in chromPartsCollections.values()
+                for part in chromPartsCollection]
+
+    reads = []
+    for i in range(count):
+        partSeq = random.choice(partSeqs)
+        start = random.randint(0, len(partSeq)-length)
+        read = _mutate(partSeq[start:start+length], rate)
+        if i % 4 == 0:
+            read = reverseComp(read)
+        reads.append(read)
+    return reads
+
+def bestAlignments(chromPartsCollections, remapped):
+    """ returns seq -> allele -> (part, start, end, strand, cigar, score, score2) of the alignment
+    picked for each allele """
+    best = {}
+    for seq, mappings in remapped.items():
+        best[seq] = {}
+        for allele, chromPartsCollection in chromPartsCollections.items():
+            partMappings = collections.OrderedDict((name, mappings[name]) for name in chromPartsCollection.parts)
+            aln = remap.chooseBestAlignment(_Read(seq), partMappings, chromPartsCollection)
+            if aln is not None:
+                aln = (aln.regionID, aln.start, aln.end, aln.strand, aln.cigar, aln.score, aln.score2)
+            best[seq][allele] = aln
+    return best
+
+def _multimapping(aln):
+    return aln[6] is not None and aln[6] / float(aln[5]) > MAX_SIMILARITY
+
+def compare(chromPartsCollections, seqs, description, exactScore2=False, **remapArgs):
+    """ checks that realigning seqs with the given remapSeqs() arguments picks the same alignments
+    as a plain realignment; unless exactScore2, the second-best scores only need to agree on
+    whether the reads are multimapping """
+    expected = bestAlignments(chromPartsCollections, remap.remapSeqs(chromPartsCollections, seqs, processes=1))
+    actual = bestAlignments(chromPartsCollections, remap.remapSeqs(chromPartsCollections, seqs, processes=1,
+        **remapArgs))
+
+    for seq in seqs:
+        for allele in chromPartsCollections:
+            expectedAln, actualAln = expected[seq][allele], actual[seq][allele]
+            if (expectedAln is None) != (actualAln is None):
+                same = False
+            elif exactScore2 or expectedAln is None:
+                same = expectedAln == actualAln
+            else:
+                same = expectedAln[:6] == actualAln[:6] and _multimapping(expectedAln) == _multimapping(actualAln)
+            if not same:
+                return False, "{}: {} alignment of {} is {} instead of {}".format(
+                    description, allele, seq, actualAln, expectedAln)
+
+    return True, ""
+
+def checkExactIndex(chromPartsCollections):
+    seqs = sampleReads(chromPartsCollections, 200, 150, 0) + sampleReads(chromPartsCollections, 50, 150, 0.02)
+    return compare(chromPartsCollections, seqs, "exact index", tryExact=True)
+
+def checkPrefilter(chromPartsCollections):
+    # reads from one part of an allele share no k-mers with its other part (except in the repeat)
+    seqs = sampleReads(chromPartsCollections, 200, 150, 0.02)
+
+    remapped = remap.remapSeqs(chromPartsCollections, seqs, processes=1, maxSecondScoreRatio=MAX_SIMILARITY)
+    if not any(isinstance(aln, remap.SkippedAlignment) for mappings in remapped.values() for strand, aln in mappings.values()):
+        return False, "prefilter: no alignments were skipped"
+
+    return compare(chromPartsCollections, seqs, "prefilter", maxSecondScoreRatio=MAX_SIMILARITY)
+
+def checkDedupe(chromPartsCollections):
+    # two samples sharing some of their read sequences, realigned together and separately
+    shared = sampleReads(chromPartsCollections, 50, 150, 0.02)
+    samples = [shared + sampleReads(chromPartsCollections, 50, 150, 0.02) for i in range(2)]
+
+    remapped = remap.remapSeqs(chromPartsCollections, samples[0] + samples[1], processes=1)
+    if len(remapped) != len(set(samples[0] + samples[1])):
+        return False, "dedupe: {} realignments for {} distinct sequences".format(len(remapped), len(set(samples[0] + samples[1])))
+    together = bestAlignments(chromPartsCollections, remapped)
+
+    for sample in samples:
+        alone = bestAlignments(chromPartsCollections, remap.remapSeqs(chromPartsCollections, sample, processes=1))
+        for seq in sample:
+            if together[seq] != alone[seq]:
+                return False, "dedupe: alignments of {} are {} instead of {}".format(seq, together[seq], alone[seq])
+
+    return True, ""
+
+def checkPredictStrand(chromPartsCollections):
+    # the parts are all on the forward strand, so the reverse-complemented reads are first aligned
+    # on the wrong strand
+    seqs = sampleReads(chromPartsCollections, 200, 150, 0.02)
+    return compare(chromPartsCollections, seqs, "predict strand", maxSecondScoreRatio=MAX_SIMILARITY,
+        predictStrand=True)
+
+def checkSeedChain(chromPartsCollections):
+    seqs = sampleReads(chromPartsCollections, 30, 1200, 0.03)
+    result = compare(chromPartsCollections, seqs, "seed chain", seedChain=True)
+    if not result[0]:
+        return result
+
+    # deletions closer to the ends of a read than the length of a minimizer are outside its chain,
+    # so they lie beyond the edges of the window the chain spans (before padding)
+    partSeq = chromPartsCollections["ref"].getSeq("ref_chr1")
+    read = partSeq[100:112] + partSeq[117:1200] + partSeq[1205:1217]
+
+    expected = bestAlignments(chromPartsCollections, remap.remapSeqs(chromPartsCollections, [read], processes=1))
+    actual = bestAlignments(chromPartsCollections, remap.remapSeqs(chromPartsCollections, [read], processes=1,
+        seedChain=True))
+    if expected[read]["ref"][:3] != ("ref_chr1", 100, 1216):
+        return False, "seed chain: plain alignment of the read with deletions is {}".format(expected[read]["ref"])
+    if actual[read]["ref"][:6] != expected[read]["ref"][:6]:
+        return False, "seed chain: alignment of the read with deletions is {} instead of {}".format(
+            actual[read]["ref"], expected[read]["ref"])
+
+    return True, ""
+
+def checkCache(chromPartsCollections):
+    # a second run with the crash-isolated subprocesses (processes=-1) gets every realignment from
+    # the cache (which marks them as used), and the same alignments as without a cache
+    seqs = sampleReads(chromPartsCollections, 50, 150, 0.02)
+    expected = bestAlignments(chromPartsCollections, remap.remapSeqs(chromPartsCollections, seqs, processes=1))
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = AlignmentCache(os.path.join(directory, "cache.sqlite"), 1e8)
+        for attempt in ["first", "second"]:
+            t0 = time.time()
+            remapped = remap.remapSeqs(chromPartsCollections, seqs, processes=-1, cache=cache)
+            if bestAlignments(chromPartsCollections, remapped) != expected:
+                return False, "cache: {} run gave different alignments".format(attempt)
+
+        if not os.path.exists(cache.path):
+            return False, "cache: nothing was cached"
+        connection = sqlite3.connect(cache.path)
+        count, used = connection.execute("SELECT COUNT(*), SUM(atime >= ?) FROM alignments", (t0,)).fetchone()
+        connection.close()
+        if count != len(set(seqs)) or used != count:
+            return False, "cache: {} of the {} cached realignments were used, for {} reads".format(used, count, len(set(seqs)))
+    finally:
+        alignproc.closeWorkers()
+        shutil.rmtree(directory)
+
+    return True, ""
+
+def checkMateWindow(chromPartsCollections):
+    # pairs from the start of ref_chr1, which the first part of each allele shares, away from the
+    # repeat; the second read of each pair is aligned only near the first
+    partSeq = chromPartsCollections["ref"].getSeq("ref_chr1")
+    pairs = []
+    for i in range(20):
+        start = random.randint(0, 550)
+        mate = _Read(_mutate(partSeq[start:start+150], 0.02))
+        follower = _Read(reverseComp(_mutate(partSeq[start+300:start+450], 0.02)))
+        pairs.append((follower, mate, 200))
+
+    remapped = remap.remapSeqs(chromPartsCollections, [mate.seq for follower, mate, halfWidth in pairs], processes=1)
+    windowed, fallback = remap._alignInMateWindows(chromPartsCollections, pairs, remapped, processes=1)
+    if any(len(followers) > 0 for followers in fallback.values()):
+        return False, "mate window: {} reads fell back to the full alleles".format(
+            sum(len(followers) for followers in fallback.values()))
+
+    followers = [follower for follower, mate, halfWidth in pairs]
+    full = bestAlignments(chromPartsCollections, remap.remapSeqs(chromPartsCollections,
+        [follower.seq for follower in followers], processes=1))
+
+    for follower in followers:
+        for allele, chromPartsCollection in chromPartsCollections.items():
+            aln = remap.chooseBestAlignment(follower, windowed[id(follower)][allele], chromPartsCollection)
+            aln = (aln.regionID, aln.start, aln.end, aln.strand, aln.cigar, aln.score)
+            if aln != full[follower.seq][allele][:6]:
+                return False, "mate window: {} alignment of {} is {} instead of {}".format(
+                    allele, follower.seq, aln, full[follower.seq][allele])
+
+    return True, ""
+
+def checkFlankingShortcut():
+    # a deletion whose deleted segment holds a copy of a stretch of the left flank, so that reads
+    # from that stretch are multimapping against the ref allele but not against the alt allele
+    random.seed(2)
+    genome = "".join(random.choice("ACGT") for i in range(20000))
+    genome = genome[:11000] + genome[9000:9300] + genome[11300:]
+    variant = Deletion.from_breakpoints("chr1", 10000, 12000, 2000, GenomeSource(genome))
+    chromPartsCollections = collections.OrderedDict((allele, variant.chromParts(allele)) for allele in ["ref", "alt"])
+    refOnly = collections.OrderedDict([("ref", chromPartsCollections["ref"])])
+    flankingRegions = FlankingRegionCollection(variant)
+
+    # reads from the left flank (segment 0), at least two read lengths inside it
+    reads = []
+    for i in range(100):
+        start = random.randint(300, 1550) if i % 2 == 0 else random.randint(950, 1300)
+        reads.append(_Read(_mutate(chromPartsCollections["ref"].getSeq("ref_part", start, start+150), 0.01)))
+    confined = dict((read.qname, 0) for read in reads)
+
+    seqs = [read.seq for read in reads]
+    refRemapped = remap.remapSeqs(chromPartsCollections, seqs, processes=1, seqsToAlleles=dict((seq, ["ref"]) for seq in seqs))
+    refSets, altSets, fallback = remap._projectFlanking(reads, refRemapped, refOnly, confined, flankingRegions,
+        MAX_SIMILARITY)
+
+    remapped = remap.remapSeqs(chromPartsCollections, seqs, processes=1)
+    expected = remap._chooseAlignments(chromPartsCollections, reads, remapped)["alt"][0]
+
+    for read in reads:
+        if read.qname in fallback:
+            continue
+        aln = altSets[read.qname].getAlignments()[0]
+        expectedAln = expected[read.qname].getAlignments()[0]
+        aln = (aln.regionID, aln.start, aln.end, aln.strand, aln.cigar, aln.score, aln.score2)
+        expectedAln = (expectedAln.regionID, expectedAln.start, expectedAln.end, expectedAln.strand,
+            expectedAln.cigar, expectedAln.score, expectedAln.score2)
+        if aln[:6] != expectedAln[:6] or _multimapping(aln) != _multimapping(expectedAln):
+            return False, "flanking shortcut: alt alignment of {} is {} instead of {}".format(read.qname, aln, expectedAln)
+
+    if len(fallback) == 0 or len(fallback) == len(reads):
+        return False, "flanking shortcut: {} of {} reads were realigned against the alt allele".format(len(fallback), len(reads))
+
+    return True, ""
+
+def run():
+    """ checks that the realignment shortcuts pick the same alignments as a plain realignment """
+    chromPartsCollections = makeChromParts()
+
+    for check in [checkExactIndex, checkPrefilter, checkDedupe, checkPredictStrand,
+                  checkSeedChain, checkCache, checkMateWindow]:
+        result = check(chromPartsCollections)
+        if not result[0]:
+            return result
+
+    return checkFlankingShortcut()
+
+if __name__ == '__main__':
+    print(run())
@@ -0,0 +1,81 @@
+import random
+
+from ssw import ssw_wrap
+
+
+def _mutate(seq, rate):
+    # substitutions and short indels, so that the alignments have gaps
+    mutated = []
+    for base in seq:
+        r = random.random()
+        if r < rate:
+            mutated.append(random.choice("ACGT"))
+        elif r < rate*1.5:
+            continue
+        elif r < rate*2:
+            mutated.append(base + "".join(random.choice("ACGT") for i in range(random.randint(1, 5))))
+        else:
+            mutated.append(base)
+    return "".join(mutated)
+
+def _cases(count):
+    random.seed(1)
+
+    for i in range(count):
+        refLength = random.choice([50, 300, 1000, 5000])
+        ref = "".join(random.choice("ACGTN" if i % 10 == 0 else "ACGT") for j in range(refLength))
+        if i % 2 == 0:
+            # copies of a repeat, for the sub-optimal alignments
+            repeat = ref[:random.randint(20, 500)]
+            ref = "".join(_mutate(repeat, 0.05) + ref[j:j+300] for j in range(0, refLength, 300))
+            refLength = len(ref)
+
+        # long reads overflow the byte kernels and use the word kernels
+        readLength = random.choice([15, 31, 33, 100, 150, 250, 1200, 3000])
+        readLength = min(readLength, refLength)
+        start = random.randint(0, refLength-readLength)
+        read = _mutate(ref[start:start+readLength], random.choice([0, 0.02, 0.1, 0.3]))
+
+        yield ref, read
+
+def _describe(aln):
+    if aln is None:
+        return None
+    return (aln.score, aln.score2, aln.ref_begin, aln.ref_end, aln.query_begin, aln.query_end,
+        aln.ref_end2, aln.cigar_string)
+
+def _alignAll(cases):
+    results = []
+    for ref, read in cases:
+        aligner = ssw_wrap.Aligner(ref, report_secondary=True, report_cigar=True)
+        results.append(_describe(aligner.align(read)))
+
+        # the batch entry points, including the score-only pass of ssw_align_batch_best
+        aligner = ssw_wrap.MultiAligner([ref, ref[::-1], ref[:len(ref)//2]], report_secondary=True,
+            report_cigar=True)
+        for forward, reverse in aligner.align_many([read], ref_groups=[0, 0, 1])[0]:
+            results.append((_describe(forward), _describe(reverse)))
+    return results
+
+def run(count=500):
+    """ checks that the SSE2 and AVX2 kernels of the ssw library give the same alignments """
+    cases = list(_cases(count))
+
+    if not ssw_wrap.set_simd(True):
+        ssw_wrap.set_simd(False)
+        return True, "AVX2 not supported by this cpu; skipped"
+
+    try:
+        avx2 = _alignAll(cases)
+        ssw_wrap.set_simd(False)
+        sse2 = _alignAll(cases)
+    finally:
+        ssw_wrap.set_simd(True)
+
+    different = sum(1 for a, b in zip(avx2, sse2) if a != b)
+    if different > 0:
+        return False, "{} of {} alignments differ between the SSE2 and AVX2 kernels".format(different, len(avx2))
+    return True, ""
+
+if __name__ == '__main__':
+    print(run())
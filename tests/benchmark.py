@@ -0,0 +1,154 @@
+""" Timings behind the performance changes, on simulated data so that they can be rerun anywhere:
+
+python benchmark.py [which ...]
+
+backends - realigns reads around a deletion serially, with threads and with worker processes
+encoding - encodes sequences for the ssw library, compared to looking up each base in a dict
+readset  - gathers and pairs up the reads from two overlapping regions of a simulated bam
+
+Run it against another checkout (eg with PYTHONPATH pointing to its src directory) to compare
+versions; the readset benchmark writes its bam with svviz.testPairfinder.writeBam(). """
+
+import argparse
+import collections
+from ctypes import c_int8
+import random
+import shutil
+import tempfile
+import time
+import timeit
+
+import pysam
+
+from svviz import multiprocessor
+from svviz import remap
+from svviz import testPairfinder
+from svviz.pairfinder import PairFinder
+from svviz.sharedrefs import shareReference
+from svviz.utilities import Locus
+from ssw import ssw_wrap
+
+
+def randomSeq(length):
+    return "".join(random.choice("ACGT") for i in range(length))
+
+def sampleReads(seq, count, readLength=150):
+    reads = []
+    for i in range(count):
+        start = random.randint(0, len(seq)-readLength)
+        read = seq[start:start+readLength]
+        if random.random() < 0.5:
+            read = remap.reverseComp(read)
+        reads.append(read)
+    return reads
+
+def _time(fn, *args):
+    t0 = time.time()
+    result = fn(*args)
+    return result, time.time() - t0
+
+
+def benchmarkBackends(args, reads=2500):
+    """ a 2kb deletion with 1kb of flanking sequence on either side; the reads come from both
+    alleles """
+    random.seed(1)
+    left, deleted, right = randomSeq(1000), randomSeq(2000), randomSeq(1000)
+
+    namesToReferences = collections.OrderedDict([("ref", left+deleted+right), ("alt", left+right)])
+    namesToAlleles = {"ref": "ref", "alt": "alt"}
+    seqs = sampleReads(namesToReferences["ref"], reads//2) + sampleReads(namesToReferences["alt"], reads//2)
+
+    def serial():
+        mapper = remap.Multimap(namesToReferences, namesToAlleles=namesToAlleles)
+        remapped = {}
+        for i in range(0, len(seqs), remap.planner.BATCH_SIZE):
+            remapped.update(mapper.remapMany(seqs[i:i+remap.planner.BATCH_SIZE]))
+        return remapped
+
+    def threads():
+        mapper = remap.Multimap(namesToReferences, namesToAlleles=namesToAlleles)
+        return remap.remapThreaded(mapper, seqs, args.processes)
+
+    def processes():
+        # as in remap.remapSeqs(), this includes starting the pool
+        namesToShared = collections.OrderedDict((name, shareReference(ref)) for name, ref in namesToReferences.items())
+        return dict(remap.Multimap.map(remap.Multimap.remapMany, seqs, initArgs=[namesToShared, False, namesToAlleles],
+            verbose=0, processes=args.processes, batched=True))
+
+    results = []
+    try:
+        for name, fn in [("serial", serial), ("threads", threads), ("processes", processes)]:
+            remapped, elapsed = _time(fn)
+            results.append((name, remapped))
+            print("{:>10}: {:.2f}s for {} reads".format(name, elapsed, len(seqs)))
+    finally:
+        multiprocessor.closePool()
+
+    for name, remapped in results[1:]:
+        for seq in seqs:
+            for part in namesToReferences:
+                expected, actual = results[0][1][seq][part], remapped[seq][part]
+                if (expected[0], expected[1].ref_begin, expected[1].cigar_string) != (actual[0], actual[1].ref_begin, actual[1].cigar_string):
+                    print("  ** {} realignments differ from the serial ones **".format(name))
+                    return
+
+
+_BASE_TO_INT = {"A":0, "C":1, "G":2, "T":3, "N":4, "a":0, "c":1, "g":2, "t":3, "n":4}
+
+def _encodePerBase(seq):
+    # how ssw_wrap used to encode sequences, for comparison
+    encoded = (c_int8 * len(seq))()
+    for i in range(len(seq)):
+        encoded[i] = _BASE_TO_INT.get(seq[i], 4)
+    return encoded
+
+def benchmarkEncoding(args, reads=100):
+    """ a 20kb reference and 150bp reads """
+    random.seed(1)
+    reference = randomSeq(20000)
+    seqs = sampleReads(reference, reads)
+    aligner = ssw_wrap.Aligner()
+
+    for name, seq, number in [("20kb reference", reference, 100), ("150bp read", seqs[0], 10000)]:
+        perBase = timeit.timeit(lambda: _encodePerBase(seq), number=number) / number
+        table = timeit.timeit(lambda: aligner._DNA_to_int_mat(seq, len(seq)), number=number) / number
+        print("  encode {}: {:.1f}us per base lookup, {:.1f}us translation table".format(name, perBase*1e6, table*1e6))
+
+    mapper = remap.Multimap({"ref": reference})
+    elapsed = timeit.timeit(lambda: [mapper.remap(seq) for seq in seqs], number=1)
+    print("  Multimap.remap(): {:.2f}ms per read".format(elapsed / len(seqs) * 1e3))
+
+
+def benchmarkReadSet(args, pairs=50000):
+    """ about 100k reads, most of which are in both regions """
+    directory = tempfile.mkdtemp()
+    try:
+        bamPath = testPairfinder.writeBam(directory, properPairs=pairs)
+        regions = [Locus("chr1", 10000, 60000, "+"), Locus("chr1", 20000, 70000, "+")]
+
+        with pysam.AlignmentFile(bamPath) as bam:
+            pairFinder, elapsed = _time(PairFinder, regions, bam)
+        reads = sum(len(pair) for pair in pairFinder.matched)
+        print("  PairFinder: {:.2f}s for {} reads in {} groups".format(elapsed, reads, len(pairFinder.matched)))
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = collections.OrderedDict([
+    ("backends", benchmarkBackends),
+    ("encoding", benchmarkEncoding),
+    ("readset", benchmarkReadSet)
+])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--processes", type=int, default=4, help="workers for the threads and processes backends")
+    parser.add_argument("which", nargs="*", help="which benchmarks to run (default all): {}".format(", ".join(BENCHMARKS)))
+    args = parser.parse_args()
+
+    for name in (args.which or BENCHMARKS):
+        print("\n -- {} --".format(name))
+        BENCHMARKS[name](args)
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,10 @@ from svviz import testIssues
 from svviz import rendertest
 from svviz import testDemos
 from svviz import testCounts
+from svviz import testSimd
+from svviz import testPairfinder
+from svviz import testMultiprocessor
+from svviz import testRemap
 
 
 # USAGE = """
@@ -126,6 +130,22 @@ def run(which):
     if len(which)==0 or "counts" in which:
         summary.loc["counts"] = _runTest(runTestCounts, "counts")
 
+    # Check that the SSE2 and AVX2 alignment kernels agree
+    if len(which)==0 or "simd" in which:
+        summary.loc["simd"] = _runTest(testSimd.run, "simd")
+
+    # Check PairFinder on a simulated bam
+    if len(which)==0 or "pairfinder" in which:
+        summary.loc["pairfinder"] = _runTest(testPairfinder.run, "pairfinder")
+
+    # Check that the worker pool is reused across jobs
+    if len(which)==0 or "multiprocessor" in which:
+        summary.loc["multiprocessor"] = _runTest(testMultiprocessor.run, "multiprocessor")
+
+    # Check that the realignment shortcuts pick the same alignments as a plain realignment
+    if len(which)==0 or "remap" in which:
+        summary.loc["remap"] = _runTest(testRemap.run, "remap")
+
     # Run the render regression tests
     if len(which)==0 or "rendering" in which:
         summary.loc["rendering"] = _runTest(rendertest.run, "rendering")    